@@ -1,12 +1,23 @@
-import geopandas as gpd
-import pandas as pd
+import os
+import sys
 import altair as alt
 import dash
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-import dash_gif_component as Gif
 from dash.dependencies import Input, Output
+from chart_cache import ChartCache
+from data_api import DataAPI
+from datastore import LineStore, window_means
+from metrics import Metrics
+# The grid store reader is shared with the scripts that write it
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from frame_api import FrameAPI
+from point_api import PointAPI
+from tile_api import TileAPI
+from topology import build_layers
+from window_stats import (load_windows, read_window_stats, stats_path,
+                          window_stats, windows_path)
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 
@@ -22,26 +33,13 @@ app.title = 'Air Quality'
 ####################################################################################################
 pollutants = ['NOX', 'BC', 'OZONE', 'PM25HR', 'NO2']
 
-# Load geojson to dataframe object
-shape_gdf = gpd.read_file('data/raw/Bay_Area_Counties.geojson')
-
-# Load sites data
-sites = pd.read_csv('data/wrangled/sites_data.csv')
-sites_gdf = gpd.GeoDataFrame(sites, geometry=gpd.points_from_xy(sites.longitude,
-                                                                sites.latitude))
-
-# Load line chart data
-lc_OZONE = pd.read_csv('data/wrangled/OZONE_line_plot.csv')
-lc_BC = pd.read_csv('data/wrangled/BC_line_plot.csv')
-lc_NOX = pd.read_csv('data/wrangled/NOX_line_plot.csv')
-lc_PM25HR = pd.read_csv('data/wrangled/PM25HR_line_plot.csv')
-lc_NO2 = pd.read_csv('data/wrangled/NO2_line_plot.csv')
-
-lc_dict = {'OZONE': lc_OZONE, 
-           'NOX': lc_NOX, 
-           'BC': lc_BC, 
-           'PM25HR': lc_PM25HR,
-           'NO2': lc_NO2}
+# Paths to chart source data (written by scripts/run_all.py)
+counties_layers = build_layers('data/raw/Bay_Area_Counties.geojson', 'data/wrangled')
+sites_path = 'data/wrangled/sites_data.csv'
+
+# Line chart data, loaded per pollutant on first request
+line_store = LineStore('data/wrangled')
+
 param_title = {'OZONE': 'Ozone', 
                'NOX': 'NOx', 
                'PM25HR': 'PM 2.5', 
@@ -53,12 +51,37 @@ units_dict = {'OZONE': 'ppm',
               'BC': 'µg/m3',
               'NO2': 'ppm'}
 
-# Create base-map
-base_map = (alt.Chart(shape_gdf).mark_geoshape(
-                stroke='black',
-                fill = 'lightgray'
-                ).encode())
+# Intervention windows whose means can be overlaid on the line chart,
+# and the ones overlaid by default
+windows = load_windows(windows_path('data/raw'))
+default_windows = [w['name'] for w in windows if w.get('default')]
+
+# Rendered chart documents, keyed on their source files' fingerprints
+chart_cache = ChartCache(maxsize=4*len(pollutants))
+
+# Window statistics per pollutant, written by run_all.py
+stats_cache = ChartCache(maxsize=len(pollutants))
+
+# Width of the line chart in pixels, also the most points drawn per station
+line_width = 1100
+
+# JSON routes the charts load their data from
+data_api = DataAPI(server, line_store, pollutants, counties_layers, sites_path,
+                   line_width)
+
+# Interpolated values at given points and dates
+point_api = PointAPI(server, pollutants, 'data/wrangled')
 
+# Zoomable map tiles of the interpolated values
+tile_api = TileAPI(server, pollutants, 'data/wrangled', 'data/tiles')
+
+# Quantized frames of the interpolated values, animated in the browser
+frame_api = FrameAPI(server, pollutants, 'data/wrangled')
+
+# Callback and data route latency on /metrics, if AQ_METRICS is set
+metrics = Metrics(server, endpoints=['line_data', 'counties_data', 'sites_data',
+                                     'point_data', 'points_data', 'tile_data',
+                                     'frames_data'])
 
 
 #####################################################################################################
@@ -67,24 +90,52 @@ base_map = (alt.Chart(shape_gdf).mark_geoshape(
 
 def plot_sensors():
     """
-    Returns Altair plot of point locations in gdf overlayed
-    on base map.
+    Returns Altair plot of point locations overlayed on base
+    map, both loaded from the data routes by url.
     """
-    sites_map = (alt.Chart(sites_gdf)
-             .mark_geoshape(color = 'red', 
-                            size = .25)
-             .encode(tooltip = ['name']))
+    features = alt.DataFormat(property='features', type='json')
+    counties = alt.TopoDataFormat(type='topojson', feature='counties')
+    # Create base-map
+    base_map = (alt.Chart(alt.UrlData(data_api.counties_url(), format=counties))
+                .mark_geoshape(
+                    stroke='black',
+                    fill = 'lightgray'
+                    ).encode())
+    sites_map = (alt.Chart(alt.UrlData(data_api.sites_url(), format=features))
+             .mark_geoshape(color = 'red')
+             .encode(tooltip = [alt.Tooltip('properties.name:N', title='name')]))
     return ((base_map + sites_map).properties(title = "Sensor Locations",
                                              height = 450,
                                              width = 500)
                                              .configure(background='#cae1ff')
                                              .configure_title(fontSize = 24))
 
-def plot_line(param='NOX'):
-    lp = (alt.Chart(lc_dict[param]).mark_line(size=1)
+def line_stats(param):
+    """
+    Returns the window statistics of param, computed from its line
+    chart data if run_all.py hasn't written them
+    """
+    path = stats_path(param, 'data/wrangled')
+
+    def load():
+        if os.path.exists(path):
+            return read_window_stats(path)
+        return window_stats(line_store.get(param), param, windows)
+    return stats_cache.get(param, [path, line_store.path(param)], load)
+
+def plot_line(param='NOX', start_date=None, end_date=None, names=()):
+    """
+    Returns Altair line plot of the daily values of param per station
+    between start_date and end_date, each station downsampled to
+    about one point per pixel of chart width, with the means of the
+    windows in names
+    """
+    means = window_means(line_stats(param), names, start_date, end_date)
+    lc = alt.UrlData(data_api.line_url(param, start_date, end_date))
+    lp = (alt.Chart(lc).mark_line(size=1)
                 .encode(
                     x=alt.X('date:T', title='',axis = alt.Axis(labelFontSize = 13)),
-                    y=alt.Y(param, 
+                    y=alt.Y(param+':Q', 
                             title = '{} ({})'.format(param_title[param],
                                                 units_dict[param]),
                             axis = alt.Axis(labelFontSize = 16,
@@ -93,30 +144,90 @@ def plot_line(param='NOX'):
                                     title = 'Station'),
                     tooltip=['name:N'])
                 .properties(height = 300, 
-                            width = 1100, 
+                            width = line_width, 
                             title = 'Daily average {} concentration per station'.format(param_title[param])))
-    pre_line = (alt.Chart(lc_dict[param])
-        .mark_line(size=3, color='black')
-        .encode(x='date:T',y='Pre-Shelter in place mean:Q'))
-    post_line = (alt.Chart(lc_dict[param])
-        .mark_line(size=3, color='black')
-        .encode(x='date:T',y='Post-Shelter in place mean:Q'))
+    mean_lines = (alt.Chart(means)
+        .mark_line(size=3, color='black', point=True)
+        .encode(x='date:T',y='mean:Q',detail='window:N',
+                tooltip=['window:N', 'mean:Q', 'weekday:Q', 'weekend:Q']))
     text = alt.Chart().mark_text(dx=340,
                                 dy=-130,
                                 size=18,
-                                text='Black = Mean value Pre- and Post- Shelter in Place').encode()
-    return ((lp + pre_line + post_line + text)
+                                text='Black = Mean value over the chosen windows').encode()
+    return ((lp + mean_lines + text)
                 .configure_title(fontSize = 24)
                 .configure_legend(titleFontSize=16))
 
-def render_gif(param='NOX'):
-    gp = Gif.GifPlayer(
-            gif='assets/'+param+'.gif',
-            still='assets/'+param+'_29.png'
-                 )
-    return gp
+def sensor_html():
+    """
+    Returns the sensor map document, rebuilt only when the sites
+    or county files change.
+    """
+    return chart_cache.get('sensors',
+                           [sites_path, counties_layers['medium']],
+                           lambda: plot_sensors().to_html())
+
+def line_html(param='NOX', start_date=None, end_date=None, names=None):
+    """
+    Returns the line chart document for param and the date range with
+    the means of the windows in names (the default ones if None),
+    rebuilding the chart only when its source data changes.
+    """
+    names = tuple(sorted(default_windows if names is None else names))
+    return chart_cache.get(('line', param, start_date, end_date, names),
+                           [line_store.path(param),
+                            stats_path(param, 'data/wrangled')],
+                           lambda: plot_line(param, start_date, end_date,
+                                             names).to_html())
+
+def tile_map_html(param='NOX'):
+    """
+    Returns the zoomable tile map document for param, rebuilt only
+    when its grid store changes.
+    """
+    return chart_cache.get(('tiles', param),
+                           ['data/wrangled/'+param+'_grid/manifest.json'],
+                           lambda: tile_api.map_document(
+                               param, '{} ({})'.format(param_title[param],
+                                                       units_dict[param])))
+
+def player_html(param='NOX'):
+    """
+    Returns the animation document of the interpolated values of
+    param, which loads its frames from the frame stream route.
+    """
+    return chart_cache.get(('frames', param),
+                           ['data/wrangled/'+param+'_grid/manifest.json'],
+                           lambda: frame_api.player_document(
+                               param, param_title[param], units_dict[param],
+                               data_api.counties_url()))
+
+
+def preload():
+    """
+    Loads every pollutant's data and builds the charts and data
+    payloads of the default views. gunicorn.conf.py calls it in the
+    master process before forking, so the workers share them instead
+    of each building their own; its on_reload hook calls it again to
+    pick up the files run_all.py replaced since.
+    """
+    sensor_html()
+    data_api.counties_payload()
+    data_api.sites_payload()
+    for param in pollutants:
+        line_html(param)
+        tile_map_html(param)
+        player_html(param)
+        data_api.line_payload(param)
+        frame_api.frames_payload(param)
+        point_api.open_store(param)
 
 
+# Warm the cache with the charts of the initial layout; the other
+# pollutants' data and charts load on their first request
+sensor_html()
+line_html()
+
 ##########################################################################################
 # APP LAYOUT
 ##########################################################################################
@@ -171,6 +282,24 @@ app.layout = html.Div([
                                                     fontSize = 18
                                                     )
                                     ),
+                                    html.H3("Choose a Date Range:"),
+                                    dcc.DatePickerRange(
+                                        id='date-range',
+                                        min_date_allowed='2020-02-01',
+                                        display_format='YYYY-MM-DD',
+                                        clearable = True
+                                    ),
+                                    html.H3("Overlay Window Means:"),
+                                    dcc.Dropdown(
+                                        id='windows',
+                                        options=[{'label': w['name'], 'value': w['name']}
+                                                 for w in windows],
+                                        value = default_windows,
+                                        multi = True,
+                                        style=dict(width='67%',
+                                                    fontSize = 14
+                                                    )
+                                    ),
                             ]),
                         dcc.Markdown(
                                 """
@@ -196,18 +325,34 @@ app.layout = html.Div([
                                                 width='575',
                                                 height='515',
                                                 # Call plot function
-                                                srcDoc = plot_sensors().to_html()
+                                                srcDoc = sensor_html()
                                             ))
                                         ],
                                     ),
                                     dcc.Tab(
                                         label='Air Quality Time Series',
-                                        value='gif',
+                                        value='frames',
+                                        children=[
+                                            html.Div(html.Iframe(
+                                                sandbox='allow-scripts',
+                                                id='frame-player',
+                                                width='575',
+                                                height='515',
+                                                srcDoc = player_html()
+                                            ))
+                                        ]
+                                    ),
+                                    dcc.Tab(
+                                        label='Zoomable Map',
+                                        value='tiles',
                                         children=[
-                                            html.Div(id='gif-player',
-                                            children = [
-                                                render_gif()
-                                            ])
+                                            html.Div(html.Iframe(
+                                                sandbox='allow-scripts',
+                                                id='tile-map',
+                                                width='575',
+                                                height='515',
+                                                srcDoc = tile_map_html()
+                                            ))
                                         ]
                                     )
                                 ]
@@ -225,7 +370,7 @@ app.layout = html.Div([
                         height='400',
                         width='1425',
                         # Call plot function
-                        srcDoc = plot_line().to_html()
+                        srcDoc = line_html()
                 )]
         ),
         # Row 3
@@ -245,23 +390,38 @@ app.layout = html.Div([
 
 @app.callback(
     dash.dependencies.Output('line-plot', 'srcDoc'),
-              [dash.dependencies.Input('dd-param', 'value')])
-def update_plot(param):
+              [dash.dependencies.Input('dd-param', 'value'),
+               dash.dependencies.Input('date-range', 'start_date'),
+               dash.dependencies.Input('date-range', 'end_date'),
+               dash.dependencies.Input('windows', 'value')])
+@metrics.callback('update_plot')
+def update_plot(param, start_date, end_date, names):
     '''
-    Takes in a date and calls plot_line() to update our Altair figure
+    Takes in a pollutant, date range and windows and calls plot_line()
+    to update our Altair figure
     '''
-    updated_plot = plot_line(param).to_html()
+    updated_plot = line_html(param, start_date, end_date, names or ())
     return updated_plot
 
 @app.callback(
-    dash.dependencies.Output('gif-player', 'children'),
+    dash.dependencies.Output('frame-player', 'srcDoc'),
+              [dash.dependencies.Input('dd-param', 'value')])
+@metrics.callback('update_player')
+def update_player(param):
+    '''
+    Takes in a pollutant and returns the animation of its values
+    '''
+    return player_html(param)
+
+@app.callback(
+    dash.dependencies.Output('tile-map', 'srcDoc'),
               [dash.dependencies.Input('dd-param', 'value')])
-def update_gif(param):
+@metrics.callback('update_map')
+def update_map(param):
     '''
-    Takes in a date and calls plot_line() to update our Altair figure
+    Takes in a pollutant and returns its zoomable tile map
     '''
-    updated_path = render_gif(param)
-    return updated_path
+    return tile_map_html(param)
 
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
@@ -0,0 +1,344 @@
+"""
+Stage-level benchmarks of the content pipeline and the app callbacks.
+
+Runs every stage of scripts/run_all.py, and the app.py callbacks and
+data routes, on synthetic station networks (see synthetic.py) for each
+combination of the station counts, grid resolutions and history
+lengths given, in a temporary copy of the data folders, entirely
+offline. Prints a table and writes the timings, with the commit and
+environment they were measured on, as JSON so runs can be compared
+across commits.
+
+Usage (from the repository root):
+
+    python benchmarks/run_benchmarks.py --stations 20 80 --pixel .05 .02 \
+        --days 60 365 --output bench.json
+"""
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fetch
+import gif_stream
+import grid as grid_module
+import render
+import run_all
+import synthetic
+import topology
+import window_stats
+from grid_store import write_grid_store
+
+PARAM = 'PM25HR'
+
+
+def timed(fn, repeat, setup=None):
+    """
+    Returns the result of fn and the wall times of repeat calls of it
+    in seconds, calling setup before each call
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def summary(times, per=1):
+    """
+    Returns the best, median and mean of times in seconds, divided by
+    per (e.g. the number of frames a call rendered)
+    """
+    times = np.asarray(times)/per
+    return {'best': float(times.min()),
+            'median': float(np.median(times)),
+            'mean': float(times.mean()),
+            'repeat': len(times)}
+
+
+def make_workspace():
+    """
+    Returns a temporary folder laid out like the repository, with the
+    county borders, that the stages can write to
+    """
+    workspace = tempfile.mkdtemp(prefix='aq-bench-')
+    for folder in ['scripts', 'data/raw', 'data/wrangled',
+                   'assets/img/'+PARAM]:
+        os.makedirs(os.path.join(workspace, folder))
+    for name in ['Bay_Area_Counties.geojson', 'intervention_windows.json']:
+        shutil.copy(os.path.join(ROOT, 'data/raw', name),
+                    os.path.join(workspace, 'data/raw'))
+    return workspace
+
+
+def bench_pipeline(sites, days, pixel, frames, repeat):
+    """
+    Returns {stage: timings} of the pipeline stages on a synthetic
+    history of days days at sites, interpolated on a grid of pixel
+    degrees. Runs in the scripts folder of the workspace.
+    """
+    results = {}
+    aq_data = synthetic.observations(sites, days, PARAM)
+    report = synthetic.report_csv(aq_data)
+
+    aq_data, times = timed(lambda: fetch.parse(report), repeat)
+    results['csv_parse'] = summary(times)
+
+    daily, times = timed(lambda: run_all.daily_means(aq_data), repeat)
+    results['daily_means'] = summary(times)
+    stations = run_all.stations(daily, sites)
+    date_cols = sorted(daily['date'].unique())
+    mapped = run_all.map_dates(date_cols)
+
+    site_values, times = timed(lambda: run_all.site_values(daily, stations,
+                                                           mapped),
+                               repeat)
+    results['site_values'] = summary(times)
+
+    def interpolate():
+        grid, interpolator = run_all.make_interpolator(stations, pixel)
+        return grid, interpolator(site_values)
+    (grid, values), times = timed(interpolate, repeat)
+    results['interpolate'] = summary(times)
+
+    def clear_geometry():
+        grid_module.cell_polygons.cache_clear()
+        grid_module.cell_wkt.cache_clear()
+    _, times = timed(lambda: grid_module.cell_wkt(grid), repeat, clear_geometry)
+    results['cell_geometry'] = summary(times)
+
+    _, times = timed(lambda: write_grid_store('../data/wrangled/'+PARAM+'_grid',
+                                              PARAM, grid, mapped, values),
+                     repeat)
+    results['grid_store'] = summary(times)
+
+    line_df, times = timed(lambda: run_all.line_data(daily, stations, date_cols,
+                                                     PARAM),
+                           repeat)
+    results['line_data'] = summary(times)
+
+    _, times = timed(lambda: run_all.write_line_data(line_df, PARAM), repeat)
+    results['line_export'] = summary(times)
+
+    windows = window_stats.load_windows(window_stats.windows_path('../data/raw'))
+    _, times = timed(lambda: window_stats.window_stats(line_df, PARAM, windows),
+                     repeat)
+    results['window_stats'] = summary(times)
+
+    def export_csv():
+        with open('../data/wrangled/bench_interpolated.csv', 'w', newline='') as f:
+            run_all.export_interpolated_csv(f, PARAM, grid, mapped, values)
+    _, times = timed(export_csv, repeat)
+    results['interpolated_csv'] = summary(times)
+
+    job = {'param': PARAM,
+           'grid': grid,
+           'dates': mapped,
+           'indices': [run_all.date_int(d) for d in mapped],
+           'values': values,
+           'domain': (np.nanmin(values), np.nanmax(values))}
+    indices = job['indices'][:frames]
+
+    _, times = timed(lambda: topology.build_layers(force=True), repeat)
+    results['counties_layers'] = summary(times)
+
+    # Loading and rasterizing the full and the simplified county borders
+    def clear_borders():
+        for cached in (render.load_counties, render.projection,
+                       render.border_mask):
+            cached.cache_clear()
+    for name, path in [('borders_geojson', topology.COUNTIES),
+                       ('borders_topojson', render.COUNTIES)]:
+        _, times = timed(lambda: render.border_mask(path), repeat, clear_borders)
+        results[name] = summary(times)
+        with open(path, 'rb') as f:
+            results[name]['bytes'] = len(gzip.compress(f.read()))
+    clear_borders()
+
+    # First frame draws the per-process caches (borders, cell index)
+    run_all.plot_aq(job, indices[0])
+    rendered, times = timed(lambda: [run_all.plot_aq(job, i) for i in indices],
+                            repeat)
+    results['frame_render'] = summary(times, len(indices))
+
+    _, times = timed(lambda: [render.save_frame(frame, '../assets/bench.png')
+                              for frame in rendered],
+                     repeat)
+    results['frame_png'] = summary(times, len(indices))
+
+    def encode():
+        blocks = [gif_stream.encode_frame(rendered[0])]
+        for previous, frame in zip(rendered, rendered[1:]):
+            blocks.append(gif_stream.encode_frame(frame, previous))
+        return blocks
+    blocks, times = timed(encode, repeat)
+    results['gif_encode'] = summary(times, len(indices))
+
+    _, times = timed(lambda: gif_stream.write_gif(
+                         '../assets/bench.gif', iter(blocks),
+                         (render.CANVAS[1], render.CANVAS[0]),
+                         run_all.gif_duration, run_all.gif_loop),
+                     repeat)
+    results['gif_write'] = summary(times)
+
+    # Files the app stages read
+    sites.to_csv('../data/wrangled/sites_data.csv')
+    for param in ['NOX', 'BC', 'OZONE', 'NO2']:
+        run_all.write_line_data(line_df.rename(columns={PARAM: param}), param)
+    render.save_frame(rendered[0],
+                      '../assets/'+PARAM+'_'+str(run_all.mar1_offset)+'.png')
+    return results, grid, date_cols
+
+
+def bench_app(date_cols, repeat):
+    """
+    Returns {stage: timings} of the app.py callbacks and the line data,
+    county and frame stream routes on the data written by bench_pipeline, or an empty dict if
+    the app's dependencies aren't installed. Runs in the workspace.
+    """
+    sys.path.insert(0, ROOT)
+    try:
+        import app
+    except ImportError as e:
+        print('Skipping the app benchmarks: {}'.format(e))
+        return {}
+    # Call the callbacks themselves, not dash's wrappers
+    update_plot = getattr(app.update_plot, '__wrapped__', app.update_plot)
+    update_player = getattr(app.update_player, '__wrapped__', app.update_player)
+    start, end = date_cols[0], date_cols[-1]
+    results = {}
+
+    def cold():
+        app.chart_cache.clear()
+        app.data_api.payloads.clear()
+        app.line_store.clear()
+        app.stats_cache.clear()
+    windows = app.default_windows
+    html, times = timed(lambda: update_plot(PARAM, start, end, windows), repeat,
+                        cold)
+    results['update_plot_cold'] = summary(times)
+    results['update_plot_cold']['bytes'] = len(html)
+
+    _, times = timed(lambda: update_plot(PARAM, start, end, windows), repeat)
+    results['update_plot_warm'] = summary(times)
+
+    client = app.server.test_client()
+    url = app.data_api.line_url(PARAM, start, end)
+    headers = {'Accept-Encoding': 'gzip'}
+    response, times = timed(lambda: client.get(url, headers=headers), repeat,
+                            app.data_api.payloads.clear)
+    results['line_route_cold'] = summary(times)
+    results['line_route_cold']['bytes'] = len(response.data)
+
+    _, times = timed(lambda: client.get(url, headers=headers), repeat)
+    results['line_route_warm'] = summary(times)
+
+    url = app.data_api.counties_url()
+    response, times = timed(lambda: client.get(url, headers=headers), repeat,
+                            app.data_api.payloads.clear)
+    results['counties_route_cold'] = summary(times)
+    results['counties_route_cold']['bytes'] = len(response.data)
+
+    url = app.frame_api.frames_url(PARAM)
+    response, times = timed(lambda: client.get(url, headers=headers), repeat,
+                            app.frame_api.payloads.clear)
+    results['frames_route_cold'] = summary(times)
+    results['frames_route_cold']['bytes'] = len(response.data)
+
+    _, times = timed(lambda: update_player(PARAM), repeat)
+    results['update_player'] = summary(times)
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline stages and app callbacks on '
+                    'synthetic data')
+    parser.add_argument('--stations', type=int, nargs='+', default=[40],
+                        help='station counts (default 40)')
+    parser.add_argument('--pixel', type=float, nargs='+', default=[.05],
+                        help='grid resolutions in degrees (default .05)')
+    parser.add_argument('--days', type=int, nargs='+', default=[90],
+                        help='history lengths in days from '+synthetic.START
+                             +' (default 90)')
+    parser.add_argument('--frames', type=int, default=10,
+                        help='frames rendered and encoded per case (default 10)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed calls per stage (default 3)')
+    parser.add_argument('--no-app', action='store_true',
+                        help="skip the app's callbacks")
+    parser.add_argument('--output', help='file to write the JSON results to')
+    args = parser.parse_args(argv)
+
+    if min(args.days) <= run_all.mar1_offset:
+        parser.error('--days must be over {}'.format(run_all.mar1_offset))
+
+    cwd = os.getcwd()
+    report = {'commit': commit(),
+              'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': os.cpu_count(),
+              'frames': args.frames,
+              'repeat': args.repeat,
+              'cases': []}
+    try:
+        for n in args.stations:
+            sites = synthetic.stations(n)
+            for days in args.days:
+                for pixel in args.pixel:
+                    workspace = make_workspace()
+                    try:
+                        os.chdir(os.path.join(workspace, 'scripts'))
+                        stages, grid, date_cols = bench_pipeline(
+                            sites, days, pixel, args.frames, args.repeat)
+                        if not args.no_app:
+                            os.chdir(workspace)
+                            stages.update(bench_app(date_cols, args.repeat))
+                    finally:
+                        os.chdir(cwd)
+                        shutil.rmtree(workspace, ignore_errors=True)
+                    case = {'stations': n, 'days': days, 'pixel': pixel,
+                            'cells': grid.nrows*grid.ncols, 'stages': stages}
+                    report['cases'].append(case)
+                    print('{} stations, {} days, {} degree pixels ({} cells):'.format(
+                        n, days, pixel, case['cells']))
+                    for stage, timing in stages.items():
+                        print('    {:<20}{:>10.2f} ms'.format(stage,
+                                                              1e3*timing['best']))
+    finally:
+        os.chdir(cwd)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Synthetic station networks and observation histories for the
+benchmarks.
+
+Stations are scattered over the Bay Area counties' bounding box and
+report hourly values of a smooth regional field that drifts from day
+to day, plus station noise, with a share of hours missing as in the
+CARB reports. Everything is seeded, so a case generates the same data
+on every run.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Bounding box of data/raw/Bay_Area_Counties.geojson
+LONGITUDE = (-123.5, -121.2)
+LATITUDE = (36.9, 38.9)
+
+# First date of the histories, the first date run_all.py downloads
+START = '2020-02-01'
+
+
+def stations(n, seed=0):
+    """
+    Returns a df of n stations like the one run_all.load_sites returns
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'site': [str(10000 + i) for i in range(n)],
+                         'name': ['Station {}'.format(i) for i in range(n)],
+                         'latitude': rng.uniform(*LATITUDE, n),
+                         'longitude': rng.uniform(*LONGITUDE, n)})
+
+
+def observations(sites, days, param='PM25HR', hours=24, missing=.05, seed=0):
+    """
+    Returns a df of hourly observations at sites over days days from
+    START, with the columns of a CARB report
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(START, periods=days).strftime('%Y-%m-%d')
+    n = len(sites)
+    # Regional field: a gradient whose direction and level drift daily
+    angle = np.cumsum(rng.normal(0, .2, days))
+    level = 8 + np.cumsum(rng.normal(0, .5, days))
+    x = (sites['longitude'].values - LONGITUDE[0])/(LONGITUDE[1] - LONGITUDE[0])
+    y = (sites['latitude'].values - LATITUDE[0])/(LATITUDE[1] - LATITUDE[0])
+    daily = (level[:, None] + 4*(np.cos(angle)[:, None]*x[None]
+                                 + np.sin(angle)[:, None]*y[None]))
+    value = (np.repeat(daily[:, :, None], hours, axis=2)
+             + rng.normal(0, 1, (days, n, hours)))
+    keep = rng.uniform(size=value.shape) >= missing
+    day, station, hour = np.nonzero(keep)
+    return pd.DataFrame({'site': sites['site'].values[station],
+                         'date': dates.values[day],
+                         'start_hour': hour,
+                         'value': np.abs(value[keep]).round(3),
+                         'variable': param,
+                         'units': 'x',
+                         'quality': 0,
+                         'prelim': 'N',
+                         'name': sites['name'].values[station]})
+
+
+def report_csv(aq_data):
+    """
+    Returns aq_data as the text of a CARB csv report, footer included
+    """
+    return aq_data.to_csv(index=False)+'Quality Flag Definition\n'
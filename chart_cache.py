@@ -0,0 +1,67 @@
+"""
+Bounded LRU cache of rendered chart documents for app.py.
+
+Entries are keyed on a chart name plus the fingerprint (mtime, size)
+of the data files the chart was built from, so a chart is rebuilt
+as soon as run_all.py regenerates one of its source files.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+def file_fingerprint(paths):
+    """
+    Returns a hashable fingerprint of the given files made from
+    their path, modification time and size. Missing files
+    fingerprint as None so their later creation invalidates too.
+    """
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+
+class ChartCache:
+    """
+    Thread-safe LRU mapping of (name, fingerprint) to a chart
+    document (HTML string).
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, paths, build):
+        """
+        Returns the cached document for name if none of paths
+        changed since it was built, otherwise calls build() and
+        caches its result in place of the stale entry.
+        """
+        key = (name, file_fingerprint(paths))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        document = build()
+        with self._lock:
+            # Drop documents built from older versions of the data
+            for stale in [k for k in self._entries if k[0] == name]:
+                del self._entries[stale]
+            self._entries[key] = document
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return document
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
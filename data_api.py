@@ -0,0 +1,212 @@
+"""
+JSON data routes served from app.server.
+
+The charts reference their data by url instead of inlining it, so the
+browser can cache it. Every response carries a strong ETag of its body,
+Cache-Control and, when the client accepts it, gzip or brotli
+compression; a request whose If-None-Match matches gets a 304. Urls
+carry a version of the source files' fingerprint so a regenerated file
+is fetched anew.
+"""
+
+import gzip
+import hashlib
+import json
+from urllib.parse import urlencode
+
+import pandas as pd
+from flask import Response, abort, jsonify, request
+
+from chart_cache import ChartCache, file_fingerprint
+from datastore import window
+from downsample import downsample
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# How long browsers may reuse a response before revalidating it
+MAX_AGE = 300
+
+
+class QueryError(Exception):
+    """
+    A query with missing or invalid arguments
+    """
+
+
+def bad_query(error):
+    """
+    Returns the 400 response to a QueryError
+    """
+    response = jsonify(error=str(error))
+    response.status_code = 400
+    return response
+
+
+def date_arg(args, name):
+    """
+    Returns the date in args[name] as yyyy-mm-dd, or None if it is
+    left out
+    """
+    if not args.get(name):
+        return None
+    try:
+        return pd.Timestamp(str(args[name])).strftime('%Y-%m-%d')
+    except ValueError:
+        raise QueryError('{} must be a date'.format(name))
+
+
+def data_version(paths):
+    """
+    Returns a short hash of the fingerprint of paths
+    """
+    fingerprint = repr(file_fingerprint(paths)).encode()
+    return hashlib.sha1(fingerprint).hexdigest()[:12]
+
+
+class Payload:
+    """
+    A response body with its ETag and compressed variants, built once
+    per version of the data
+    """
+
+    def __init__(self, body, content_type='application/json'):
+        self.body = body
+        self.content_type = content_type
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.encoded = {'gzip': gzip.compress(body, compresslevel=6)}
+        if brotli is not None:
+            self.encoded['br'] = brotli.compress(body)
+
+    def response(self):
+        """
+        Returns the flask Response to the current request
+        """
+        headers = {'Cache-Control': 'public, max-age={}'.format(MAX_AGE),
+                   'Vary': 'Accept-Encoding',
+                   # Charts render in sandboxed iframes with a null origin
+                   'Access-Control-Allow-Origin': '*'}
+        if request.if_none_match.contains(self.etag):
+            response = Response(status=304, headers=headers)
+            response.set_etag(self.etag)
+            return response
+        body = self.body
+        accepted = request.accept_encodings
+        for encoding in ('br', 'gzip'):
+            if encoding in self.encoded and accepted[encoding]:
+                body = self.encoded[encoding]
+                headers['Content-Encoding'] = encoding
+                break
+        response = Response(body, content_type=self.content_type, headers=headers)
+        response.set_etag(self.etag)
+        return response
+
+
+def compact_json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def line_records(lc, param, start_date, end_date, points):
+    """
+    Returns the compact JSON records of the daily values of param per
+    station between start_date and end_date, downsampled to points
+    per station
+    """
+    lc = downsample(window(lc, start_date, end_date)[['name', 'date', param]],
+                    'date', param, 'name', points)
+    return compact_json([{'name': name, 'date': date, param: value}
+                         for name, date, value in zip(
+                             lc['name'].astype('str'),
+                             lc['date'].dt.strftime('%Y-%m-%d'),
+                             lc[param].round(8))])
+
+
+def sites_geojson(sites_path):
+    """
+    Returns the GeoJSON of the sensor locations in sites_path
+    """
+    sites = pd.read_csv(sites_path, usecols=['name', 'latitude', 'longitude'])
+    features = [{'type': 'Feature',
+                 'properties': {'name': name},
+                 'geometry': {'type': 'Point',
+                              'coordinates': [round(long, 6), round(lat, 6)]}}
+                for name, lat, long in zip(sites['name'], sites['latitude'],
+                                           sites['longitude'])]
+    return compact_json({'type': 'FeatureCollection', 'features': features})
+
+
+class DataAPI:
+    """
+    Registers the data routes on a flask server and builds the urls
+    the charts load their data from
+    """
+
+    def __init__(self, server, line_store, pollutants, counties_layers,
+                 sites_path, points):
+        self.line_store = line_store
+        self.pollutants = pollutants
+        # {level: path} of the simplified TopoJSON county layers
+        self.counties_layers = counties_layers
+        self.sites_path = sites_path
+        self.points = points
+        self.payloads = ChartCache(maxsize=8*len(pollutants))
+        server.add_url_rule('/data/line/<param>.json', 'line_data', self.line_data)
+        server.add_url_rule('/data/counties/<level>.topojson', 'counties_data',
+                            self.counties_data)
+        server.add_url_rule('/data/sites.geojson', 'sites_data', self.sites_data)
+        server.register_error_handler(QueryError, bad_query)
+
+    def line_url(self, param, start_date=None, end_date=None):
+        args = {k: v for k, v in [('start', start_date), ('end', end_date)] if v}
+        args['v'] = data_version([self.line_store.path(param)])
+        return '/data/line/{}.json?{}'.format(param, urlencode(args))
+
+    def counties_url(self, level='medium'):
+        return '/data/counties/{}.topojson?v={}'.format(
+            level, data_version([self.counties_layers[level]]))
+
+    def sites_url(self):
+        return '/data/sites.geojson?v='+data_version([self.sites_path])
+
+    def line_payload(self, param, start_date=None, end_date=None):
+        """
+        Returns the Payload of the line chart data of param between
+        start_date and end_date, built once per version of its file
+        """
+        def build():
+            return Payload(line_records(self.line_store.get(param), param,
+                                        start_date, end_date, self.points))
+        return self.payloads.get(('line', param, start_date, end_date),
+                                 [self.line_store.path(param)], build)
+
+    def counties_payload(self, level='medium'):
+        path = self.counties_layers[level]
+
+        def build():
+            with open(path, 'rb') as f:
+                return Payload(f.read())
+        return self.payloads.get(('counties', level), [path], build)
+
+    def sites_payload(self):
+        return self.payloads.get('sites', [self.sites_path],
+                                 lambda: Payload(sites_geojson(self.sites_path),
+                                                 'application/geo+json'))
+
+    def line_data(self, param):
+        if param not in self.pollutants:
+            abort(404)
+        start = date_arg(request.args, 'start')
+        end = date_arg(request.args, 'end')
+        if start and end and start > end:
+            raise QueryError('start {} is after end {}'.format(start, end))
+        return self.line_payload(param, start, end).response()
+
+    def counties_data(self, level):
+        if level not in self.counties_layers:
+            abort(404)
+        return self.counties_payload(level).response()
+
+    def sites_data(self):
+        return self.sites_payload().response()
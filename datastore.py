@@ -0,0 +1,125 @@
+"""
+Lazily loaded, typed line chart data for app.py.
+
+Each pollutant is read on first use from the columnar
+data/wrangled/<param>_line_plot.parquet written by run_all.py (falling
+back to the older csv), with a datetime date column and categorical
+station names. Loaded pollutants are kept within a memory budget and
+reloaded when their file changes.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from chart_cache import file_fingerprint
+
+# Memory budget for loaded line chart data, in MB
+BUDGET_MB = float(os.environ.get('AQ_DATA_BUDGET_MB', 64))
+
+
+def read_line_data(path):
+    """
+    Returns the line chart data in path (parquet or csv) with typed
+    columns
+    """
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    line_df = pd.read_csv(path, index_col=0,
+                          dtype={'name': 'category'},
+                          parse_dates=['date'])
+    return line_df.reset_index(drop=True)
+
+
+class LineStore:
+    """
+    Per-pollutant line chart data, loaded on first request and
+    evicted least recently used first once over budget_mb
+    """
+
+    def __init__(self, root='data/wrangled', budget_mb=BUDGET_MB):
+        self.root = root
+        self.budget = budget_mb*2**20
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, param):
+        """
+        Returns the file the data of param is read from
+        """
+        parquet = os.path.join(self.root, param+'_line_plot.parquet')
+        if os.path.exists(parquet):
+            return parquet
+        return os.path.join(self.root, param+'_line_plot.csv')
+
+    def get(self, param):
+        """
+        Returns the line chart df of param, loading it if it isn't
+        loaded yet or its file changed since it was
+        """
+        path = self.path(param)
+        fingerprint = file_fingerprint([path])
+        with self._lock:
+            entry = self._frames.get(param)
+            if entry is not None and entry[0] == fingerprint:
+                self._frames.move_to_end(param)
+                return entry[1]
+        line_df = read_line_data(path)
+        size = line_df.memory_usage(deep=True).sum()
+        with self._lock:
+            self._frames[param] = (fingerprint, line_df, size)
+            self._frames.move_to_end(param)
+            # Keep at least the frame just loaded
+            while (len(self._frames) > 1
+                   and sum(e[2] for e in self._frames.values()) > self.budget):
+                self._frames.popitem(last=False)
+        return line_df
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+    def loaded(self):
+        """
+        Returns the pollutants currently in memory
+        """
+        return list(self._frames)
+
+
+def window_means(stats, names, start_date=None, end_date=None):
+    """
+    Returns the means of the windows named in names, from the window
+    statistics stats, as two-point segments spanning each window,
+    clipped to the dates of the data and between start_date and
+    end_date, with the window's weekday and weekend means
+    """
+    if stats['first'] is None:
+        return pd.DataFrame(columns=['window', 'date', 'mean', 'weekday', 'weekend'])
+    lower = max(pd.Timestamp(stats['first']), pd.Timestamp(start_date or stats['first']))
+    upper = min(pd.Timestamp(stats['last']), pd.Timestamp(end_date or stats['last']))
+    segments = []
+    for w in stats['windows']:
+        if w['name'] not in names or w['mean'] is None:
+            continue
+        first = max(pd.Timestamp(w['start'] or lower), lower)
+        last = min(pd.Timestamp(w['end'] or upper), upper)
+        if first <= last:
+            segments += [(w['name'], date, w['mean'], w['weekday'], w['weekend'])
+                         for date in (first, last)]
+    return pd.DataFrame(segments, columns=['window', 'date', 'mean', 'weekday',
+                                           'weekend'])
+
+
+def window(lc, start_date=None, end_date=None):
+    """
+    Returns the rows of lc dated between start_date and end_date
+    (inclusive, either may be None)
+    """
+    keep = pd.Series(True, index=lc.index)
+    if start_date:
+        keep &= lc['date'] >= pd.Timestamp(start_date)
+    if end_date:
+        keep &= lc['date'] <= pd.Timestamp(end_date)
+    return lc[keep]
@@ -0,0 +1,68 @@
+"""
+Shape-preserving downsampling of the line chart series.
+
+Uses Largest-Triangle-Three-Buckets (Steinarsson, 2013): the series is
+split into equal buckets and from each bucket the point forming the
+largest triangle with the previously kept point and the next bucket's
+average is kept, so peaks and troughs survive.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def lttb(x, y, threshold):
+    """
+    Returns the indices of the points of (x, y) kept when reducing it
+    to threshold points. x must be sorted and numeric. Points where y
+    is NaN are kept only from buckets without values, so gaps in the
+    series stay gaps.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    valid = ~np.isnan(y)
+    # Bucket edges over the points between the fixed first and last
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = np.empty(threshold, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        # Average of the values of the next bucket (or the last point)
+        following = slice(stop, edges[i + 2]) if i + 2 < len(edges) else slice(0)
+        if valid[following].any():
+            next_x = x[following][valid[following]].mean()
+            next_y = y[following][valid[following]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        area = np.abs((x[a] - next_x)*(y[start:stop] - y[a])
+                      - (x[a] - x[start:stop])*(next_y - y[a]))
+        # Without an area, values still rank above gaps
+        missing = np.isnan(area)
+        area[missing] = np.where(valid[start:stop], -1, -2)[missing]
+        kept = start + int(np.argmax(area))
+        keep[i + 1] = kept
+        if valid[kept]:
+            a = kept
+    return keep
+
+
+def downsample(df, x, y, by, threshold):
+    """
+    Returns the rows of df kept when reducing the series of each
+    group of column by to at most threshold points with lttb. x may be
+    a datetime column.
+    """
+    parts = []
+    for _, group in df.groupby(by, observed=True, sort=False):
+        group = group.sort_values(x)
+        xs = group[x]
+        if pd.api.types.is_datetime64_any_dtype(xs):
+            xs = xs.astype('int64')
+        parts.append(group.iloc[lttb(xs.values, group[y].values, threshold)])
+    if not parts:
+        return df.iloc[:0]
+    return pd.concat(parts)
@@ -0,0 +1,264 @@
+"""
+Frame stream of the interpolated values, served from app.server, and
+the browser animation that plays it.
+
+    GET /data/frames/<param>.bin
+
+The stream holds every date's values of the grid cells with data,
+quantized to one byte over the pollutant's fixed color domain, so the
+browser downloads the numbers once and colors and animates the frames
+itself, instead of downloading a gif of pre-colored frames. Layout:
+
+- 'AQF1' and the little-endian uint32 length of the JSON header
+- the JSON header: param, grid (x0, y0, pixel, nrows, ncols), dates,
+  domain [min, max], number of cells with data
+- the uint8 mask of the grid cells with data, in row-major order
+- the uint8 (dates x cells with data) values, where q in 0-254 stands
+  for min + q/254*(max - min) and 255 for no data
+
+Like the other data routes it is sent with an ETag and compressed. A
+store without values has no domain to quantize over, and no stream.
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+from flask import abort
+
+from chart_cache import ChartCache
+from data_api import Payload, data_version
+from grid_store import GridStore
+from render import YELLOWORANGEBROWN
+
+MAGIC = b'AQF1'
+
+# Code of missing values
+MISSING = 255
+
+# Dates quantized at a time
+BLOCK = 256
+
+
+def quantize(values, domain):
+    """
+    Returns values as uint8 codes over domain, MISSING where NaN
+    """
+    values = np.asarray(values, dtype='float64')
+    span = (domain[1] - domain[0]) or 1
+    codes = np.round(np.clip((values - domain[0])/span, 0, 1)*(MISSING - 1))
+    codes[np.isnan(values)] = MISSING
+    return codes.astype('uint8')
+
+
+def frame_stream(store):
+    """
+    Returns the frame stream of a GridStore
+    """
+    domain = store.value_range()
+    header = json.dumps({'param': store.param,
+                         'grid': store.grid._asdict(),
+                         'dates': store.dates,
+                         'domain': domain,
+                         'cells': int(store.mask.sum())},
+                        separators=(',', ':')).encode()
+    parts = [MAGIC, struct.pack('<I', len(header)), header,
+             store.mask.astype('uint8').tobytes()]
+    for start in range(0, len(store.dates), BLOCK):
+        parts.append(quantize(store.values[start:start+BLOCK], domain).tobytes())
+    return b''.join(parts)
+
+
+class FrameAPI:
+    """
+    Registers the frame stream route on a flask server
+    """
+
+    def __init__(self, server, pollutants, root='data/wrangled'):
+        self.pollutants = pollutants
+        self.root = root
+        self.payloads = ChartCache(maxsize=len(pollutants))
+        server.add_url_rule('/data/frames/<param>.bin', 'frames_data',
+                            self.frames_data)
+
+    def manifest(self, param):
+        return os.path.join(self.root, param+'_grid', 'manifest.json')
+
+    def frames_url(self, param):
+        return '/data/frames/{}.bin?v={}'.format(
+            param, data_version([self.manifest(param)]))
+
+    def frames_payload(self, param):
+        """
+        Returns the Payload of the frame stream of param, built once
+        per version of its grid store, or None if there is none or it
+        has no values
+        """
+        def build():
+            if not os.path.exists(self.manifest(param)):
+                return None
+            store = GridStore(os.path.dirname(self.manifest(param)))
+            if not store.mask.any():
+                return None
+            return Payload(frame_stream(store), 'application/octet-stream')
+        return self.payloads.get(param, [self.manifest(param)], build)
+
+    def frames_data(self, param):
+        payload = self.frames_payload(param) if param in self.pollutants else None
+        if payload is None:
+            abort(404)
+        return payload.response()
+
+    def player_document(self, param, title, units, counties_url, duration=.4):
+        """
+        Returns the HTML of the animation of the frames of param, with
+        play/pause and a date slider, colored like the map frames and
+        drawn with the county borders of the TopoJSON layer at
+        counties_url
+        """
+        return PLAYER_TEMPLATE.format(title=json.dumps(title),
+                                      units=json.dumps(units),
+                                      url=json.dumps(self.frames_url(param)),
+                                      counties=json.dumps(counties_url),
+                                      scheme=json.dumps(YELLOWORANGEBROWN),
+                                      duration=int(duration*1000))
+
+
+PLAYER_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>
+  body {{ margin: 0; font-family: sans-serif; }}
+  #title {{ font-weight: bold; font-size: 18px; text-align: center; margin: 4px 0; }}
+  #frame {{ display: flex; align-items: flex-start; }}
+  #legend {{ margin-left: 8px; font-size: 12px; }}
+  #controls {{ display: flex; align-items: center; padding: 4px 0; }}
+  #date {{ flex: 1; margin-left: 8px; }}
+</style>
+</head>
+<body>
+<div id="title"></div>
+<div id="frame">
+  <canvas id="map"></canvas>
+  <div id="legend"><div id="units"></div><div id="max"></div>
+    <canvas id="ramp" width="15" height="200"></canvas><div id="min"></div></div>
+</div>
+<div id="controls">
+  <button id="play">&#9654;</button>
+  <input id="date" type="range" min="0" value="0" step="1">
+</div>
+<script>
+var title = {title}, units = {units}, scheme = {scheme}, duration = {duration};
+var WIDTH = 480, HEIGHT = 430, MISSING = 255;
+
+function rgb(hex) {{
+  return [1, 3, 5].map(function (i) {{ return parseInt(hex.substr(i, 2), 16); }});
+}}
+
+// Color of every code, as render.colorize() colors the map frames
+var stops = scheme.map(rgb), lut = new Uint8ClampedArray(256*4);
+for (var q = 0; q < 256; q++) {{
+  var color = [255, 255, 255];
+  if (q != MISSING) {{
+    var t = q/(MISSING - 1)*(stops.length - 1), i = Math.min(Math.floor(t), stops.length - 2);
+    color = [0, 1, 2].map(function (c) {{
+      return Math.round(stops[i][c] + (stops[i + 1][c] - stops[i][c])*(t - i));
+    }});
+  }}
+  lut.set(color.concat([255]), q*4);
+}}
+
+fetch({url}).then(function (r) {{ return r.arrayBuffer(); }}).then(function (buffer) {{
+  var length = new DataView(buffer).getUint32(4, true);
+  var header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, length)));
+  var grid = header.grid, ncells = grid.nrows*grid.ncols;
+  var mask = new Uint8Array(buffer, 8 + length, ncells);
+  var values = new Uint8Array(buffer, 8 + length + ncells, header.dates.length*header.cells);
+  var index = [];
+  for (var k = 0; k < ncells; k++) if (mask[k]) index.push(k);
+
+  // Cells are square in degrees; stretch rows as mercator does
+  var north = grid.y0 + (grid.nrows - 0.5)*grid.pixel, west = grid.x0 - grid.pixel/2;
+  var stretch = 1/Math.cos((north - grid.nrows*grid.pixel/2)*Math.PI/180);
+  var cw = Math.min(WIDTH/grid.ncols, HEIGHT/(grid.nrows*stretch)), ch = cw*stretch;
+  var map = document.getElementById('map');
+  map.width = Math.round(cw*grid.ncols);
+  map.height = Math.round(ch*grid.nrows);
+  var ctx = map.getContext('2d');
+  ctx.imageSmoothingEnabled = false;
+  var cells = document.createElement('canvas');
+  cells.width = grid.ncols;
+  cells.height = grid.nrows;
+  var cellCtx = cells.getContext('2d'), image = cellCtx.createImageData(grid.ncols, grid.nrows);
+  var borders = [];
+
+  function draw(d) {{
+    var pixels = image.data, frame = values.subarray(d*header.cells, (d + 1)*header.cells);
+    for (var k = 0; k < ncells; k++) pixels.set(lut.subarray(MISSING*4, MISSING*4 + 4), k*4);
+    for (var j = 0; j < index.length; j++) {{
+      pixels.set(lut.subarray(frame[j]*4, frame[j]*4 + 4), index[j]*4);
+    }}
+    cellCtx.putImageData(image, 0, 0);
+    ctx.drawImage(cells, 0, 0, map.width, map.height);
+    ctx.strokeStyle = 'black';
+    ctx.lineWidth = 1;
+    borders.forEach(function (line) {{
+      ctx.beginPath();
+      line.forEach(function (p, i) {{
+        var x = (p[0] - west)/grid.pixel*cw, y = (north - p[1])/grid.pixel*ch;
+        if (i) ctx.lineTo(x, y); else ctx.moveTo(x, y);
+      }});
+      ctx.stroke();
+    }});
+    document.getElementById('title').textContent = title + ': ' + header.dates[d];
+  }}
+
+  var slider = document.getElementById('date'), button = document.getElementById('play');
+  var timer = null;
+  slider.max = header.dates.length - 1;
+  slider.addEventListener('input', function () {{ draw(+slider.value); }});
+  button.addEventListener('click', function () {{
+    if (timer) {{
+      clearInterval(timer);
+      timer = null;
+      button.innerHTML = '&#9654;';
+      return;
+    }}
+    button.innerHTML = '&#10074;&#10074;';
+    timer = setInterval(function () {{
+      slider.value = (+slider.value + 1) % header.dates.length;
+      draw(+slider.value);
+    }}, duration);
+  }});
+
+  var ramp = document.getElementById('ramp').getContext('2d');
+  for (var y = 0; y < 200; y++) {{
+    var q = Math.round((1 - y/199)*(MISSING - 1));
+    ramp.fillStyle = 'rgb(' + lut[q*4] + ',' + lut[q*4 + 1] + ',' + lut[q*4 + 2] + ')';
+    ramp.fillRect(0, y, 15, 1);
+  }}
+  document.getElementById('units').textContent = units;
+  document.getElementById('max').textContent = header.domain[1].toPrecision(3);
+  document.getElementById('min').textContent = header.domain[0].toPrecision(3);
+  draw(0);
+
+  fetch({counties}).then(function (r) {{ return r.json(); }}).then(function (topology) {{
+    // Each border once, from the arcs of the TopoJSON layer
+    var scale = topology.transform.scale, translate = topology.transform.translate;
+    topology.arcs.forEach(function (arc) {{
+      var x = 0, y = 0;
+      borders.push(arc.map(function (d) {{
+        x += d[0];
+        y += d[1];
+        return [x*scale[0] + translate[0], y*scale[1] + translate[1]];
+      }}));
+    }});
+    draw(+slider.value);
+  }});
+}});
+</script>
+</body>
+</html>
+'''
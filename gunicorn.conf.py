@@ -0,0 +1,57 @@
+"""
+gunicorn settings for serving app.py (see Procfile).
+
+The app is imported once in the master process (preload_app) and its
+data loaded there (app.preload()) before the workers are forked, so the
+workers share the imported modules, data frames, chart documents and
+payloads copy-on-write instead of each building their own, and adding
+a worker costs little memory. gc.freeze() moves everything loaded so
+far out of the garbage collector's reach, so collections in the
+workers don't write to, and so copy, the shared pages.
+
+After run_all.py has refreshed the data, a HUP to the master (which
+`run_all.py --reload <pidfile>` sends when it finishes) reloads the
+data in the master with on_reload() and gracefully replaces the
+workers with ones forked from it, so the fresh data is shared again.
+The master's pid is written to AQ_PIDFILE when it is set. Every cache
+and store of the app is keyed on the fingerprint (mtime and size) of
+its files, so until the workers are replaced they swap in replaced
+files on their own, each in its own memory.
+
+With AQ_METRICS set, the master clears the workers' metric counts of
+earlier runs when it starts and merges a worker's counts into those of
+exited workers when it exits (see metrics.py), so /metrics totals stay
+monotonic across worker restarts.
+"""
+
+import gc
+import os
+
+preload_app = True
+pidfile = os.environ.get('AQ_PIDFILE')
+
+
+def when_ready(server):
+    import app
+    app.metrics.reset()
+    app.preload()
+    gc.freeze()
+
+
+def on_reload(server):
+    import app
+    gc.unfreeze()
+    app.preload()
+    gc.freeze()
+    server.log.info('Reloaded the app data')
+
+
+def child_exit(server, worker):
+    import app
+    app.metrics.process_exited(worker.pid)
+
+
+def worker_exit(server, worker):
+    import app
+    app.metrics.flush(force=True)
+
@@ -0,0 +1,282 @@
+"""
+Latency and payload size metrics for app.py, in Prometheus format.
+
+Enabled by setting AQ_METRICS=1. Callbacks decorated with
+Metrics.callback() record how long they take and how large their
+output is, requests to the data routes record the same per endpoint,
+and /metrics serves the histograms in the Prometheus text format.
+When disabled the decorator returns the callback unchanged and no
+route or request hook is added, so there is no overhead.
+
+gunicorn hands each scrape to an arbitrary worker, so every process
+writes its counts to its own file in a shared folder (AQ_METRICS_DIR,
+or a temporary folder made when the app is imported in the gunicorn
+master) at most every FLUSH_SECONDS, and /metrics serves the sum of
+all the files. When a worker exits, gunicorn.conf.py has the master
+merge its file into the counts of exited workers, so totals never go
+backwards and the folder doesn't grow with worker restarts.
+"""
+
+import bisect
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import Response, g, request
+
+ENABLED = os.environ.get('AQ_METRICS', '').lower() in ('1', 'true', 'yes')
+
+# Histogram bucket upper bounds
+SECONDS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+BYTES = (2**10, 2**12, 2**14, 2**16, 2**18, 2**20, 2**22, 2**24)
+
+# Most seconds between writes of a process's counts to its file
+FLUSH_SECONDS = 1
+
+# File of the merged counts of exited processes
+EXITED = 'exited.json'
+
+
+class Histogram:
+    """
+    Thread-safe Prometheus histogram with one series per label value
+    """
+
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [[0]*(len(self.buckets) + 1), 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def snapshot(self):
+        """
+        Returns {label: [bucket counts, sum]} of the observations
+        """
+        with self._lock:
+            return {k: [[*v[0]], v[1]] for k, v in self._series.items()}
+
+    def exposition(self, series):
+        """
+        Returns the lines of the histogram of series, as returned by
+        snapshot(), in the Prometheus text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        for label, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(
+                    self.name, self.label, label, bound, cumulative))
+            lines.append('{}_sum{{{}="{}"}} {}'.format(self.name, self.label,
+                                                        label, total))
+            lines.append('{}_count{{{}="{}"}} {}'.format(self.name, self.label,
+                                                          label, cumulative))
+        return lines
+
+
+def add_series(into, series):
+    """
+    Adds the {histogram: {label: [bucket counts, sum]}} counts of
+    series to into
+    """
+    for name, labels in series.items():
+        for label, (counts, total) in labels.items():
+            current = into.setdefault(name, {}).setdefault(
+                label, [[0]*len(counts), 0])
+            current[0] = [a + b for a, b in zip(current[0], counts)]
+            current[1] += total
+    return into
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    with open(path+'.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path+'.tmp', path)
+
+
+def payload_size(output):
+    """
+    Returns the size in bytes of a callback's output as sent to the
+    browser
+    """
+    if isinstance(output, str):
+        return len(output.encode())
+    if hasattr(output, 'to_plotly_json'):
+        from plotly.utils import PlotlyJSONEncoder
+        return len(json.dumps(output, cls=PlotlyJSONEncoder).encode())
+    return len(json.dumps(output, default=str).encode())
+
+
+class Metrics:
+    """
+    The app's metrics, served on /metrics of server when enabled
+    """
+
+    def __init__(self, server, enabled=ENABLED, endpoints=(), directory=None):
+        self.enabled = enabled
+        self.endpoints = set(endpoints)
+        self.callback_seconds = Histogram(
+            'aq_callback_seconds', 'Dash callback latency in seconds',
+            'callback', SECONDS)
+        self.callback_bytes = Histogram(
+            'aq_callback_payload_bytes', 'Size of Dash callback outputs in bytes',
+            'callback', BYTES)
+        self.request_seconds = Histogram(
+            'aq_request_seconds', 'Data route latency in seconds',
+            'endpoint', SECONDS)
+        self.response_bytes = Histogram(
+            'aq_response_bytes', 'Size of data route response bodies in bytes',
+            'endpoint', BYTES)
+        self.histograms = (self.callback_seconds, self.callback_bytes,
+                           self.request_seconds, self.response_bytes)
+        self.directory = None
+        self._pid = None
+        self._flushed = 0
+        self._flush_lock = threading.Lock()
+        if enabled:
+            self.directory = (directory or os.environ.get('AQ_METRICS_DIR')
+                              or tempfile.mkdtemp(prefix='aq-metrics-'))
+            os.makedirs(self.directory, exist_ok=True)
+            server.add_url_rule('/metrics', 'metrics', self.serve)
+            server.before_request(self._start)
+            server.after_request(self._finish)
+
+    def callback(self, name):
+        """
+        Returns a decorator recording the latency and output size of a
+        callback as name
+        """
+        def decorator(fn):
+            if not self.enabled:
+                return fn
+
+            @functools.wraps(fn)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                output = fn(*args, **kwargs)
+                self.callback_seconds.observe(name, time.perf_counter() - start)
+                self.callback_bytes.observe(name, payload_size(output))
+                self.flush()
+                return output
+            return timed
+        return decorator
+
+    def _start(self):
+        g.metrics_start = time.perf_counter()
+
+    def _finish(self, response):
+        if request.endpoint in self.endpoints and 'metrics_start' in g:
+            self.request_seconds.observe(request.endpoint,
+                                         time.perf_counter() - g.metrics_start)
+            if not response.direct_passthrough:
+                self.response_bytes.observe(request.endpoint,
+                                            response.calculate_content_length() or 0)
+            self.flush()
+        return response
+
+    def _path(self):
+        """
+        Returns the file of the counts of this process, named by its
+        pid and a token so a reused pid gets a new file. Counts made
+        before a fork (there are none when the app is preloaded) are
+        left to the parent.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._pid is not None:
+                for histogram in self.histograms:
+                    histogram._series.clear()
+            self._pid = pid
+            self._name = '{}-{}.json'.format(pid, uuid.uuid4().hex[:8])
+        return os.path.join(self.directory, self._name)
+
+    def flush(self, force=False):
+        """
+        Writes the counts of this process to its file, unless they
+        were written less than FLUSH_SECONDS ago
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed < FLUSH_SECONDS:
+            return
+        with self._flush_lock:
+            self._flushed = now
+            _write(self._path(), {h.name: h.snapshot() for h in self.histograms})
+
+    def process_exited(self, pid):
+        """
+        Merges the counts of the exited process pid into the counts of
+        exited processes and removes its file. Called by the gunicorn
+        master when a worker exits.
+        """
+        if not self.enabled:
+            return
+        exited = os.path.join(self.directory, EXITED)
+        merged = _read(exited) or {'series': {}, 'merged': []}
+        names = [n for n in os.listdir(self.directory)
+                 if n.startswith('{}-'.format(pid)) and n.endswith('.json')
+                 and n not in merged['merged']]
+        for name in names:
+            add_series(merged['series'],
+                       _read(os.path.join(self.directory, name)) or {})
+        # Readers skip the files merged, until they are removed
+        merged['merged'] = [n for n in merged['merged']
+                            if os.path.exists(os.path.join(self.directory, n))] + names
+        _write(exited, merged)
+        for name in names:
+            os.remove(os.path.join(self.directory, name))
+
+    def reset(self):
+        """
+        Removes the counts of earlier runs, when the gunicorn master
+        starts
+        """
+        if self.enabled:
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+
+    def collect(self):
+        """
+        Returns the summed counts of every process, exited ones included
+        """
+        self.flush(force=True)
+        exited = _read(os.path.join(self.directory, EXITED)) or {'series': {},
+                                                                 'merged': []}
+        totals = add_series({}, exited['series'])
+        skip = set(exited['merged']) | {EXITED}
+        for name in os.listdir(self.directory):
+            if name.endswith('.json') and name not in skip:
+                add_series(totals, _read(os.path.join(self.directory, name)) or {})
+        return totals
+
+    def serve(self):
+        totals = self.collect()
+        lines = []
+        for histogram in self.histograms:
+            lines += histogram.exposition(totals.get(histogram.name, {}))
+        return Response('\n'.join(lines)+'\n',
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
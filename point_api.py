@@ -0,0 +1,162 @@
+"""
+Point queries of the interpolated values, served from app.server.
+
+    GET  /data/point/<param>.json?lat=37.77&long=-122.42&date=2020-04-03
+    GET  /data/point/<param>.json?lat=37.77&long=-122.42&start=2020-04-01&end=2020-04-07
+    POST /data/points/<param>.json  {"points": [[lat, long], ...],
+                                     "date": ... | "start": ..., "end": ...}
+
+Points are looked up in the grid store run_all.py writes: the nearest
+grid point is found arithmetically from the grid definition and its
+column read straight from the memory-mapped values matrix, so a query
+costs the same whatever the size of the grid, and a batch of points
+is one vectorized lookup. Values are those drawn on the maps; cells
+without data get null. A single point off the grid is not found (404);
+a batch gets null for its points off the grid, and is refused (400)
+past MAX_POINTS points or if its body isn't the JSON object above.
+"""
+
+import bisect
+import os
+
+import numpy as np
+from flask import abort, request
+
+from chart_cache import file_fingerprint
+from data_api import Payload, QueryError, bad_query, compact_json
+from grid_store import GridStore
+
+# Most points accepted in one batch query
+MAX_POINTS = 10000
+
+
+class PointAPI:
+    """
+    Registers the point query routes on a flask server
+    """
+
+    def __init__(self, server, pollutants, root='data/wrangled'):
+        self.pollutants = pollutants
+        self.root = root
+        self._stores = {}
+        server.add_url_rule('/data/point/<param>.json', 'point_data',
+                            self.point_data)
+        server.add_url_rule('/data/points/<param>.json', 'points_data',
+                            self.points_data, methods=['POST'])
+        server.register_error_handler(QueryError, bad_query)
+
+    def open_store(self, param):
+        """
+        Returns the GridStore of param, reopened when run_all.py
+        replaces it, or None if there is none
+        """
+        path = os.path.join(self.root, param+'_grid')
+        fingerprint = file_fingerprint([os.path.join(path, 'manifest.json')])
+        entry = self._stores.get(param)
+        if entry is None or entry[0] != fingerprint:
+            if fingerprint[0][1] is None:
+                return None
+            entry = self._stores[param] = (fingerprint, GridStore(path))
+        return entry[1]
+
+    def store(self, param):
+        store = self.open_store(param) if param in self.pollutants else None
+        if store is None:
+            abort(404)
+        return store
+
+    def point_data(self, param):
+        store = self.store(param)
+        lat = _number(request.args, 'lat')
+        long = _number(request.args, 'long')
+        rows = _date_rows(store, request.args)
+        cell = store.grid.cell_index(long, lat)
+        if cell < 0:
+            abort(404)
+        column = store.column[cell]
+        result = {'pollutant': param, 'lat': lat, 'long': long}
+        if isinstance(rows, slice):
+            result['dates'] = store.dates[rows]
+            result['values'] = _values(store, rows, column).tolist()
+        else:
+            result['date'] = store.dates[rows]
+            result['value'] = _values(store, rows, column).tolist()
+        return Payload(compact_json(result)).response()
+
+    def points_data(self, param):
+        store = self.store(param)
+        query = request.get_json(silent=True)
+        if not isinstance(query, dict) or not query.get('points'):
+            raise QueryError('expected a JSON object with a list of points')
+        try:
+            points = np.asarray(query['points'], dtype='float64')
+        except (TypeError, ValueError):
+            raise QueryError('points must be [lat, long] pairs')
+        if points.ndim != 2 or points.shape[1] != 2:
+            raise QueryError('points must be [lat, long] pairs')
+        if len(points) > MAX_POINTS:
+            raise QueryError('at most {} points per query'.format(MAX_POINTS))
+        rows = _date_rows(store, query)
+        columns = _columns(store, points[:, 1], points[:, 0])
+        # (points x dates) for a range, one value per point otherwise
+        values = _values(store, rows, columns)
+        result = {'pollutant': param}
+        if isinstance(rows, slice):
+            result['dates'] = store.dates[rows]
+            values = values.T
+        else:
+            result['date'] = store.dates[rows]
+        result['values'] = values.tolist()
+        return Payload(compact_json(result)).response()
+
+
+def _number(args, name):
+    try:
+        return float(args[name])
+    except (KeyError, TypeError, ValueError):
+        raise QueryError('{} must be a number'.format(name))
+
+
+def _date_rows(store, args):
+    """
+    Returns the row of values of the date in args, or a slice of the
+    rows from its start to end dates (inclusive, either may be left
+    out)
+    """
+    if args.get('date'):
+        try:
+            return store.date_index(str(args['date']))
+        except KeyError:
+            raise QueryError('no values on {}'.format(args['date']))
+    if not (args.get('start') or args.get('end')):
+        raise QueryError('pass a date, or a start and/or end date')
+    start = bisect.bisect_left(store.dates, str(args.get('start') or ''))
+    end = (bisect.bisect_right(store.dates, str(args['end']))
+           if args.get('end') else len(store.dates))
+    if start >= end:
+        raise QueryError('no values between {} and {}'.format(
+            args.get('start'), args.get('end')))
+    return slice(start, end)
+
+
+def _columns(store, longitude, latitude):
+    """
+    Returns the column of values of the grid cell nearest to each
+    point, or -1 for points off the grid or on cells without data
+    """
+    cells = store.grid.cell_index(longitude, latitude)
+    return np.where(cells >= 0, store.column[cells], -1)
+
+
+def _values(store, rows, columns):
+    """
+    Returns the values of rows at columns as a float or object array,
+    with None in place of missing values
+    """
+    columns = np.asarray(columns)
+    values = np.asarray(store.values[rows, np.maximum(columns, 0)],
+                        dtype='float64')
+    missing = np.isnan(values) | (columns < 0)
+    values = np.array(values.round(6), dtype=object)
+    values[missing] = None
+    return values
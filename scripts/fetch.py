@@ -0,0 +1,292 @@
+"""
+Incremental download of hourly CARB observations into a local store.
+
+Raw observations are kept in one Parquet file per pollutant per month
+(../data/raw/store/<param>/<yyyy-mm>.parquet). Each run only requests
+the dates after the last stored one, plus a revision window so values
+CARB screens or corrects after the fact are picked up, and reports
+which dates actually changed so later stages can redo only those.
+
+All pollutants are downloaded concurrently over one pooled session.
+Each request has a timeout and is retried a bounded number of times
+with exponential backoff, and every response is checked (size, header,
+row count and dates) before it is stored, so a failed or truncated
+download fails its pollutant instead of being stored.
+"""
+
+import glob
+import io
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from run_report import stage
+
+STORE = '../data/raw/store'
+BASE_URL = 'https://www.arb.ca.gov/aqmis2/display.php'
+
+# Connect and read timeouts of each request, in seconds
+TIMEOUT = (10, 300)
+# Attempts after the first, and seconds to wait before the first
+# retry (doubled for each further one)
+RETRIES = 3
+BACKOFF = 2
+# Largest response accepted, in bytes
+MAX_BYTES = 256*2**20
+# Columns every report must have
+COLUMNS = ['site', 'date', 'start_hour', 'value']
+
+# CARB report parameters per pollutant
+units = {'OZONE': '007', 'BC': '001', 'NOX': '007', 'PM25HR': '001', 'NO2':'007'}
+rows = {'OZONE': '20', 'BC': '6', 'NOX': '18', 'PM25HR': '17', 'NO2': '18'}
+basin = 'SFB-San+Francisco+Bay'
+
+
+def carb_url(param, start, end, base_url=BASE_URL):
+    """
+    Returns the url of the PICKDATA csv report for param covering the
+    dates start to end (datetime.date)
+    """
+    fname = param+'_'+str(end.year)+'-'+str(end.month)+'-'+str(end.day)
+    first_date = '{}-{}-{}'.format(start.year, start.month, start.day) # yyyy-m-d
+    return base_url+'?sitelist=All&\
+filefmt=csv&fname='+fname+'&datafmt=web&download=y&\
+first_date='+first_date+'&param='+param+'&\
+units='+units[param]+'&year='+str(end.year)+'&report=PICKDATA\
+&mon='+str(end.month)+'&day='+str(end.day)+'&o3area=&o3pa8=&\
+county_name=--COUNTY--&latitude=--PART+OF+STATE--&\
+basin='+basin+'&order=basin%2Ccounty_name%2Cs.name&\
+ptype=aqd&o3switch=new&hours=all&\
+statistic=&qselect=Screened&start_mon='+str(start.month)+'&\
+start_day='+str(start.day)+'&submit=All+Sites&\
+rows='+rows[param]
+
+
+class DownloadError(Exception):
+    """
+    A CARB report that couldn't be downloaded or failed validation
+    """
+
+
+def make_session(pool_size=8):
+    """
+    Returns a requests session keeping up to pool_size connections
+    open for reuse
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def read_body(r, max_bytes=MAX_BYTES):
+    """
+    Returns the body of the streamed response r, checking it is
+    complete and not larger than max_bytes
+    """
+    chunks = []
+    size = 0
+    for chunk in r.iter_content(2**16):
+        size += len(chunk)
+        if size > max_bytes:
+            raise DownloadError('response larger than {} bytes'.format(max_bytes))
+        chunks.append(chunk)
+    expected = r.headers.get('Content-Length')
+    if expected is not None and 'Content-Encoding' not in r.headers \
+            and int(expected) != size:
+        raise DownloadError('truncated response, got {} of {} bytes'.format(
+            size, expected))
+    return b''.join(chunks)
+
+
+def validate(aq_data, start, end):
+    """
+    Raises DownloadError unless the observations in aq_data are all
+    dated between start and end. A report without observations is
+    valid: there is nothing new.
+    """
+    if aq_data.empty:
+        return
+    dates = aq_data['date']
+    if dates.min() < start.isoformat() or dates.max() > end.isoformat():
+        raise DownloadError('report has dates {} to {} outside {} to {}'.format(
+            dates.min(), dates.max(), start, end))
+
+
+def download(param, start, end, base_url=BASE_URL, session=None,
+             timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+    """
+    Returns a df of the hourly observations of param from start to end
+    from the CA air resources board (https://www.arb.ca.gov), retrying
+    failed or invalid responses up to retries times
+    """
+    session = session or requests
+    url = carb_url(param, start, end, base_url)
+    for attempt in range(retries + 1):
+        try:
+            with session.post(url, timeout=timeout, stream=True) as r:
+                if not r.ok:
+                    raise DownloadError('HTTP {} {}'.format(r.status_code,
+                                                            r.reason))
+                body = read_body(r)
+            aq_data = parse(body.decode('utf8'))
+            validate(aq_data, start, end)
+            return aq_data
+        except (requests.RequestException, DownloadError, ValueError) as e:
+            if attempt == retries:
+                raise DownloadError('{} failed after {} attempts: {}'.format(
+                    param, attempt + 1, e)) from e
+            wait = backoff*2**attempt
+            print('    Download of {} failed ({}), retrying in {}s'.format(
+                param, e, wait))
+            time.sleep(wait)
+
+
+def parse(data):
+    """
+    Returns the observations in a CARB csv report, dropping the
+    footer lines that aren't observations
+    """
+    aq_data = pd.read_csv(io.StringIO(data), dtype={'site': 'str',
+                                                    'date': 'str'})
+    missing = [c for c in COLUMNS if c not in aq_data.columns]
+    if missing:
+        raise DownloadError('report is missing columns '+', '.join(missing))
+    return aq_data.dropna(subset=['site', 'date']).reset_index(drop=True)
+
+
+class RawStore:
+    """
+    Month-partitioned Parquet store of raw hourly observations
+    """
+
+    def __init__(self, root=STORE):
+        self.root = root
+
+    def partitions(self, param):
+        """
+        Returns the sorted partition files of param
+        """
+        return sorted(glob.glob(os.path.join(self.root, param, '*.parquet')))
+
+    def partition_path(self, param, month):
+        return os.path.join(self.root, param, month+'.parquet')
+
+    def last_date(self, param):
+        """
+        Returns the last stored date of param, or None if the store
+        is empty
+        """
+        for path in reversed(self.partitions(param)):
+            dates = pd.read_parquet(path, columns=['date'])['date'].dropna()
+            if not dates.empty:
+                return date.fromisoformat(dates.max())
+        return None
+
+    def read(self, param):
+        """
+        Returns a df of all stored observations of param
+        """
+        partitions = self.partitions(param)
+        if not partitions:
+            return pd.DataFrame()
+        return pd.concat([pd.read_parquet(p) for p in partitions],
+                         ignore_index=True)
+
+    def update(self, param, aq_data, since):
+        """
+        Replaces the stored observations of param from since onwards
+        with aq_data and returns the set of dates whose observations
+        were added or changed
+        """
+        since = since.isoformat()
+        aq_data = aq_data[aq_data['date'] >= since]
+        months = set(aq_data['date'].str[:7])
+        months.update(os.path.basename(p)[:7] for p in self.partitions(param)
+                      if os.path.basename(p)[:7] >= since[:7])
+        affected = set()
+        for month in sorted(months):
+            path = self.partition_path(param, month)
+            old = pd.read_parquet(path) if os.path.exists(path) else aq_data[:0]
+            new = pd.concat([old[old['date'] < since],
+                             aq_data[aq_data['date'].str[:7] == month]],
+                            ignore_index=True)
+            old_digests = _date_digests(old)
+            new_digests = _date_digests(new)
+            changed = {d for d in set(old_digests) | set(new_digests)
+                       if old_digests.get(d) != new_digests.get(d)}
+            if not changed:
+                continue
+            affected |= changed
+            if new.empty:
+                # Every date of the month was withdrawn
+                os.remove(path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            new.to_parquet(path+'.tmp', index=False)
+            os.replace(path+'.tmp', path)
+        return affected
+
+
+def _date_digests(aq_data):
+    """
+    Returns {date: hash} of the observations of each date, independent
+    of row order
+    """
+    if aq_data.empty:
+        return {}
+    hashes = pd.util.hash_pandas_object(aq_data.astype('str'), index=False)
+    return hashes.groupby(aq_data['date'].values).sum().to_dict()
+
+
+def fetch(param, first, store, today=None, revision_days=7, base_url=BASE_URL,
+          **kwargs):
+    """
+    Downloads the observations of param not yet in store (from first
+    if it is empty), re-requesting the last revision_days stored days.
+    Returns the set of dates that were added or changed, empty if the
+    report has no observations. kwargs are passed on to download.
+    """
+    today = today or date.today()
+    last = store.last_date(param)
+    if last is None:
+        start = first
+    else:
+        start = max(first, last - timedelta(days=revision_days))
+    with stage('download', param, days=(today - start).days + 1):
+        aq_data = download(param, start, today, base_url, **kwargs)
+    if aq_data.empty:
+        return set()
+    with stage('store_update', param, rows=len(aq_data)):
+        return store.update(param, aq_data, start)
+
+
+def fetch_all(params, first, store, **kwargs):
+    """
+    Fetches every pollutant in params concurrently over one pooled
+    session. Returns a dict of the pollutants fetched to their changed
+    dates, and a dict of the ones that failed to their error.
+    """
+    updates = {}
+    failures = {}
+    with make_session(len(params)) as session, \
+            ThreadPoolExecutor(max_workers=len(params)) as pool:
+        futures = {param: pool.submit(fetch, param, first, store,
+                                      session=session, **kwargs)
+                   for param in params}
+        for param, future in futures.items():
+            try:
+                updates[param] = future.result()
+            except DownloadError as e:
+                failures[param] = str(e)
+            except Exception:
+                failures[param] = traceback.format_exc()
+    return updates, failures
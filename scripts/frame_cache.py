@@ -0,0 +1,122 @@
+"""
+Content-addressed cache of the rendered map frames.
+
+Each pollutant's image folder holds a frames.json manifest recording,
+for every frame file, the key it was rendered from: a hash of the
+frame's values, the color domain and its style (title, annotation and
+render settings). A frame is redrawn only when its key changes or its
+file is missing, so frames of revised observations are redrawn and a
+shifted color domain redraws every frame. The manifest also records
+which frame each frame's encoded gif block is a delta against, and the
+keys of the frames in the gif, so the gif is only rebuilt when they
+change and only extended when frames were just added.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def frame_key(values, domain, style):
+    """
+    Returns the cache key of a frame drawn from values over domain
+    with style, a json serializable dict
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(values, dtype='float64').tobytes())
+    h.update(json.dumps([[float(d) for d in domain], style],
+                        sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def sequence_key(keys, style=None):
+    """
+    Returns the cache key of an animation of the frames with keys, in
+    order
+    """
+    return hashlib.sha1(json.dumps([list(keys), style],
+                                   sort_keys=True).encode()).hexdigest()
+
+
+class FrameCache:
+    """
+    Manifest of the keys of the frames in a folder, read from and
+    written to <folder>/frames.json
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, 'frames.json')
+        try:
+            with open(self.path) as f:
+                self.manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.manifest = {}
+        self.manifest.setdefault('frames', {})
+        self.manifest.setdefault('gif', None)
+        self.manifest.setdefault('gif_frames', [])
+        self.manifest.setdefault('blocks', {})
+
+    def stale(self, keys):
+        """
+        Returns the files of keys, a dict of frame files to keys, whose
+        key changed or that don't exist
+        """
+        frames = self.manifest['frames']
+        return [filename for filename, key in keys.items()
+                if frames.get(os.path.basename(filename)) != key
+                or not os.path.exists(filename)]
+
+    def record(self, keys, bases):
+        """
+        Records the keys of freshly rendered frame files and, in bases,
+        the key of the frame each one's gif block is a delta against
+        (None for full frames)
+        """
+        for filename, key in keys.items():
+            self.manifest['frames'][os.path.basename(filename)] = key
+        self.record_blocks(bases)
+
+    def record_blocks(self, bases):
+        for filename, base in bases.items():
+            self.manifest['blocks'][os.path.basename(filename)] = base
+
+    def block_valid(self, filename, base):
+        """
+        Returns whether the gif block of the frame file can follow the
+        frame with key base (None for the first frame)
+        """
+        blocks = self.manifest['blocks']
+        name = os.path.basename(filename)
+        return name in blocks and blocks[name] in (None, base)
+
+    def gif_frames(self, style, filename):
+        """
+        Returns the keys of the frames in the gif at filename, or []
+        if it doesn't exist, was written with another style or may
+        be incomplete
+        """
+        frames = self.manifest['gif_frames']
+        if (self.manifest['gif'] != sequence_key(frames, style)
+                or not os.path.exists(filename)):
+            return []
+        return frames
+
+    def record_gif(self, keys, style):
+        """
+        Records the keys of the frames in a freshly written gif, or
+        marks it incomplete if style is None
+        """
+        self.manifest['gif'] = None if style is None else sequence_key(keys, style)
+        self.manifest['gif_frames'] = list(keys)
+
+    def save(self):
+        """
+        Writes the manifest, replacing the old one in one step
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.path+'.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(self.path+'.tmp', self.path)
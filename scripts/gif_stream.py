@@ -0,0 +1,165 @@
+"""
+Streaming gif assembly from cached, individually encoded frames.
+
+Each frame is palette-quantized and LZW-encoded once, when it is
+rendered, into a self-contained gif block (graphic control extension,
+image descriptor, local color table and image data) cached next to
+its png. A frame rendered right after the one before it is encoded as
+a delta: only the rectangle of pixels that changed, with the unchanged
+ones in it transparent, which keeps the gif about as small as one
+optimized across frames. A gif is then just a header, the cached
+blocks and a trailer, so it is written one block at a time without
+decoding or re-encoding any frame, and when only new frames were added
+their blocks are appended to the existing gif in place of its trailer.
+"""
+
+import io
+import os
+import struct
+
+import numpy as np
+from PIL import Image
+
+TRAILER = b';'
+
+# Palette index of transparent pixels in delta frames
+TRANSPARENT = 255
+
+
+def _sub_blocks_end(data, pos):
+    """
+    Returns the position after the data sub-blocks starting at pos
+    """
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def _image_block(image, left=0, top=0):
+    """
+    Returns the image descriptor, local color table and image data of
+    a palette image saved by Pillow, placed at (left, top)
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, 'GIF', optimize=False)
+    data = buffer.getvalue()
+    # Global color table of the single frame gif, if any
+    packed = data[10]
+    table_end = 13 + (3 << ((packed & 7) + 1) if packed & 0x80 else 0)
+    table = data[13:table_end]
+    pos = table_end
+    while data[pos] == 0x21:
+        # Skip extensions, the frame's own control extension is added
+        pos = _sub_blocks_end(data, pos + 2)
+    if data[pos] != 0x2C:
+        raise ValueError('no image in encoded frame')
+    descriptor = bytearray(data[pos:pos + 10])
+    descriptor[1:5] = struct.pack('<HH', left, top)
+    pos += 10
+    if descriptor[9] & 0x80:
+        # Already has a local color table
+        table_end = pos + (3 << ((descriptor[9] & 7) + 1))
+        table, pos = data[pos:table_end], table_end
+    else:
+        # Move the global color table into the block
+        descriptor[9] = (descriptor[9] & 0x40) | 0x80 | (packed & 7)
+    image_end = _sub_blocks_end(data, pos + 1)
+    return bytes(descriptor) + table + data[pos:image_end]
+
+
+def control(duration=0, transparent=None):
+    """
+    Returns the graphic control extension showing a frame for duration
+    seconds over the frame before it, with an optional transparent
+    palette index
+    """
+    packed = 1 << 2 | (transparent is not None)
+    return (b'\x21\xf9\x04'
+            + struct.pack('<BHB', packed, int(round(duration*100)),
+                          transparent or 0)
+            + b'\x00')
+
+
+def encode_frame(frame, previous=None):
+    """
+    Returns the gif block of an RGB frame array, quantized to its own
+    palette. If previous, the frame shown before it, is given only the
+    pixels that differ from it are encoded.
+    """
+    frame = np.asarray(frame)
+    if previous is None:
+        image = Image.fromarray(frame).convert('P', palette=Image.ADAPTIVE,
+                                               colors=256)
+        return control() + _image_block(image)
+    changed = np.any(frame != previous, axis=2)
+    rows = np.flatnonzero(changed.any(axis=1))
+    cols = np.flatnonzero(changed.any(axis=0))
+    if len(rows) == 0:
+        # Nothing changed, draw a single transparent pixel
+        rows = cols = np.array([0])
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = cols[0], cols[-1] + 1
+    changed = changed[top:bottom, left:right]
+    image = Image.fromarray(np.ascontiguousarray(frame[top:bottom, left:right]))
+    image = image.convert('P', palette=Image.ADAPTIVE, colors=TRANSPARENT)
+    indices = np.array(image, dtype='uint8')
+    indices[~changed] = TRANSPARENT
+    palette = image.getpalette()[:3*TRANSPARENT]
+    delta = Image.frombytes('P', (right - left, bottom - top), indices.tobytes())
+    delta.putpalette(palette + [0]*(768 - len(palette)))
+    return control(transparent=TRANSPARENT) + _image_block(delta, left, top)
+
+
+def header(width, height, loop):
+    """
+    Returns the gif header of an animation of width x height frames
+    played loop times (0 loops forever)
+    """
+    return (b'GIF89a' + struct.pack('<HHBBB', width, height, 0x70, 0, 0)
+            + b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop)
+            + b'\x00')
+
+
+def _with_duration(block, duration):
+    # Sets the delay in the block's graphic control extension
+    return block[:4] + struct.pack('<H', int(round(duration*100))) + block[6:]
+
+
+def write_gif(filename, blocks, size, duration, loop):
+    """
+    Writes a gif of size (width, height) from an iterable of encoded
+    frame blocks, holding one block in memory at a time, and replaces
+    filename with it in one step. The first block must be a full frame.
+    """
+    with open(filename+'.tmp', 'wb') as f:
+        f.write(header(*size, loop))
+        for block in blocks:
+            f.write(_with_duration(block, duration))
+        f.write(TRAILER)
+    os.replace(filename+'.tmp', filename)
+
+
+def append_gif(filename, blocks, duration):
+    """
+    Appends encoded frame blocks to the gif written to filename by
+    write_gif
+    """
+    with open(filename, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != TRAILER:
+            raise ValueError(filename+' is not a complete gif')
+        f.seek(-1, os.SEEK_END)
+        for block in blocks:
+            f.write(_with_duration(block, duration))
+        f.write(TRAILER)
+
+
+def save_block(block, filename):
+    with open(filename+'.tmp', 'wb') as f:
+        f.write(block)
+    os.replace(filename+'.tmp', filename)
+
+
+def read_block(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
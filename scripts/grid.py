@@ -0,0 +1,116 @@
+"""
+Definition of the regular lat/long grid the station values are
+interpolated onto.
+
+shapely is only needed to export the cells as polygons, so it is
+imported there and the app, which reads grids through grid_store.py,
+doesn't depend on it.
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+
+class Grid(namedtuple('Grid', ['x0', 'y0', 'pixel', 'nrows', 'ncols'])):
+    """
+    Regular grid of nrows x ncols points spaced pixel degrees apart,
+    starting at longitude x0 and latitude y0 (the south-west point).
+    Rows run north to south and columns west to east, matching the
+    meshgrid run_all.py has always used.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_extent(cls, longitude, latitude, pixel):
+        """
+        Returns the grid covering the extent of the given
+        longitudes and latitudes, snapped to multiples of pixel.
+        """
+        x_range = np.arange(longitude.min()-longitude.min()%pixel,
+                            longitude.max(), pixel)
+        y_range = np.arange(latitude.min()-latitude.min()%pixel,
+                            latitude.max(), pixel)
+        return cls(float(x_range[0]), float(y_range[0]), pixel,
+                   len(y_range), len(x_range))
+
+    @property
+    def shape(self):
+        return (self.nrows, self.ncols)
+
+    @property
+    def x_range(self):
+        return _arange(self.x0, self.pixel, self.ncols)
+
+    @property
+    def y_range(self):
+        return _arange(self.y0, self.pixel, self.nrows)[::-1]
+
+    def mesh(self):
+        """
+        Returns the (x_mesh, y_mesh) arrays of grid point coordinates.
+        """
+        return np.meshgrid(self.x_range, self.y_range)
+
+    def points(self):
+        """
+        Returns an (nrows*ncols x 2) array of (long, lat) grid points
+        in row-major order.
+        """
+        x_mesh, y_mesh = self.mesh()
+        return np.column_stack([x_mesh.ravel(), y_mesh.ravel()])
+
+    def cell_index(self, longitude, latitude):
+        """
+        Returns the flat index of the grid point nearest to each
+        longitude, latitude, or -1 where it is more than half a pixel
+        outside the grid.
+        """
+        longitude = np.asarray(longitude, dtype='float64')
+        latitude = np.asarray(latitude, dtype='float64')
+        with np.errstate(invalid='ignore'):
+            j = np.round((longitude - self.x0)/self.pixel)
+            i = self.nrows - 1 - np.round((latitude - self.y0)/self.pixel)
+            inside = (i >= 0) & (i < self.nrows) & (j >= 0) & (j < self.ncols)
+        return np.where(inside, i*self.ncols + j, -1).astype(int)
+
+
+@lru_cache(maxsize=8)
+def cell_polygons(grid, half_width=0.04):
+    """
+    Returns an array of square shapely Polygons, one per grid point in
+    row-major order, centred on the point and half_width degrees
+    across each way. Built in one vectorized step and cached per grid;
+    join it to values by cell index only when exporting.
+
+    Matches the envelope of a half_width buffer around each point,
+    which is how the cells used to be built.
+    """
+    import shapely
+
+    x, y = grid.points().T
+    xmin, xmax = x - half_width, x + half_width
+    ymin, ymax = y - half_width, y + half_width
+    rings = np.stack([np.column_stack(corner) for corner in
+                      [(xmin, ymin), (xmax, ymin), (xmax, ymax),
+                       (xmin, ymax), (xmin, ymin)]], axis=1)
+    return shapely.polygons(rings)
+
+
+@lru_cache(maxsize=8)
+def cell_wkt(grid, half_width=0.04):
+    """
+    Returns the WKT text of cell_polygons(grid, half_width)
+    """
+    import shapely
+
+    return shapely.to_wkt(cell_polygons(grid, half_width), rounding_precision=-1)
+
+
+def _arange(start, step, num):
+    """
+    Returns the same values as np.arange(start, stop, step) with num
+    elements, which steps by (start+step)-start rather than step.
+    """
+    return start + np.arange(num)*((start + step) - start)
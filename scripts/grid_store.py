@@ -0,0 +1,273 @@
+"""
+Compact on-disk format for the interpolated grids.
+
+Each pollutant is stored as a directory holding
+
+- manifest.json ; the grid definition (origin, pixel size, shape), the
+  dates and the file names below
+- mask.npy ; boolean flag per grid cell, True for cells that have a
+  value on at least one date
+- values.npy ; float32 (dates x masked cells) matrix of values
+- stations.npy ; optionally, the float32 (dates x stations) matrix of
+  the station values the grid was interpolated from, with the station
+  locations and their Delaunay triangles in the manifest, from which
+  the surface can be interpolated at any resolution (see tiles.py)
+
+The grid is stored once instead of on every row, and values.npy is
+memory-mapped on read so a single date's frame or a single cell's
+time series can be read without loading the rest.
+
+Each write makes a new version directory, <path>.v<n>, and <path> is a
+symlink to the current one. A write swaps the symlink in one rename,
+so readers always find a complete store at <path>, and readers open
+every file of a version through its resolved path, so a swap never
+mixes versions. The previous version is kept until the next write, for
+readers still opening it.
+"""
+
+import glob
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from grid import Grid
+
+
+def store_path(param, root='../data/wrangled'):
+    return os.path.join(root, param+'_grid')
+
+
+def write_grid_store(path, param, grid, dates, values, date_ints=None):
+    """
+    Writes values, a (grid cells x dates) array in grid's row-major
+    cell order, to a grid store at path, replacing any existing store
+    in one step.
+    """
+    writer = GridStoreWriter(path, param, grid, dates, date_ints)
+    writer.write(values)
+    writer.close()
+
+
+class GridStoreWriter:
+    """
+    Writes a grid store a batch of dates at a time, so the values of
+    every date never have to be in memory at once. Batches are written
+    in date order to an unmasked scratch matrix of a new version, which
+    close() compacts into the store and swaps in place of the existing
+    one.
+    """
+
+    # Dates copied from the scratch matrix to the store at a time
+    block = 256
+
+    def __init__(self, path, param, grid, dates, date_ints=None, points=None,
+                 triangles=None):
+        self.path = path
+        self.tmp = '{}.v{}'.format(path, time.time_ns())
+        self.manifest = {'param': param,
+                         'grid': grid._asdict(),
+                         'dates': [str(d) for d in dates],
+                         'date_ints': [int(i) for i in (date_ints if date_ints is not None
+                                                        else range(len(dates)))],
+                         'dtype': 'float32',
+                         'cells': None,
+                         'mask': 'mask.npy',
+                         'values': 'values.npy'}
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+        self._scratch = np.lib.format.open_memmap(
+            os.path.join(self.tmp, 'scratch.npy'), mode='w+', dtype='float32',
+            shape=(len(dates), grid.nrows*grid.ncols))
+        self._mask = np.zeros(grid.nrows*grid.ncols, dtype=bool)
+        self._range = [np.inf, -np.inf]
+        self._written = 0
+        self._stations = None
+        if points is not None:
+            self.manifest['stations'] = {'points': np.asarray(points).tolist(),
+                                         'triangles': np.asarray(triangles).tolist(),
+                                         'values': 'stations.npy'}
+            self._stations = np.lib.format.open_memmap(
+                os.path.join(self.tmp, 'stations.npy'), mode='w+',
+                dtype='float32', shape=(len(dates), len(points)))
+
+    def write(self, values, station_values=None):
+        """
+        Writes values, a (grid cells x dates) array, and the (stations x
+        dates) station_values if the store has stations, for the dates
+        following the ones already written
+        """
+        values = np.asarray(values)
+        end = self._written + values.shape[1]
+        self._scratch[self._written:end] = values.T
+        self._mask |= ~np.all(np.isnan(values), axis=1)
+        if not np.all(np.isnan(values)):
+            # Range of the values as stored
+            self._range = [min(self._range[0], float(np.float32(np.nanmin(values)))),
+                           max(self._range[1], float(np.float32(np.nanmax(values))))]
+        if self._stations is not None:
+            self._stations[self._written:end] = np.asarray(station_values).T
+        self._written = end
+
+    def close(self):
+        if self._written != len(self._scratch):
+            raise ValueError('wrote {} of {} dates'.format(self._written,
+                                                           len(self._scratch)))
+        mask = self._mask
+        self.manifest['cells'] = int(mask.sum())
+        self.manifest['range'] = self._range
+        np.save(os.path.join(self.tmp, 'mask.npy'), mask)
+        values = np.lib.format.open_memmap(os.path.join(self.tmp, 'values.npy'),
+                                           mode='w+', dtype='float32',
+                                           shape=(len(self._scratch), int(mask.sum())))
+        for start in range(0, len(values), self.block):
+            values[start:start+self.block] = self._scratch[start:start+self.block][:, mask]
+        values.flush()
+        del values
+        self._scratch = None
+        os.remove(os.path.join(self.tmp, 'scratch.npy'))
+        if self._stations is not None:
+            self._stations.flush()
+            self._stations = None
+        with open(os.path.join(self.tmp, 'manifest.json'), 'w') as f:
+            json.dump(self.manifest, f)
+        self._swap()
+
+    def _swap(self):
+        """
+        Points path at the new version in one rename and removes the
+        versions before the one it replaces
+        """
+        link = self.path+'.link'
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(self.tmp), link)
+        previous = None
+        if os.path.islink(self.path):
+            previous = os.path.join(os.path.dirname(self.path),
+                                    os.readlink(self.path))
+        elif os.path.isdir(self.path):
+            # A store written before stores were versioned; readers
+            # opening it during this one rename find no store
+            previous = self.path+'.v0'
+            shutil.rmtree(previous, ignore_errors=True)
+            os.rename(self.path, previous)
+        os.replace(link, self.path)
+        keep = {self.tmp, previous}
+        for version in glob.glob(glob.escape(self.path)+'.v*'):
+            if version not in keep:
+                shutil.rmtree(version, ignore_errors=True)
+        for stale in (self.path+'.tmp', self.path+'.old'):
+            shutil.rmtree(stale, ignore_errors=True)
+
+
+class GridStore:
+    """
+    Reader for a grid store directory written by write_grid_store
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # The version the files are read from, whatever later writes swap in
+        self.version = path = os.path.realpath(path)
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.param = self.manifest['param']
+        self.grid = Grid(**self.manifest['grid'])
+        self.dates = self.manifest['dates']
+        self.date_ints = self.manifest['date_ints']
+        self._date_index = {d: i for i, d in enumerate(self.dates)}
+        self.mask = np.load(os.path.join(path, self.manifest['mask']))
+        self.values = np.load(os.path.join(path, self.manifest['values']),
+                              mmap_mode='r')
+        self.stations = self.manifest.get('stations')
+        if self.stations is not None:
+            self.station_values = np.load(os.path.join(path, self.stations['values']),
+                                          mmap_mode='r')
+        # Position of each grid cell in the columns of values (-1 if masked out)
+        self.column = np.full(self.mask.shape, -1)
+        self.column[self.mask] = np.arange(self.mask.sum())
+
+    def date_index(self, date):
+        """
+        Returns the row of values holding date (an iso string or an
+        index)
+        """
+        if isinstance(date, str):
+            return self._date_index[date]
+        return date
+
+    def frame(self, date):
+        """
+        Returns the flat array of values of every grid cell on date,
+        NaN outside the cell mask
+        """
+        out = np.full(self.mask.shape, np.nan, dtype='float32')
+        out[self.mask] = self.values[self.date_index(date)]
+        return out
+
+    def frame_2d(self, date):
+        """
+        Returns the values on date as an (nrows x ncols) array
+        """
+        return self.frame(date).reshape(self.grid.shape)
+
+    def series(self, cell):
+        """
+        Returns the values of grid cell (a flat index) on every date
+        """
+        column = self.column[cell]
+        if column < 0:
+            return np.full(len(self.dates), np.nan, dtype='float32')
+        return np.array(self.values[:, column])
+
+    def value_range(self, block=256):
+        """
+        Returns the smallest and largest value of the store, reading
+        block dates at a time if the manifest doesn't record them
+        """
+        if 'range' in self.manifest:
+            return tuple(self.manifest['range'])
+        low, high = np.inf, -np.inf
+        for start in range(0, len(self.dates), block):
+            values = self.values[start:start+block]
+            if values.size and not np.all(np.isnan(values)):
+                low = min(low, float(np.nanmin(values)))
+                high = max(high, float(np.nanmax(values)))
+        return low, high
+
+    def matrix(self):
+        """
+        Returns the full (grid cells x dates) matrix of values
+        """
+        out = np.full((self.mask.size, len(self.dates)), np.nan, dtype='float32')
+        out[self.mask] = np.asarray(self.values).T
+        return out
+
+
+class CellMatrix:
+    """
+    Read-only (grid cells x dates) view of the values of a grid
+    store, like GridStore.matrix() returns, that only reads the dates
+    it is indexed with: matrix[:, date] or matrix[:, [dates]].
+    Pickles as the path of the version of the store it reads, so worker
+    processes map the same values themselves.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.store = GridStore(path)
+        self.shape = (self.store.mask.size, len(self.store.dates))
+
+    def __reduce__(self):
+        return CellMatrix, (self.store.version,)
+
+    def __getitem__(self, key):
+        cells, dates = key
+        rows = np.asarray(self.store.values[dates])
+        out = np.full((self.store.mask.size,) + rows.shape[:-1], np.nan,
+                      dtype='float32')
+        out[self.store.mask] = rows.T
+        return out[cells]
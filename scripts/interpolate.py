@@ -0,0 +1,117 @@
+"""
+Batched linear interpolation of station values onto a fixed grid.
+
+scipy.interpolate.griddata rebuilds the Delaunay triangulation of the
+stations on every call. Here the triangulation is built once per set
+of stations and turned into a sparse (grid cells x stations) matrix of
+barycentric weights, so every date is interpolated by a single matrix
+multiply.
+
+Method from http://geologyandpython.com/ml-interpolation-method.html
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import Delaunay
+
+
+def triangulate(points):
+    """
+    Returns the (triangles x 3) array of the indices of points forming
+    their Delaunay triangulation, the one barycentric_weights uses
+    """
+    return Delaunay(np.asarray(points, dtype='float64')).simplices
+
+
+def barycentric_weights(points, xi):
+    """
+    Returns a sparse (len(xi) x len(points)) matrix W such that W @ z
+    is the piecewise linear interpolation of the station values z at
+    xi, plus a boolean array flagging the xi outside the convex hull
+    of points (where griddata returns NaN).
+    """
+    points = np.asarray(points, dtype='float64')
+    xi = np.asarray(xi, dtype='float64')
+    tri = Delaunay(points)
+    simplex = tri.find_simplex(xi)
+    outside = simplex == -1
+    inside = np.flatnonzero(~outside)
+    # Barycentric coordinates of each grid point in its triangle
+    transform = tri.transform[simplex[inside]]
+    delta = xi[inside] - transform[:, 2]
+    bary = np.einsum('ijk,ik->ij', transform[:, :2], delta)
+    weights = np.column_stack([bary, 1 - bary.sum(axis=1)])
+    rows = np.repeat(inside, 3)
+    cols = tri.simplices[simplex[inside]].ravel()
+    matrix = sparse.csr_matrix((weights.ravel(), (rows, cols)),
+                               shape=(len(xi), len(points)))
+    return matrix, outside
+
+
+class GridInterpolator:
+    """
+    Linear interpolator from a fixed set of station locations to a
+    fixed set of grid points, equivalent to calling
+    griddata(points, values[:, j], xi, method='linear') for every
+    column j of values.
+
+    With skip_missing=False (griddata's behaviour) a station that is
+    missing on a date is still part of the triangulation and blanks
+    every grid cell whose triangle touches it. With skip_missing=True
+    each date is interpolated from the stations that reported on it;
+    dates sharing the same missing-station pattern share one
+    triangulation.
+    """
+
+    def __init__(self, points, xi, skip_missing=False):
+        self.points = np.asarray(points, dtype='float64')
+        self.xi = np.asarray(xi, dtype='float64')
+        self.skip_missing = skip_missing
+        self._weights = {}
+
+    def weights(self, reporting):
+        """
+        Returns the (cached) weight matrix and outside-hull mask for
+        the stations flagged in the boolean array reporting.
+        """
+        key = reporting.tobytes()
+        if key not in self._weights:
+            self._weights[key] = barycentric_weights(self.points[reporting],
+                                                     self.xi)
+        return self._weights[key]
+
+    def __call__(self, values):
+        """
+        Interpolates values, a (stations x dates) array, returning a
+        (grid points x dates) array with NaN outside the hull.
+        """
+        values = np.asarray(values, dtype='float64')
+        if values.ndim == 1:
+            return self(values[:, None])[:, 0]
+        out = np.full((len(self.xi), values.shape[1]), np.nan)
+        if not self.skip_missing:
+            groups = {np.ones(len(self.points), dtype=bool).tobytes():
+                      np.arange(values.shape[1])}
+        else:
+            groups = group_by_mask(~np.isnan(values))
+        for key, dates in groups.items():
+            reporting = np.frombuffer(key, dtype=bool)
+            if self.skip_missing and reporting.sum() < 3:
+                # Too few stations to triangulate; leave the dates blank
+                continue
+            matrix, outside = self.weights(reporting)
+            block = matrix @ values[reporting][:, dates]
+            block[outside] = np.nan
+            out[:, dates] = block
+        return out
+
+
+def group_by_mask(mask):
+    """
+    Groups the columns of a boolean (stations x dates) mask by their
+    pattern, returning {pattern bytes: array of column indices}.
+    """
+    patterns, inverse = np.unique(mask.T, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    return {pattern.tobytes(): np.flatnonzero(inverse == i)
+            for i, pattern in enumerate(patterns)}
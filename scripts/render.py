@@ -0,0 +1,252 @@
+"""
+NumPy raster renderer for the daily air quality map frames.
+
+Paints the interpolated grid straight into an RGB array using the
+same yelloworangebrown scale and fixed per-pollutant domain as the
+original Altair charts, overlays the Bay Area county borders (the
+simplified layer built by topology.py, rasterized once per process)
+and draws the title, legend and
+shelter-in-place annotation with Pillow.
+"""
+
+import hashlib
+import json
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import topology
+
+# Plot area and canvas size in pixels (matches the old 500x450 charts)
+WIDTH, HEIGHT = 500, 450
+LEFT, TOP, RIGHT, BOTTOM = 5, 30, 70, 7
+CANVAS = (TOP + HEIGHT + BOTTOM, LEFT + WIDTH + RIGHT)
+
+# Vega's 'yelloworangebrown' scheme (ColorBrewer YlOrBr)
+YELLOWORANGEBROWN = ['#ffffe5', '#fff7bc', '#fee391', '#fec44f', '#fe9929',
+                     '#ec7014', '#cc4c02', '#993404', '#662506']
+
+# County layer the frames draw, simplified within a fifth of a pixel
+COUNTIES = topology.layer_path('medium')
+
+# Bump when a change to the drawing code alters the frames, so frames
+# cached by run_all.py are redrawn
+STYLE_VERSION = 2
+
+
+def _rgb(hex_color):
+    return [int(hex_color[i:i+2], 16) for i in (1, 3, 5)]
+
+
+SCHEME = np.array([_rgb(c) for c in YELLOWORANGEBROWN], dtype='float64')
+
+
+def colorize(values, domain):
+    """
+    Maps values onto the yelloworangebrown scale over domain
+    (min, max), returning a uint8 (..., 3) RGB array. NaNs map to
+    white.
+    """
+    values = np.asarray(values, dtype='float64')
+    span = (domain[1] - domain[0]) or 1
+    t = np.clip((values - domain[0])/span, 0, 1)
+    stops = np.linspace(0, 1, len(SCHEME))
+    rgb = np.stack([np.interp(t, stops, SCHEME[:, c]) for c in range(3)],
+                   axis=-1)
+    rgb[np.isnan(values)] = 255
+    return np.round(rgb).astype('uint8')
+
+
+def _mercator_y(lat):
+    return np.log(np.tan(np.pi/4 + np.radians(lat)/2))
+
+
+class Projection:
+    """
+    Mercator projection fitted to a lon/lat bounding box inside the
+    WIDTH x HEIGHT plot area, as Vega fits geoshape charts.
+    """
+
+    def __init__(self, bounds):
+        xmin, ymin, xmax, ymax = bounds
+        self.x0 = np.radians(xmin)
+        self.y1 = _mercator_y(ymax)
+        dx = np.radians(xmax) - self.x0
+        dy = self.y1 - _mercator_y(ymin)
+        self.scale = min(WIDTH/dx, HEIGHT/dy)
+        self.dx = (WIDTH - dx*self.scale)/2
+        self.dy = (HEIGHT - dy*self.scale)/2
+
+    def __call__(self, lon, lat):
+        """
+        Returns plot-area pixel (column, row) coordinates of lon, lat.
+        """
+        col = (np.radians(lon) - self.x0)*self.scale + self.dx
+        row = (self.y1 - _mercator_y(lat))*self.scale + self.dy
+        return col, row
+
+    def inverse(self, col, row):
+        """
+        Returns the lon, lat at plot-area pixel (column, row).
+        """
+        lon = np.degrees((col - self.dx)/self.scale + self.x0)
+        lat = np.degrees(2*np.arctan(np.exp(self.y1 - (row - self.dy)/self.scale))
+                         - np.pi/2)
+        return lon, lat
+
+
+def _rings(geometry):
+    if geometry['type'] == 'Polygon':
+        return geometry['coordinates']
+    if geometry['type'] == 'MultiPolygon':
+        return [ring for polygon in geometry['coordinates'] for ring in polygon]
+    return []
+
+
+@lru_cache(maxsize=None)
+def load_counties(path=COUNTIES):
+    """
+    Returns the county border rings in path, a TopoJSON layer or a
+    GeoJSON file, as a tuple of (n x 2) lon/lat arrays.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if data['type'] == 'Topology':
+        return tuple(topology.rings(data))
+    return tuple(np.asarray(ring, dtype='float64')[:, :2]
+                 for feature in data['features']
+                 for ring in _rings(feature['geometry']))
+
+
+@lru_cache(maxsize=None)
+def style(counties=COUNTIES):
+    """
+    Returns a dict of the render settings, other than the data, that
+    determine how a frame looks
+    """
+    with open(counties, 'rb') as f:
+        counties_hash = hashlib.sha1(f.read()).hexdigest()
+    return {'version': STYLE_VERSION,
+            'canvas': list(CANVAS),
+            'margins': [LEFT, TOP, RIGHT, BOTTOM],
+            'scheme': YELLOWORANGEBROWN,
+            'counties': counties_hash}
+
+
+@lru_cache(maxsize=None)
+def projection(path=COUNTIES):
+    """
+    Returns the Projection fitted to the counties in path.
+    """
+    rings = np.concatenate(load_counties(path))
+    return Projection((*rings.min(axis=0), *rings.max(axis=0)))
+
+
+@lru_cache(maxsize=None)
+def border_mask(path=COUNTIES):
+    """
+    Returns a boolean HEIGHT x WIDTH mask of the county borders in
+    path, rasterized once and reused for every frame.
+    """
+    proj = projection(path)
+    image = Image.new('1', (WIDTH, HEIGHT), 0)
+    draw = ImageDraw.Draw(image)
+    for ring in load_counties(path):
+        col, row = proj(ring[:, 0], ring[:, 1])
+        draw.line(list(zip(col, row)), fill=1, width=1)
+    return np.array(image, dtype=bool)
+
+
+@lru_cache(maxsize=8)
+def cell_index(grid, path=COUNTIES):
+    """
+    Returns a HEIGHT x WIDTH array holding, for every plot pixel, the
+    flat index of the grid cell it falls in, or -1 outside the grid.
+    """
+    proj = projection(path)
+    col, row = np.meshgrid(np.arange(WIDTH) + .5, np.arange(HEIGHT) + .5)
+    lon, lat = proj.inverse(col, row)
+    return grid.cell_index(lon, lat)
+
+
+@lru_cache(maxsize=None)
+def _font(size, bold=False):
+    name = 'DejaVuSans-Bold.ttf' if bold else 'DejaVuSans.ttf'
+    try:
+        return ImageFont.truetype(name, size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def _nice_ticks(domain, count=4):
+    span = domain[1] - domain[0]
+    if not span > 0:
+        return [domain[0]]
+    step = 10**np.floor(np.log10(span/count))
+    for factor in (1, 2, 5, 10):
+        if span/(step*factor) <= count:
+            step *= factor
+            break
+    first = np.ceil(domain[0]/step)*step
+    return list(np.arange(first, domain[1] + step*1e-9, step))
+
+
+def _draw_legend(draw, domain, units):
+    x, y = LEFT + WIDTH + 18, TOP + 20
+    height = 200
+    draw.text((x, TOP - 4), units, fill='black', font=_font(14, bold=True))
+    ramp = colorize(np.linspace(domain[1], domain[0], height), domain)
+    for k, color in enumerate(ramp):
+        draw.line([(x, y + k), (x + 15, y + k)], fill=tuple(int(c) for c in color))
+    span = (domain[1] - domain[0]) or 1
+    for tick in _nice_ticks(domain):
+        ty = y + (domain[1] - tick)/span*(height - 1)
+        draw.text((x + 20, ty - 7), '{:g}'.format(round(tick, 10)),
+                  fill='black', font=_font(13))
+
+
+def render_frame(values, grid, domain, title, units, annotation=None,
+                 counties=COUNTIES):
+    """
+    Returns a uint8 RGB array of the map of values, a flat array of
+    grid cell values in grid's row-major order, colored over domain,
+    with county borders, a title, a legend titled units and an
+    optional red annotation in the top right of the map.
+    """
+    canvas = np.full(CANVAS + (3,), 255, dtype='uint8')
+    index = cell_index(grid, counties)
+    # Color each cell once, then look the colors up per pixel
+    cells = np.append(np.asarray(values, dtype='float64'), np.nan)
+    plot = colorize(cells, domain)[index]
+    plot[border_mask(counties)] = 0
+    canvas[TOP:TOP + HEIGHT, LEFT:LEFT + WIDTH] = plot
+
+    image = Image.fromarray(canvas)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([LEFT - 1, TOP - 1, LEFT + WIDTH, TOP + HEIGHT],
+                   outline=(221, 221, 221))
+    font = _font(20, bold=True)
+    left, _, right, _ = draw.textbbox((0, 0), title, font=font)
+    draw.text((LEFT + (WIDTH - (right - left))/2, 2), title,
+              fill='black', font=font)
+    if annotation:
+        draw.text((LEFT + WIDTH/2 + 65, TOP + HEIGHT/2 - 210 - 9), annotation,
+                  fill='red', font=_font(16))
+    _draw_legend(draw, domain, units)
+    return np.asarray(image)
+
+
+def save_frame(frame, filename):
+    """
+    Writes an RGB frame array to filename as a PNG.
+    """
+    Image.fromarray(frame).save(filename)
+
+
+def load_frame(filename):
+    """
+    Returns the RGB frame array saved to filename.
+    """
+    with Image.open(filename) as image:
+        return np.asarray(image.convert('RGB'))
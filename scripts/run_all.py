@@ -35,41 +35,33 @@ Code resources
 - http://geologyandpython.com/ml-interpolation-method.html
 """
 
-import geopandas as gpd
 import pandas as pd
-import altair as alt
-from shapely.geometry import Polygon, Point
-from scipy.interpolate import griddata
 import numpy as np
-import requests
-import io
-import imageio
+import argparse
 import os
 import shutil
+import signal
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
-
-# Load site information
-sites = pd.read_csv('../data/raw/PM25HR_SITELIST_2020-12-31.csv')
-sites.astype({'site': 'str'})
-
-# Load geojson (Bay Area County borders) to dataframe object
-shape_gdf = gpd.read_file('../data/raw/Bay_Area_Counties.geojson')
-
-# Create df of unique sensor locations
-sites_wr = sites.groupby(['site', 'name']).aggregate({'latitude':'mean',
-                                            'longitude':'mean'}).reset_index()
-# Export for plotting
-sites_wr.to_csv('../data/wrangled/sites_data.csv')
-# Cast 'site' column as a string to match data df
-sites_wr['site'] = sites_wr['site'].astype('int').astype('str')
+import fetch
+from frame_cache import FrameCache, frame_key
+import gif_stream
+from grid import Grid, cell_wkt
+from grid_store import CellMatrix, GridStore, GridStoreWriter, store_path
+from interpolate import GridInterpolator, triangulate
+import render
+import run_report
+from run_report import stage
+import tiles
+import topology
+import window_stats
 
 # Units and pollutant mapping
 param_title = {'OZONE': 'Ozone', 'NOX': 'NOx', 'PM25HR': 'PM 2.5', 'BC': 'Black Carbon', 'NO2':'NO2'}
 units_dict = {'OZONE': 'ppm', 'NOX': 'ppm', 'PM25HR': 'µg/m3', 'BC': 'µg/m3', 'NO2':'NO2'}
 
-# Today's date
-today = date.today()
-
 # Available pollutants
 pollutants = ['PM25HR', 'OZONE', 'BC', 'NOX', 'NO2']
 
@@ -77,214 +69,724 @@ pollutants = ['PM25HR', 'OZONE', 'BC', 'NOX', 'NO2']
 # for param in pollutants:
 #     os.system('rm -rf ../assets/img/'+param+'/*')
 
-# Set URL parameters
+# First date to download
 first_year = 2020
 first_mon = 2
 first_day = 1
-first_date = '{}-{}-{}'.format(first_year, first_mon, first_day) # yyyy-m-d 
-units = {'OZONE': '007', 'BC': '001', 'NOX': '007', 'PM25HR': '001', 'NO2':'007'}
-year = '2020'
-mon = str(today.month)
-day = str(today.day)
-basin = 'SFB-San+Francisco+Bay'
-rows = {'OZONE': '20', 'BC': '6', 'NOX': '18', 'PM25HR': '17', 'NO2': '18'}
-
-# Determine March 1st offset from first_date
-mar1_offset = int((date(2020,3,1)-date(first_year,first_mon,first_day)).days)
-
-for param in pollutants:
-    # Set filename
-    fname = param+'_'+year+'-'+mon+'-'+day
-
-    url = 'https://www.arb.ca.gov/aqmis2/display.php?sitelist=All&\
-filefmt=csv&fname='+fname+'&datafmt=web&download=y&\
-first_date='+first_date+'&param='+param+'&\
-units='+units[param]+'&year='+year+'&report=PICKDATA\
-&mon='+mon+'&day='+day+'&o3area=&o3pa8=&\
-county_name=--COUNTY--&latitude=--PART+OF+STATE--&\
-basin='+basin+'&order=basin%2Ccounty_name%2Cs.name&\
-ptype=aqd&o3switch=new&hours=all&\
-statistic=&qselect=Screened&start_mon=2&\
-start_day=1&submit=All+Sites&\
-rows='+rows[param]
-
-    print("Creating content for "+param)
-
-    # Download data from CA air resources board
-    # https://www.arb.ca.gov
-    r = requests.post(url)
-    if r.ok:
-        data = r.content.decode('utf8')
-        aq_data = pd.read_csv(io.StringIO(data))    
-
+first_date = date(first_year, first_mon, first_day)
+
+# First date mapped, and the date int (days from first_date) of its
+# frame, the still shown in the app
+map_start = '2020-03-01'
+mar1_offset = (date.fromisoformat(map_start) - first_date).days
+
+# Last day before the shelter in place order was enforced
+shelter_date = '2020-03-16'
+
+# Smallest number of frames handed to a worker at once
+min_chunk = 8
+
+# Most frames handed to a worker (or rendered serially) at once, which
+# bounds the values read for them
+max_chunk = 64
+
+# Gif frame duration (seconds) and loop count
+gif_duration = .4
+gif_loop = 1
+
+
+def load_sites():
+    """
+    Returns df of unique sensor locations, exporting it for plotting
+    """
+    # Load site information
+    sites = pd.read_csv('../data/raw/PM25HR_SITELIST_2020-12-31.csv')
+    sites.astype({'site': 'str'})
+
+    # Create df of unique sensor locations
+    sites_wr = sites.groupby(['site', 'name']).aggregate({'latitude':'mean',
+                                                'longitude':'mean'}).reset_index()
+    # Export for plotting
+    sites_wr.to_csv('../data/wrangled/sites_data.csv')
+    # Cast 'site' column as a string to match data df
+    sites_wr['site'] = sites_wr['site'].astype('int').astype('str')
+    return sites_wr
+
+
+def daily_means(aq_data):
+    """
+    Returns the long df of the daily mean value per site and date
+    ('site', 'date', 'value') of the valid observations in aq_data
+    """
     # Remove observations marked "invalid"
     aq_data = aq_data.dropna()
-
-    # Map latitude, longitude values to new columns in data df based 
-    # on site id
-    lat_dict = dict(zip(sites_wr['site'], sites_wr['latitude']))
-    long_dict = dict(zip(sites_wr['site'], sites_wr['longitude']))
-    aq_data['lat'] = aq_data['site'].map(lat_dict)
-    aq_data['long'] = aq_data['site'].map(long_dict)
-
-    # Cast sites as geodataframe
-    gdf_sites = gpd.GeoDataFrame(
-        sites_wr, geometry=gpd.points_from_xy(sites_wr.longitude, 
-                                            sites_wr.latitude))
-
-    # Reshape df, column per date
-    aq_da = aq_data[['site', 
-                    'date', 
-                    'value']].groupby(['site',
-                                        'date']).mean().reset_index()
-    aq_da = aq_da.pivot(index = 'site', 
-                        values = 'value', 
-                        columns = 'date').reset_index()
-    # Merge spatial data with aq data
-    aq_gdf = pd.merge(gdf_sites, aq_da, how = 'inner', on = 'site')
-
+    return (aq_data[['site', 'date', 'value']].groupby(['site', 'date'])
+                                              .mean()
+                                              .reset_index())
+
+
+def read_daily(store, param, chunked=False):
+    """
+    Returns the daily means of the stored observations of param. With
+    chunked, the observations are read and reduced one month partition
+    at a time, so only a month of them is ever in memory; the result
+    is the same.
+    """
+    if not chunked:
+        with stage('read_store', param):
+            aq_data = store.read(param)
+        with stage('daily_means', param, rows=len(aq_data)):
+            return daily_means(aq_data)
+    months = []
+    for partition in store.partitions(param):
+        with stage('read_store', param, partition=os.path.basename(partition)):
+            aq_data = pd.read_parquet(partition)
+        with stage('daily_means', param, rows=len(aq_data)):
+            months.append(daily_means(aq_data))
+    if not months:
+        return daily_means(pd.DataFrame(columns=['site', 'date', 'value']))
+    # In the order of the in-memory groupby, by site then date
+    return (pd.concat(months, ignore_index=True)
+              .sort_values(['site', 'date'], kind='stable', ignore_index=True))
+
+
+def stations(daily, sites_wr):
+    """
+    Returns the sites of sites_wr that have daily values, in the
+    order of sites_wr
+    """
+    return sites_wr[sites_wr['site'].isin(daily['site'])].reset_index(drop=True)
+
+
+def date_int(d):
+    """
+    Returns the number of days from first_date to the iso date d,
+    which numbers its map frames
+    """
+    return (date.fromisoformat(d) - first_date).days
+
+
+def map_dates(dates):
+    """
+    Returns the dates of dates from map_start on, which are mapped
+    """
+    return [d for d in dates if d >= map_start]
+
+
+def month_batches(dates):
+    """
+    Splits the sorted iso dates into lists of the dates of each month
+    """
+    batches = {}
+    for d in dates:
+        batches.setdefault(d[:7], []).append(d)
+    return list(batches.values())
+
+
+def site_values(daily, sites, dates):
+    """
+    Returns the (sites x dates) array of the daily values of sites on
+    dates, NaN where a site has no value
+    """
+    daily = daily[daily['date'].isin(dates) & daily['site'].isin(sites['site'])]
+    values = np.full((len(sites), len(dates)), np.nan)
+    row = pd.Index(sites['site']).get_indexer(daily['site'])
+    column = pd.Index(dates).get_indexer(daily['date'])
+    values[row, column] = daily['value'].values
+    return values
+
+
+def make_interpolator(sites, pixel=.05):
+    """
+    Returns the grid bounded by sites and the interpolator of their
+    values onto it
+    """
     # Interpolate AQ values across a grid bounded by sensor locations
     # Method from http://geologyandpython.com/ml-interpolation-method.html
+    # Determine extent of observations and create pixel_size-spaced grid
+    grid = Grid.from_extent(sites.longitude, sites.latitude, pixel)
+
+    # Linear interpolation across grid, one triangulation for all dates
+    return grid, GridInterpolator(sites[['longitude', 'latitude']].values,
+                                  grid.points())
+
+
+def line_data(daily, sites, dates, param):
+    """
+    Returns the long df of the daily values of param per station.
+    Rows are ordered, and numbered, by date and then station.
+    """
+    daily = daily[daily['site'].isin(sites['site'])]
+    row = (pd.Index(dates).get_indexer(daily['date'])*len(sites)
+           + pd.Index(sites['site']).get_indexer(daily['site']))
+    return pd.DataFrame({'name': sites['name'].values[row % len(sites)],
+                         'date': daily['date'].values,
+                         param: daily['value'].values},
+                        index=row).sort_index()
+
+
+def write_line_data(line_df, param):
+    """
+    Writes the line chart data of param as csv and parquet
+    """
+    line_df.to_csv('../data/wrangled/'+param+'_line_plot.csv')
+    # Typed, columnar copy the app loads
+    (line_df.astype({'name': 'category', 'date': 'datetime64[ns]'})
+            .reset_index(drop=True)
+            .to_parquet('../data/wrangled/'+param+'_line_plot.parquet', index=False))
+
+
+def reusable_store(param, grid, points):
+    """
+    Returns the grid store of param if it was interpolated onto grid
+    from stations at points, so the values of its dates can be reused,
+    or None
+    """
+    path = store_path(param)
+    if not os.path.exists(os.path.join(path, 'manifest.json')):
+        return None
+    old = GridStore(path)
+    if (old.grid != grid or old.stations is None
+            or old.stations['points'] != np.asarray(points).tolist()):
+        return None
+    return old
+
+
+def interpolate_batch(interpolator, batch, batch_values, old=None, changed=()):
+    """
+    Returns the interpolated (grid cells x dates) values of the dates
+    of batch from the (stations x dates) batch_values, and the number
+    of dates interpolated. The values of the dates of the grid store
+    old that aren't in changed and whose station values are the stored
+    ones are read from old instead, which also redoes dates a failed
+    earlier run left stale.
+    """
+    if old is None:
+        return interpolator(batch_values), len(batch)
+    rows = {d: row for row, d in enumerate(old.dates)}
+    stored = [None if d in changed else rows.get(d) for d in batch]
+    redo = [k for k, row in enumerate(stored)
+            if row is None or not np.array_equal(
+                old.station_values[row], batch_values[:, k].astype('float32'),
+                equal_nan=True)]
+    interp_values = np.empty((old.mask.size, len(batch)))
+    if redo:
+        interp_values[:, redo] = interpolator(batch_values[:, redo])
+    for k in sorted(set(range(len(batch))) - set(redo)):
+        interp_values[:, k] = old.frame(stored[k])
+    return interp_values, len(redo)
+
+
+def process_pollutant(param, store, sites_wr, windows, export_csv=False,
+                      chunked=False, tile_zoom=tiles.EAGER_ZOOM, changed=None):
+    """
+    Wrangles and interpolates the stored observations of param, writes
+    its grid store, csv files, statistics over the intervention windows
+    and map tiles up to zoom level tile_zoom and returns the frame job
+    used to render its maps. With chunked, observations are read and
+    dates interpolated one month at a time, bounding memory use
+    whatever the length of the history. Given the set of dates whose
+    observations changed, only those (and any whose station values
+    differ from the stored ones) are interpolated again; with None, or
+    export_csv, every date is.
+    """
+    print("Creating content for "+param)
+
+    daily = read_daily(store, param, chunked)
+    sites = stations(daily, sites_wr)
+    dates = sorted(daily['date'].unique())
+    mapped = map_dates(dates)
+
     # Define size of pixels in grid (units of lat/long degrees)
-    pixel = .05
-    # Determine extent of observations and create pixel_size-spaced arrays
-    # in the N and S direction
-    x_range = np.arange(aq_gdf.longitude.min()-aq_gdf.longitude.min()%pixel,
-                        aq_gdf.longitude.max(), pixel)
-    y_range = np.arange(aq_gdf.latitude.min()-aq_gdf.latitude.min()%pixel,
-                        aq_gdf.latitude.max(), pixel)[::-1]
-    shape = (len(y_range), len(x_range))
-    xmin, xmax = x_range.min(), x_range.max()
-    ymin, ymax = y_range.min(), y_range.max()
-    extent = (xmin, xmax, ymin, ymax)
-    # Create grid
-    x_mesh, y_mesh = np.meshgrid(x_range, y_range)
-
-    # Store interpolated points in new dataframe
-    interp_df = pd.DataFrame({'lat':y_mesh.flatten(), 
-                            'long': x_mesh.flatten()})
-    date_cols = aq_gdf.columns[5:]
-    print('    Interpolating across all dates')
-    for date in date_cols[mar1_offset:]:
-        # Linear interpolation across grid
-        pm_interp = griddata((aq_gdf['longitude'], 
-                            aq_gdf['latitude']), 
-                            aq_gdf[date], 
-                            (x_mesh, y_mesh), 
-                            method = 'linear')
-        interp_df[date] = pm_interp.flatten()
-
-    # Cast to geodataframe
-    interp_gdf = gpd.GeoDataFrame(
-        interp_df, geometry=gpd.points_from_xy(interp_df.long, 
-                                            interp_df.lat))
-
-    # Buffer each grid point to a larger pixel
-    # Method from https://gis.stackexchange.com/questions/314949/creating-square-buffers-around-points-using-shapely
-    interp_buffer = interp_gdf.copy()
-    buffer = interp_buffer.buffer(0.04)
-    envelope = buffer.envelope
-    interp_buffer['geometry'] = envelope
-
-    # Write csv with interpolated values
-    interp_buffer = interp_buffer.melt(id_vars = ['geometry','lat','long'], 
-                                    var_name = 'date', 
-                                    value_name = param)
-    interp_buffer['date_int'] = (interp_buffer['date']
-                                    .map(dict(zip(date_cols, 
-                                            range(len(date_cols))))))
-    interp_buffer.to_csv('../data/wrangled/'+param+'_interpolated.csv')
+    grid, interpolator = make_interpolator(sites, pixel=.05)
+    points = sites[['longitude', 'latitude']].values
+    old = None
+    if changed is not None and not export_csv:
+        old = reusable_store(param, grid, points)
+    writer = GridStoreWriter(store_path(param), param, grid, mapped,
+                             [date_int(d) for d in mapped],
+                             points, triangulate(points))
+    csv = open(interpolated_csv(param), 'w', newline='') if export_csv else None
+    row = 0
+    interpolated = 0
+    for batch in month_batches(mapped) if chunked else [mapped]:
+        # Write grid and interpolated values
+        with stage('interpolate', param, sites=len(sites), dates=len(batch)):
+            batch_values = site_values(daily, sites, batch)
+            interp_values, count = interpolate_batch(interpolator, batch,
+                                                     batch_values, old,
+                                                     changed or ())
+            interpolated += count
+        with stage('grid_store', param):
+            writer.write(interp_values, batch_values)
+        if csv is not None:
+            with stage('interpolated_csv', param):
+                row = export_interpolated_csv(csv, param, grid, batch,
+                                              interp_values, row)
+    with stage('grid_store', param):
+        writer.close()
+    if csv is not None:
+        csv.close()
+    print('    Interpolated {} of {} dates'.format(interpolated, len(mapped)))
 
     # Write csv to plot avg daily AQ values per station
-    cols = ['name']+list(date_cols)
-    line_df = aq_gdf[cols].melt(id_vars='name', 
-        var_name = 'date', 
-        value_name = param).dropna()
-    line_df['Pre-Shelter in place mean']=np.where(line_df['date']<='2020-03-16', 
-                    np.mean(line_df.query('date <= "2020-03-16"')[param]), np.nan)
-    line_df['Post-Shelter in place mean']=np.where(line_df['date']>'2020-03-16', 
-                    np.mean(line_df.query('date > "2020-03-16"')[param]), np.nan)
-    line_df.to_csv('../data/wrangled/'+param+'_line_plot.csv')
-
-    # create basemap
-    base_map = (alt.Chart(shape_gdf).mark_geoshape(
-        stroke='black',
-        fill = None
-        ).encode())
-
-    def plot_aq(date = 0):
-        """
-        Returns map of interpolated AQ values for single date
-        """
-        plot_df = interp_buffer.query('date_int =='+str(date)).reset_index(drop=True)
-        interpolated_plot = (alt.Chart(plot_df)
-            .mark_geoshape()
-            .encode(fill = alt.Color(param,
-                        scale = alt.Scale(
-                            domain=[min(interp_buffer[param].dropna()),
-                                max(interp_buffer[param].dropna())],
-                            type = 'linear',
-                            scheme = 'yelloworangebrown'),
-                        title = units_dict[param]),
-                    tooltip = [alt.Tooltip(param, 
-                                title = param_title[param]+" \
-                                    "+units_dict[param], 
-                                format = '0.5')]
-                            ))
-        if date < mar1_offset+16:
-            return ((interpolated_plot + base_map)
-                .properties(
-                    title = "Bay Area Avg.{} ({}): {}".format(
-                        param_title[param],
-                        units_dict[param],
-                        plot_df.loc[0,'date']),
-                    height = 450,
-                    width = 500)
-                .configure_title(fontSize = 20)
-                .configure_legend(titleFontSize=16, labelFontSize=14))
+    line_df = line_data(daily, sites, dates, param)
+    with stage('line_export', param):
+        write_line_data(line_df, param)
+    with stage('window_stats', param, windows=len(windows)):
+        window_stats.write_window_stats(
+            window_stats.stats_path(param),
+            window_stats.window_stats(line_df, param, windows))
+
+    # Coarse map tiles; finer ones are rendered by the app on request
+    with stage('tiles', param):
+        surface = tiles.SurfaceTiles(GridStore(store_path(param)))
+        rendered = surface.build(range(tiles.MIN_ZOOM, tile_zoom + 1))
+        surface.prune()
+    print('    Rendered {} map tiles'.format(rendered))
+
+    # Maps are drawn from the stored values, read a date at a time
+    values = CellMatrix(store_path(param))
+    return {'param': param,
+            'grid': grid,
+            'dates': mapped,
+            # Date indices of the columns of values
+            'indices': [date_int(d) for d in mapped],
+            'values': values,
+            # Fixed color domain across all dates
+            'domain': values.store.value_range()}
+
+
+def interpolated_csv(param):
+    return '../data/wrangled/'+param+'_interpolated.csv'
+
+
+def export_interpolated_csv(f, param, grid, dates, interp_values, row=0):
+    """
+    Writes the interpolated values of dates to the open file f in the
+    long *_interpolated.csv format, one row per grid cell per date,
+    numbering rows from row (with the header if row is 0). Returns the
+    number of the next row.
+    """
+    ncells = interp_values.shape[0]
+    # Grid cell of each row, cells varying fastest within a date.
+    # Cell geometry is built once per grid and joined by this index.
+    cell = np.tile(np.arange(ncells), len(dates))
+    points = grid.points()
+    interp_buffer = pd.DataFrame({'geometry': pd.Categorical.from_codes(
+                                      cell, cell_wkt(grid)),
+                                  'lat': points[cell, 1],
+                                  'long': points[cell, 0],
+                                  'date': pd.Categorical.from_codes(
+                                      np.repeat(np.arange(len(dates)), ncells),
+                                      dates),
+                                  param: interp_values.T.ravel(),
+                                  'date_int': np.repeat([date_int(d) for d in dates],
+                                                        ncells)},
+                                 index=pd.RangeIndex(row, row+ncells*len(dates)))
+    interp_buffer.to_csv(f, header=row == 0)
+    return row+len(interp_buffer)
+
+
+def frame_folder(param):
+    return '../assets/img/'+param
+
+
+def frame_filename(param, i):
+    return frame_folder(param)+'/'+param+'_'+str(i)+'.png'
+
+
+def block_filename(param, i):
+    # Encoded gif block of the frame, see gif_stream
+    return frame_folder(param)+'/blocks/'+param+'_'+str(i)+'.blk'
+
+
+def frame_labels(job, date):
+    """
+    Returns the title and annotation of the map of a single date
+    """
+    param = job['param']
+    title = "Bay Area Avg.{} ({}): {}".format(param_title[param],
+                                              units_dict[param],
+                                              job['dates'][job['indices'].index(date)])
+    if job['dates'][job['indices'].index(date)] <= shelter_date:
+        annotation = None
+    else:
+        annotation = 'Shelter-in-place enforced'
+    return title, annotation
+
+
+def plot_aq(job, date = 0):
+    """
+    Returns RGB array of the map of interpolated AQ values for
+    single date
+    """
+    param = job['param']
+    title, annotation = frame_labels(job, date)
+    return render.render_frame(job['values'][:, job['indices'].index(date)],
+                               job['grid'],
+                               job['domain'],
+                               title,
+                               units_dict[param],
+                               annotation)
+
+
+def render_frames(job, indices):
+    """
+    Saves an image of the plot, and its encoded gif block, for each
+    date in indices. Returns {date index: date index of the frame its
+    block is a delta against, or None}
+    """
+    os.makedirs(frame_folder(job['param'])+'/blocks', exist_ok=True)
+    with stage('render', job['param'], frames=len(indices)):
+        return _render_frames(job, indices)
+
+
+def _render_frames(job, indices):
+    bases = {}
+    previous = {}
+    for i in indices:
+        filename = frame_filename(job['param'], i)
+        print("     Creating image for"+filename)
+        frame = plot_aq(job, i)
+        # Blocks are deltas against the frame before them in the
+        # series, drawn again if it isn't one just rendered, so they
+        # don't depend on how the frames were split into chunks
+        position = job['indices'].index(i)
+        if position:
+            base = job['indices'][position-1]
+            if base not in previous:
+                previous = {base: plot_aq(job, base)}
+            block = gif_stream.encode_frame(frame, previous[base])
         else:
-            annotation = alt.Chart(plot_df).mark_text(
-                align='left',
-                baseline='middle',
-                fontSize = 16,
-                dx = 65,
-                dy = -210,
-                text = 'Shelter-in-place enforced',
-                color = 'red'
-                ).encode()
-            return ((interpolated_plot + base_map + annotation)
-                .properties(title = "Bay Area Avg.{} ({}): {}".format(
-                                            param_title[param],
-                                            units_dict[param],
-                                            plot_df.loc[0,'date']),
-                            height = 450,
-                            width = 500)
-                .configure_title(fontSize = 20)
-                .configure_legend(titleFontSize=16, labelFontSize=14))
-
-    # Save image of plot for each date
-    filenames = []
-    # Create gif starting at march 1st
-    print('    Creating images')
-
-    for i in range(mar1_offset, max(interp_buffer['date_int'])+1):
-        # collect file names of images
-        filename = '../assets/img/'+param+'/'+param+'_'+str(i)+'.png'
-        filenames.append(filename)
-        # If image doesn't exist for certain date, create it
-        if not os.path.exists(filename):
-            print("     Creating image for"+filename)
-            plot_aq(i).save(filename)
-    # Merge images into gif
-    print('    Creating gif')
-    with imageio.get_writer('../assets/'+param+'.gif', 
-                            mode='I', 
-                            duration = .4, 
-                            loop = 1) as writer:
-        for filename in filenames:
-            image = imageio.imread(filename)
-            writer.append_data(image)
+            base = None
+            block = gif_stream.encode_frame(frame)
+        bases[i] = base
+        gif_stream.save_block(block, block_filename(job['param'], i))
+        render.save_frame(frame, filename)
+        previous = {i: frame}
+    return bases
+
+
+def frame_keys(job):
+    """
+    Returns {date index: cache key} of the frames of job, hashing the
+    values, color domain and style each frame is drawn from
+    """
+    param = job['param']
+    style = render.style()
+    keys = {}
+    for column, i in enumerate(job['indices']):
+        title, annotation = frame_labels(job, i)
+        keys[i] = frame_key(job['values'][:, column], job['domain'],
+                            dict(style, title=title, units=units_dict[param],
+                                 annotation=annotation))
+    return keys
+
+
+def stale_frames(job, cache):
+    """
+    Returns the cache keys of the frames of job and the date indices
+    of the frames whose key changed or that don't exist
+    """
+    with stage('frame_keys', job['param']):
+        keys = frame_keys(job)
+    filenames = {frame_filename(job['param'], i): i for i in keys}
+    stale = cache.stale({filename: keys[i] for filename, i in filenames.items()})
+    return keys, sorted(filenames[filename] for filename in stale)
+
+
+def record_frames(job, cache, keys, bases):
+    """
+    Records the keys of the rendered frames in cache, given bases as
+    returned by render_frames
+    """
+    param = job['param']
+    cache.record({frame_filename(param, i): keys[i] for i in bases},
+                 {frame_filename(param, i): None if base is None else keys[base]
+                  for i, base in bases.items()})
+    cache.save()
+
+
+def frame_chunks(job, todo, workers):
+    """
+    Splits the date indices todo of the frames of job into chunks,
+    each carrying only the dates and values it needs: those of its
+    frames and of the frames before them, which their gif blocks are
+    deltas against
+    """
+    size = min(max_chunk, max(min_chunk, -(-len(todo)//workers)))
+    for start in range(0, len(todo), size):
+        indices = todo[start:start+size]
+        columns = sorted({c for i in indices
+                          for c in (job['indices'].index(i) - 1,
+                                    job['indices'].index(i))
+                          if c >= 0})
+        yield dict(job, indices=[job['indices'][c] for c in columns],
+                   dates=[job['dates'][c] for c in columns],
+                   values=job['values'][:, columns]), indices
+
+
+def gif_filename(param):
+    return '../assets/'+param+'.gif'
+
+
+def frame_blocks(job, cache, keys, start=0):
+    """
+    Yields the encoded gif blocks of the frames of job from position
+    start on, one at a time. Blocks that are missing or a delta against
+    a frame that no longer precedes them are encoded again from the
+    pngs of the frame and the one before it.
+    """
+    param = job['param']
+    previous = None
+    for position in range(start, len(job['indices'])):
+        i = job['indices'][position]
+        base = keys[job['indices'][position-1]] if position else None
+        filename = block_filename(param, i)
+        if cache.block_valid(frame_filename(param, i), base):
+            try:
+                yield gif_stream.read_block(filename)
+                previous = None
+                continue
+            except FileNotFoundError:
+                pass
+        frame = render.load_frame(frame_filename(param, i))
+        if position and previous is None:
+            previous = render.load_frame(
+                frame_filename(param, job['indices'][position-1]))
+        block = gif_stream.encode_frame(frame, previous)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        gif_stream.save_block(block, filename)
+        cache.record_blocks({frame_filename(param, i): base})
+        previous = frame
+        yield block
+
+
+def make_gif(job, cache, keys):
+    """
+    Brings the gif of job up to date from the cached frame blocks,
+    appending the new frames if the ones it holds are unchanged, and
+    copies the still (first in series) to the assets folder
+    """
+    with stage('gif', job['param']):
+        _make_gif(job, cache, keys)
+
+
+def _make_gif(job, cache, keys):
+    param = job['param']
+    filename = gif_filename(param)
+    style = {'duration': gif_duration, 'loop': gif_loop}
+    frames = [keys[i] for i in job['indices']]
     # Copy still (first in series) to img folder (to render in app)
-    shutil.copy('../assets/img/'+param+'/'+param+'_'+str(mar1_offset)+'.png',
+    shutil.copy(frame_filename(param, job['indices'][0]),
                 '../assets/'+param+'_'+str(mar1_offset)+'.png')
-print('All finished!!!')
\ No newline at end of file
+    done = cache.gif_frames(style, filename)
+    if done == frames:
+        print('    Gif for '+param+' is up to date')
+        return
+    if done and frames[:len(done)] == done:
+        print('    Appending {} frames to gif for {}'.format(len(frames) - len(done),
+                                                           param))
+        # Mark the gif incomplete until the new frames are in
+        cache.record_gif(done, None)
+        cache.save()
+        gif_stream.append_gif(filename,
+                              frame_blocks(job, cache, keys, len(done)),
+                              gif_duration)
+    else:
+        print('    Creating gif for '+param)
+        gif_stream.write_gif(filename,
+                             frame_blocks(job, cache, keys),
+                             (render.CANVAS[1], render.CANVAS[0]),
+                             gif_duration,
+                             gif_loop)
+    cache.record_gif(frames, style)
+    cache.save()
+
+
+def run_serial(store, updates, sites_wr, windows, export_csv=False,
+               chunked=False, tile_zoom=tiles.EAGER_ZOOM, gif=True):
+    """
+    Processes each pollutant of updates ({param: set of the dates whose
+    observations changed, or None to process every date}) one after
+    another, returning a dict of failed pollutants to their error.
+    Without gif, the map frames and gifs are left as they are.
+    """
+    failures = {}
+    for param, changed in updates.items():
+        try:
+            job = process_pollutant(param, store, sites_wr, windows, export_csv,
+                                    chunked, tile_zoom, changed)
+            if not gif:
+                continue
+            cache = FrameCache(frame_folder(param))
+            keys, todo = stale_frames(job, cache)
+            print('    Creating {} of {} images'.format(len(todo), len(keys)))
+            for chunk, indices in frame_chunks(job, todo, 1):
+                record_frames(job, cache, keys, render_frames(chunk, indices))
+            make_gif(job, cache, keys)
+        except Exception:
+            failures[param] = traceback.format_exc()
+    return failures
+
+
+def run_parallel(store, updates, sites_wr, windows, workers, export_csv=False,
+                 chunked=False, tile_zoom=tiles.EAGER_ZOOM, gif=True):
+    """
+    Processes the pollutants of updates (as run_serial takes them) in a
+    pool of worker processes, fanning out first across pollutants and
+    then across chunks of frames. Returns
+    a dict of failed pollutants to their error. The workers' stage
+    records are added to the current run report. Without gif, the map
+    frames and gifs are left as they are.
+    """
+    failures = {}
+    report = run_report.current
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        processing = {param: pool.submit(run_report.collect, report.enabled,
+                                         process_pollutant, param, store,
+                                         sites_wr, windows, export_csv, chunked,
+                                         tile_zoom, changed)
+                      for param, changed in updates.items()}
+        jobs = {}
+        frames = {}
+        rendering = {}
+        for param, future in processing.items():
+            try:
+                job, records = future.result()
+                jobs[param] = job
+                report.add(records)
+                if not gif:
+                    continue
+                cache = FrameCache(frame_folder(param))
+                keys, todo = stale_frames(job, cache)
+            except Exception:
+                failures[param] = traceback.format_exc()
+                continue
+            print('    Creating {} of {} images for {}'.format(len(todo),
+                                                              len(keys), param))
+            frames[param] = cache, keys
+            rendering[param] = [pool.submit(run_report.collect, report.enabled,
+                                            render_frames, chunk, indices)
+                                for chunk, indices in frame_chunks(job, todo,
+                                                                   workers)]
+        for param, futures in rendering.items():
+            cache, keys = frames[param]
+            try:
+                for future in futures:
+                    bases, records = future.result()
+                    report.add(records)
+                    record_frames(jobs[param], cache, keys, bases)
+                make_gif(jobs[param], cache, keys)
+            except Exception:
+                failures[param] = traceback.format_exc()
+    return failures
+
+
+def reload_app(pidfile):
+    """
+    Signals the gunicorn master whose pid is in pidfile to reload the
+    data and replace its workers (see gunicorn.conf.py). Returns False
+    if there is no such process.
+    """
+    try:
+        with open(pidfile) as f:
+            os.kill(int(f.read().strip()), signal.SIGHUP)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Create the air quality app content from CARB data')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes (default 1, serial)')
+    parser.add_argument('--revision-days', type=int, default=7,
+                        help='number of already stored days to download '
+                             'again for late-screened values (default 7)')
+    parser.add_argument('--base-url', default=fetch.BASE_URL,
+                        help='url of the CARB report (default %(default)s)')
+    parser.add_argument('--timeout', type=float, default=fetch.TIMEOUT[1],
+                        help='seconds to wait for a CARB report (default '
+                             '%(default)s)')
+    parser.add_argument('--retries', type=int, default=fetch.RETRIES,
+                        help='times to retry a failed download (default '
+                             '%(default)s)')
+    parser.add_argument('--export-csv', action='store_true',
+                        help='also write the interpolated values to '
+                             '*_interpolated.csv')
+    parser.add_argument('--windows', default=window_stats.windows_path(),
+                        help='json file of the intervention windows to '
+                             'compute statistics over (default %(default)s)')
+    parser.add_argument('--chunked', action='store_true',
+                        help='read and interpolate the observations one '
+                             'month at a time, bounding memory use for long '
+                             'histories')
+    parser.add_argument('--tile-zoom', type=int, default=tiles.EAGER_ZOOM,
+                        help='build the map tiles of zoom levels {} to '
+                             'TILE_ZOOM ahead of requests (default '
+                             '%(default)s; finer levels are rendered by the '
+                             'app on request)'.format(tiles.MIN_ZOOM))
+    parser.add_argument('--no-gif', dest='gif', action='store_false',
+                        help="skip drawing the map frames and gifs (the app "
+                             "animates the grid store's values itself)")
+    parser.add_argument('--report', metavar='PATH',
+                        help='write the wall time, CPU time and peak memory '
+                             'of each stage per pollutant to PATH as JSON')
+    parser.add_argument('--full', action='store_true',
+                        help='interpolate every date again, not only the '
+                             'ones whose observations changed')
+    parser.add_argument('--reload', metavar='PIDFILE',
+                        help='when done, signal the gunicorn master whose '
+                             'pid is in PIDFILE to reload the refreshed data '
+                             '(see gunicorn.conf.py)')
+    args = parser.parse_args(argv)
+    report = run_report.current = run_report.RunReport(enabled=bool(args.report))
+
+    sites_wr = load_sites()
+    windows = window_stats.load_windows(args.windows)
+    store = fetch.RawStore()
+
+    # Simplified county layers, for the map frames and the app
+    with stage('counties'):
+        topology.build_layers()
+
+    # Download new data for all pollutants concurrently
+    updates, failures = fetch.fetch_all(pollutants, first_date, store,
+                                        revision_days=args.revision_days,
+                                        base_url=args.base_url,
+                                        timeout=(fetch.TIMEOUT[0], args.timeout),
+                                        retries=args.retries)
+    if args.full:
+        updates = dict.fromkeys(updates)
+
+    if args.workers > 1:
+        failures.update(run_parallel(store, updates, sites_wr, windows,
+                                     args.workers, args.export_csv,
+                                     args.chunked, args.tile_zoom, args.gif))
+    else:
+        failures.update(run_serial(store, updates, sites_wr, windows,
+                                   args.export_csv, args.chunked,
+                                   args.tile_zoom, args.gif))
+
+    for param in pollutants:
+        if param in failures:
+            print('Failed to create content for '+param+':\n'+failures[param])
+    if args.report:
+        report.save(args.report, argv=sys.argv[1:] if argv is None else argv,
+                    workers=args.workers, chunked=args.chunked,
+                    failures=failures)
+    if args.reload and any(changed is None or changed
+                           for changed in updates.values()):
+        if not reload_app(args.reload):
+            print('No gunicorn master to reload in '+args.reload)
+    if failures:
+        return 1
+    print('All finished!!!')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
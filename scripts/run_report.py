@@ -0,0 +1,167 @@
+"""
+Per-stage timing and memory instrumentation for run_all.py.
+
+Code marks its stages with
+
+    with run_report.stage('interpolate', param):
+        ...
+
+When reporting is enabled each stage records its wall time, the CPU
+time of the thread running it and the peak memory traced (by
+tracemalloc, which numpy reports its arrays to) while it ran, above
+what was traced when it started. When it is disabled, stage() does
+nothing and tracing stays off, so the cost is a function call per
+stage.
+
+tracemalloc keeps a single, process-wide peak, which stages restart
+when they begin and end. Before restarting it the peak so far is
+folded into every running stage, so nested stages and stages running
+concurrently in threads (the downloads) don't lose each other's
+peaks; the peak of overlapping stages includes the memory of both.
+Restarting the peak needs Python 3.9 (tracemalloc.reset_peak), so on
+older versions stages record a peak_bytes of None.
+
+Stages run in worker processes are recorded by running the work
+through collect(), which returns the records made along with the
+result so the main process can add them to its report.
+"""
+
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+class RunReport:
+    """
+    The stage records of a run, written as JSON by save()
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+        self.started = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+        self._cpu = time.process_time()
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def add(self, records):
+        self.records.extend(records)
+
+    def totals(self):
+        """
+        Returns {param: {stage: total wall time}} of the records
+        """
+        totals = {}
+        for record in self.records:
+            stages = totals.setdefault(record['param'] or 'all', {})
+            stages[record['stage']] = stages.get(record['stage'], 0) + record['wall']
+        return totals
+
+    def save(self, path, **info):
+        """
+        Writes the report, with the run-wide numbers and info, to path
+        """
+        report = dict(info,
+                      started=self.started.isoformat(timespec='seconds'),
+                      wall=time.perf_counter() - self._start,
+                      cpu=time.process_time() - self._cpu,
+                      # Peak resident memory of this process, in bytes
+                      max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                              * (1 if sys.platform == 'darwin' else 1024),
+                      python=platform.python_version(),
+                      cpus=os.cpu_count(),
+                      totals=self.totals(),
+                      stages=self.records)
+        with open(path+'.tmp', 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(path+'.tmp', path)
+
+
+# Report the stages of this process are recorded in
+current = RunReport()
+
+
+class _Peak:
+    """
+    Traced memory when a running stage started and the peak since
+    """
+
+    __slots__ = ('base', 'peak')
+
+    def __init__(self, base):
+        self.base = self.peak = base
+
+
+# Running stages of this process
+_running = set()
+_running_lock = threading.Lock()
+
+
+def _fold_peak():
+    """
+    Folds the peak traced since the last restart into the running
+    stages and restarts it
+    """
+    peak = tracemalloc.get_traced_memory()[1]
+    for running in _running:
+        running.peak = max(running.peak, peak)
+    tracemalloc.reset_peak()
+
+
+@contextmanager
+def stage(name, param=None, **info):
+    """
+    Records the wall time, thread CPU time and peak traced memory of
+    the block as stage name of param in the current report, along with
+    info
+    """
+    report = current
+    if not report.enabled:
+        yield
+        return
+    tracked = hasattr(tracemalloc, 'reset_peak')
+    if tracked:
+        with _running_lock:
+            _fold_peak()
+            peak = _Peak(tracemalloc.get_traced_memory()[0])
+            _running.add(peak)
+    start = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        peak_bytes = None
+        if tracked:
+            with _running_lock:
+                _fold_peak()
+                _running.discard(peak)
+            peak_bytes = peak.peak - peak.base
+        report.records.append(dict(info,
+                                   param=param,
+                                   stage=name,
+                                   pid=os.getpid(),
+                                   wall=time.perf_counter() - start,
+                                   cpu=time.thread_time() - cpu,
+                                   peak_bytes=peak_bytes))
+
+
+def collect(enabled, fn, *args, **kwargs):
+    """
+    Returns the result of fn(*args, **kwargs) and the stage records
+    it made, for calls run in worker processes
+    """
+    global current
+    outer = current
+    current = RunReport(enabled)
+    try:
+        return fn(*args, **kwargs), current.records
+    finally:
+        current = outer
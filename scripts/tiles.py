@@ -0,0 +1,300 @@
+"""
+XYZ tile pyramid of the interpolated surface.
+
+Tiles are 256x256 PNGs addressed z/x/y in the web mercator scheme
+online maps use. Each pixel is interpolated from the station values of
+its date over the same Delaunay triangulation as the grid (both kept in
+the grid store), so every zoom level shows the surface at its own
+resolution instead of the 0.05 degree grid scaled up. Colors follow
+the map frames' scale and fixed domain; pixels outside the stations'
+hull are transparent.
+
+Tiles are cached on disk as <root>/<param>/<key>/<z>/<x>/<y>.png, where
+key hashes everything the tiles of a date are drawn from, so they are
+reused until the values of their date change. run_all.py builds the
+coarse levels (up to EAGER_ZOOM) of every date and removes the tiles of
+replaced values; the app renders finer levels on first request and
+keeps them, with the pixel weights of their positions, in a TileMemory
+of bounded size, so requests can't fill the disk or the memory.
+"""
+
+import hashlib
+import io
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+import render
+
+TILE = 256
+
+# Zoom levels served, and the ones run_all.py builds ahead of requests
+MIN_ZOOM = 7
+EAGER_ZOOM = 8
+MAX_ZOOM = 13
+
+# Bump when a change to the drawing code alters the tiles
+TILE_VERSION = 1
+
+# Megabytes of tiles rendered on request, and of their pixel weights,
+# each app worker keeps
+MEMORY_MB = 64
+
+# Tile positions whose pixel weights run_all.py keeps while building
+BUILD_WEIGHTS = 4
+
+
+def tile_root(root='../data'):
+    return os.path.join(root, 'tiles')
+
+
+def tile_bounds(z, x, y):
+    """
+    Returns the (west, south, east, north) lon/lat bounds of a tile
+    """
+    n = 2**z
+    north = np.degrees(np.arctan(np.sinh(np.pi*(1 - 2*y/n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi*(1 - 2*(y + 1)/n))))
+    return x/n*360 - 180, south, (x + 1)/n*360 - 180, north
+
+
+def pixel_lonlat(z, x, y):
+    """
+    Returns the (TILE x TILE) lon and lat arrays of the centers of the
+    pixels of a tile
+    """
+    n = 2**z
+    offset = (np.arange(TILE) + .5)/TILE
+    lon = (x + offset)/n*360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi*(1 - 2*(y + offset)/n))))
+    return np.meshgrid(lon, lat)
+
+
+def tile_index(lon, lat, z):
+    """
+    Returns the x, y of the tile at zoom z holding lon, lat
+    """
+    n = 2**z
+    x = int((lon + 180)/360*n)
+    y = int((1 - np.arcsinh(np.tan(np.radians(lat)))/np.pi)/2*n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def covering(bounds, z):
+    """
+    Returns the (x, y) of the tiles at zoom z covering the
+    (west, south, east, north) bounds
+    """
+    x0, y0 = tile_index(bounds[0], bounds[3], z)
+    x1, y1 = tile_index(bounds[2], bounds[1], z)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def pixel_weights(points, triangles, lon, lat):
+    """
+    Returns, for every pixel at lon, lat, the indices of the 3
+    stations of the triangle it falls in and its barycentric weights,
+    with indices of -1 outside the triangulation
+    """
+    xy = np.column_stack([lon.ravel(), lat.ravel()])
+    index = np.full((len(xy), 3), -1, dtype='int32')
+    weights = np.zeros((len(xy), 3))
+    low, high = xy.min(axis=0), xy.max(axis=0)
+    for triangle in triangles:
+        a, b, c = points[triangle]
+        corners = np.array([a, b, c])
+        # Skip triangles off the tile
+        if np.any(corners.max(axis=0) < low) or np.any(corners.min(axis=0) > high):
+            continue
+        v0, v1 = b - a, c - a
+        det = v0[0]*v1[1] - v0[1]*v1[0]
+        d = xy - a
+        l1 = (d[:, 0]*v1[1] - d[:, 1]*v1[0])/det
+        l2 = (v0[0]*d[:, 1] - v0[1]*d[:, 0])/det
+        inside = ((l1 >= -1e-12) & (l2 >= -1e-12) & (l1 + l2 <= 1 + 1e-12)
+                  & (index[:, 0] < 0))
+        index[inside] = triangle
+        weights[inside] = np.column_stack([1 - l1 - l2, l1, l2])[inside]
+    return index, weights
+
+
+def encode_png(rgba):
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+# Tile outside the surface
+EMPTY = encode_png(np.zeros((TILE, TILE, 4), dtype='uint8'))
+
+
+class TileMemory:
+    """
+    Tiles rendered on request and the pixel weights they were rendered
+    with, evicted least recently used first once their bytes are over
+    budget_mb
+    """
+
+    def __init__(self, budget_mb=MEMORY_MB):
+        self.budget = budget_mb*2**20
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        """
+        Keeps value, of size bytes, under key. Values larger than the
+        whole budget aren't kept.
+        """
+        with self._lock:
+            if key in self._entries or size > self.budget:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.budget:
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SurfaceTiles:
+    """
+    Renders and caches the tiles of the grid store of a pollutant
+    (a GridStore written with its stations). Tiles not on disk are
+    written there, or kept in memory (a TileMemory) if one is given.
+    """
+
+    def __init__(self, store, root=tile_root(), memory=None):
+        self.store = store
+        self.root = os.path.join(root, store.param)
+        self.memory = memory
+        self.points = np.asarray(store.stations['points'], dtype='float64')
+        self.triangles = np.asarray(store.stations['triangles'], dtype='int64')
+        self.domain = store.value_range()
+        self.bounds = (*self.points.min(axis=0), *self.points.max(axis=0))
+        self._hash = hashlib.sha1(repr((TILE_VERSION, render.YELLOWORANGEBROWN,
+                                        self.domain)).encode())
+        self._hash.update(self.points.tobytes())
+        self._hash.update(self.triangles.tobytes())
+        self._triangulation = self._hash.hexdigest()
+        self._build_weights = lru_cache(maxsize=BUILD_WEIGHTS)(self._weights)
+
+    def key(self, row):
+        """
+        Returns the cache key of the tiles of the date at row
+        """
+        h = self._hash.copy()
+        h.update(np.ascontiguousarray(self.store.station_values[row]).tobytes())
+        return h.hexdigest()[:16]
+
+    def path(self, key, z, x, y):
+        return os.path.join(self.root, key, str(z), str(x), str(y)+'.png')
+
+    def covers(self, z, x, y):
+        west, south, east, north = tile_bounds(z, x, y)
+        return not (east < self.bounds[0] or west > self.bounds[2]
+                    or north < self.bounds[1] or south > self.bounds[3])
+
+    def _weights(self, z, x, y):
+        return pixel_weights(self.points, self.triangles, *pixel_lonlat(z, x, y))
+
+    def weights(self, z, x, y):
+        """
+        Returns the pixel weights of a tile position, kept in memory if
+        there is one
+        """
+        if self.memory is None:
+            return self._build_weights(z, x, y)
+        key = ('weights', self._triangulation, z, x, y)
+        weights = self.memory.get(key)
+        if weights is None:
+            weights = self._weights(z, x, y)
+            self.memory.put(key, weights, weights[0].nbytes + weights[1].nbytes)
+        return weights
+
+    def render(self, row, z, x, y):
+        """
+        Returns the PNG of a tile of the date at row
+        """
+        index, weights = self.weights(z, x, y)
+        station = np.asarray(self.store.station_values[row], dtype='float64')
+        values = (station[index]*weights).sum(axis=1)
+        values[index[:, 0] < 0] = np.nan
+        rgba = np.empty((TILE*TILE, 4), dtype='uint8')
+        rgba[:, :3] = render.colorize(values, self.domain)
+        rgba[:, 3] = np.where(np.isnan(values), 0, 255)
+        return encode_png(rgba.reshape(TILE, TILE, 4))
+
+    def tile(self, date, z, x, y):
+        """
+        Returns the PNG of a tile of date (an iso string or row) and
+        its cache key, rendering and caching it if it isn't cached.
+        Raises KeyError for dates and ValueError for zoom levels that
+        aren't served.
+        """
+        if not MIN_ZOOM <= z <= MAX_ZOOM or not (0 <= x < 2**z and 0 <= y < 2**z):
+            raise ValueError('no tile {}/{}/{}'.format(z, x, y))
+        row = self.store.date_index(date)
+        key = self.key(row)
+        if not self.covers(z, x, y):
+            return EMPTY, key
+        path = self.path(key, z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                return f.read(), key
+        except FileNotFoundError:
+            pass
+        if self.memory is not None:
+            png = self.memory.get(path)
+            if png is None:
+                png = self.render(row, z, x, y)
+                self.memory.put(path, png, len(png))
+            return png, key
+        png = self.render(row, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), id(png))
+        with open(tmp, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, path)
+        return png, key
+
+    def build(self, zooms):
+        """
+        Caches the tiles of every date at zooms that aren't cached yet,
+        one tile position at a time so its pixel weights are computed
+        once. Returns the number of tiles rendered.
+        """
+        keys = [self.key(row) for row in range(len(self.store.dates))]
+        rendered = 0
+        for z in zooms:
+            for x, y in covering(self.bounds, z):
+                for row, key in enumerate(keys):
+                    if not os.path.exists(self.path(key, z, x, y)):
+                        self.tile(row, z, x, y)
+                        rendered += 1
+                self._build_weights.cache_clear()
+        return rendered
+
+    def prune(self):
+        """
+        Removes the cached tiles of values no longer in the store
+        """
+        keep = {self.key(row) for row in range(len(self.store.dates))}
+        if os.path.isdir(self.root):
+            for key in os.listdir(self.root):
+                if key not in keep:
+                    shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
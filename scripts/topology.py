@@ -0,0 +1,257 @@
+"""
+Simplified TopoJSON layers of the Bay Area county borders.
+
+The county GeoJSON is converted to a TopoJSON topology: every ring is
+cut where it meets another ring's border, and each shared border is
+stored once as an arc referenced by both counties. Arcs are simplified
+with Douglas-Peucker, their end points kept, so neighboring counties
+are simplified identically and stay seamless. Coordinates are then
+quantized onto an integer grid and delta-encoded.
+
+build_layers() writes one layer per level of LEVELS to
+data/wrangled/counties_<level>.topojson, recording the hash of the
+source they were built from; counties_layer() returns the path of a
+layer, building the layers first if the source changed. The app serves
+the layers by url and the map frames draw them from the same files.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+COUNTIES = '../data/raw/Bay_Area_Counties.geojson'
+
+# Simplification tolerance of each layer, in degrees
+LEVELS = {'full': 0, 'fine': .0002, 'medium': .001, 'coarse': .004}
+
+# Integer grid coordinates are quantized onto, per axis
+QUANTIZATION = 100000
+
+# Bump when a change to the building code alters the layers
+TOPOLOGY_VERSION = 1
+
+
+def layer_path(level, root='../data/wrangled'):
+    return os.path.join(root, 'counties_'+level+'.topojson')
+
+
+def _rings(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    return []
+
+
+def junctions(rings):
+    """
+    Returns the set of points where rings (lists of (lon, lat) tuples,
+    not closed) meet with different neighbors, i.e. where a shared
+    border starts or ends
+    """
+    neighbors = {}
+    found = set()
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            pair = frozenset((ring[i - 1], ring[(i + 1) % n]))
+            seen = neighbors.setdefault(point, pair)
+            if seen != pair:
+                found.add(point)
+    return found
+
+
+def cut(ring, junction):
+    """
+    Returns the arcs of ring (a list of points, not closed), split at
+    the points in junction. A ring without junctions is one closed arc
+    starting at its smallest point, so equal rings give equal arcs.
+    """
+    starts = [i for i, point in enumerate(ring) if point in junction]
+    if not starts:
+        start = ring.index(min(ring))
+        ring = ring[start:] + ring[:start]
+        return [ring + ring[:1]]
+    ring = ring[starts[0]:] + ring[:starts[0]]
+    offsets = [i - starts[0] for i in starts] + [len(ring)]
+    closed = ring + ring[:1]
+    return [closed[a:b + 1] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def douglas_peucker(points, tolerance):
+    """
+    Returns the indices of the points of a (n x 2) array kept by
+    Douglas-Peucker simplification within tolerance, end points
+    included
+    """
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b = points[first], points[last]
+        inner = points[first + 1:last]
+        ab = b - a
+        length = np.hypot(*ab)
+        if length == 0:
+            distance = np.hypot(*(inner - a).T)
+        else:
+            distance = np.abs(ab[0]*(inner[:, 1] - a[1])
+                              - ab[1]*(inner[:, 0] - a[0]))/length
+        k = int(np.argmax(distance))
+        if distance[k] > tolerance:
+            keep[first + 1 + k] = True
+            stack.extend([(first, first + 1 + k), (first + 1 + k, last)])
+    return np.flatnonzero(keep)
+
+
+def simplify(arc, tolerance):
+    """
+    Returns the (n x 2) arc simplified within tolerance. Closed arcs
+    (whole rings) keep at least 4 points so they stay rings.
+    """
+    if tolerance <= 0 or len(arc) < 3:
+        return arc
+    if not np.array_equal(arc[0], arc[-1]):
+        return arc[douglas_peucker(arc, tolerance)]
+    # Split a closed arc at its farthest point from the start, and keep
+    # a point of each half besides its ends
+    far = int(np.argmax(np.hypot(*(arc - arc[0]).T)))
+    halves = []
+    for half in (arc[:far + 1], arc[far:]):
+        kept = douglas_peucker(half, tolerance)
+        if len(kept) == 2 and len(half) > 2:
+            kept = np.r_[0, len(half)//2, len(half) - 1]
+        halves.append(half[kept])
+    return np.concatenate([halves[0], halves[1][1:]])
+
+
+def topology(features, tolerance=0, quantization=QUANTIZATION):
+    """
+    Returns the TopoJSON topology of the polygon features (GeoJSON
+    feature dicts), with arcs simplified within tolerance, as a dict
+    holding one 'counties' GeometryCollection
+    """
+    polygons = [[[[tuple(point[:2]) for point in ring[:-1]] for ring in polygon]
+                 for polygon in _rings(feature['geometry'])]
+                for feature in features]
+    junction = junctions([ring for feature in polygons for polygon in feature
+                          for ring in polygon])
+
+    # Shared arcs are stored once; a ring traversing one backwards
+    # refers to it as ~index
+    arcs = []
+    index = {}
+
+    def arc_index(arc):
+        key = tuple(arc)
+        if key not in index:
+            reverse = key[::-1]
+            if reverse in index:
+                return ~index[reverse]
+            index[key] = len(arcs)
+            arcs.append(arc)
+        return index[key]
+
+    geometries = []
+    for feature, geometry in zip(features, polygons):
+        geometries.append({'type': 'MultiPolygon',
+                           'properties': feature.get('properties') or {},
+                           'arcs': [[[arc_index(arc) for arc in cut(ring, junction)]
+                                     for ring in polygon]
+                                    for polygon in geometry]})
+
+    points = np.array([point for arc in arcs for point in arc], dtype='float64')
+    low, high = points.min(axis=0), points.max(axis=0)
+    scale = (high - low)/(quantization - 1)
+    encoded = []
+    for arc in arcs:
+        q = np.round((simplify(np.array(arc, dtype='float64'), tolerance) - low)
+                     /scale).astype('int64')
+        # Drop the points quantized onto their predecessor
+        q = q[np.r_[True, np.any(np.diff(q, axis=0) != 0, axis=1)]]
+        if len(q) < 2:
+            q = np.repeat(q, 2, axis=0)
+        encoded.append(np.vstack([q[:1], np.diff(q, axis=0)]).tolist())
+    return {'type': 'Topology',
+            'bbox': [*low.tolist(), *high.tolist()],
+            'transform': {'scale': scale.tolist(), 'translate': low.tolist()},
+            'objects': {'counties': {'type': 'GeometryCollection',
+                                     'geometries': geometries}},
+            'arcs': encoded}
+
+
+def decode_arcs(topo):
+    """
+    Returns the arcs of a quantized topology as (n x 2) lon/lat arrays
+    """
+    scale = np.array(topo['transform']['scale'])
+    translate = np.array(topo['transform']['translate'])
+    return [np.cumsum(np.array(arc, dtype='float64'), axis=0)*scale + translate
+            for arc in topo['arcs']]
+
+
+def rings(topo, name='counties'):
+    """
+    Returns the rings of the geometries of object name in topo as a
+    list of closed (n x 2) lon/lat arrays
+    """
+    arcs = decode_arcs(topo)
+    result = []
+    for geometry in topo['objects'][name]['geometries']:
+        for polygon in geometry['arcs']:
+            for ring in polygon:
+                parts = [arcs[i] if i >= 0 else arcs[~i][::-1] for i in ring]
+                result.append(np.concatenate([parts[0]] + [p[1:] for p in parts[1:]]))
+    return result
+
+
+def source_hash(source):
+    h = hashlib.sha1(repr((TOPOLOGY_VERSION, LEVELS, QUANTIZATION)).encode())
+    with open(source, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def _built_from(path):
+    try:
+        with open(path) as f:
+            return json.load(f).get('source')
+    except (OSError, ValueError):
+        return None
+
+
+def build_layers(source=COUNTIES, root='../data/wrangled', force=False):
+    """
+    Writes the layer of every level of the county borders in source
+    under root, unless they were already built from it. Returns
+    {level: path}.
+    """
+    paths = {level: layer_path(level, root) for level in LEVELS}
+    digest = source_hash(source)
+    if not force and all(_built_from(p) == digest for p in paths.values()):
+        return paths
+    with open(source) as f:
+        features = json.load(f)['features']
+    for level, tolerance in LEVELS.items():
+        topo = dict(topology(features, tolerance), source=digest)
+        with open(paths[level]+'.tmp', 'w') as f:
+            json.dump(topo, f, separators=(',', ':'))
+        os.replace(paths[level]+'.tmp', paths[level])
+    return paths
+
+
+def counties_layer(level, source=COUNTIES, root='../data/wrangled'):
+    """
+    Returns the path of the layer of level, built from source if it
+    is missing or stale
+    """
+    path = layer_path(level, root)
+    if _built_from(path) != source_hash(source):
+        build_layers(source, root, force=True)
+    return path
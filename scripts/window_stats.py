@@ -0,0 +1,125 @@
+"""
+Statistics of the daily station values over intervention windows.
+
+Windows (e.g. the weeks before and after the shelter in place order,
+reopening phases, holidays) are configured in
+data/raw/intervention_windows.json as a list of
+
+    {"name": "Post-Shelter in place", "start": "2020-03-17", "end": null,
+     "default": true}
+
+with inclusive iso dates; a null start or end leaves the window open on
+that side, and default marks the windows the app overlays first.
+Windows may overlap.
+
+For every window, and for all dates, window_stats() computes the mean
+of all station values, the weekday and weekend means and the mean per
+station, in one grouped pass over the rows. The results are written
+once per pollutant to data/wrangled/<param>_windows.json, which the app
+reads to overlay any window.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def windows_path(root='../data/raw'):
+    return os.path.join(root, 'intervention_windows.json')
+
+
+def stats_path(param, root='../data/wrangled'):
+    return os.path.join(root, param+'_windows.json')
+
+
+def load_windows(path):
+    """
+    Returns the list of windows configured in path
+    """
+    with open(path) as f:
+        windows = json.load(f)
+    for w in windows:
+        if not w.get('name'):
+            raise ValueError('window without a name in '+path)
+        for bound in ('start', 'end'):
+            if w.get(bound) is not None:
+                pd.Timestamp(w[bound])
+    return windows
+
+
+def membership(dates, windows):
+    """
+    Returns the boolean (dates x windows) array flagging the dates
+    (datetime64) that fall within each window
+    """
+    dates = np.asarray(dates, dtype='datetime64[ns]')[:, None]
+    start = pd.to_datetime([w.get('start') for w in windows]).values[None]
+    end = pd.to_datetime([w.get('end') for w in windows]).values[None]
+    return ((np.isnat(start) | (dates >= start))
+            & (np.isnat(end) | (dates <= end)))
+
+
+def _means(sums, counts):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums/counts
+    return [None if np.isnan(m) else round(float(m), 8) for m in np.ravel(means)]
+
+
+def window_stats(line_df, param, windows):
+    """
+    Returns the statistics of the daily values of param in line_df
+    (with 'name' and 'date' columns) over windows, as a JSON
+    serializable dict
+    """
+    dates = pd.DatetimeIndex(pd.to_datetime(line_df['date']))
+    station = pd.Categorical(line_df['name'])
+    values = line_df[param].to_numpy(dtype='float64')
+    nstations = len(station.categories)
+    # Column 0 holds every date, the windows follow
+    member = np.column_stack([np.ones(len(dates), dtype=bool),
+                              membership(dates, windows)])
+    nwindows = member.shape[1]
+    # Group of each row: station and day type (0 weekday, 1 weekend)
+    group = station.codes.astype('int64')*2 + (dates.dayofweek >= 5)
+    # Sum and count every (station, day type, window) in one pass
+    row, column = np.nonzero(member)
+    index = group[row]*nwindows + column
+    size = nstations*2*nwindows
+    sums = np.bincount(index, weights=values[row], minlength=size)
+    counts = np.bincount(index, minlength=size)
+    sums = sums.reshape(nstations, 2, nwindows)
+    counts = counts.reshape(nstations, 2, nwindows)
+
+    mean = _means(sums.sum(axis=(0, 1)), counts.sum(axis=(0, 1)))
+    weekday = _means(sums[:, 0].sum(axis=0), counts[:, 0].sum(axis=0))
+    weekend = _means(sums[:, 1].sum(axis=0), counts[:, 1].sum(axis=0))
+    count = counts.sum(axis=(0, 1))
+    by_station = np.array(_means(sums.sum(axis=1), counts.sum(axis=1)),
+                          dtype=object).reshape(nstations, nwindows)
+
+    def summary(i):
+        return {'count': int(count[i]),
+                'mean': mean[i],
+                'weekday': weekday[i],
+                'weekend': weekend[i],
+                'stations': list(by_station[:, i])}
+
+    return {'param': param,
+            'first': dates.min().strftime('%Y-%m-%d') if len(dates) else None,
+            'last': dates.max().strftime('%Y-%m-%d') if len(dates) else None,
+            'stations': [str(s) for s in station.categories],
+            'all': summary(0),
+            'windows': [dict(w, **summary(i + 1)) for i, w in enumerate(windows)]}
+
+
+def write_window_stats(path, stats):
+    with open(path+'.tmp', 'w') as f:
+        json.dump(stats, f, separators=(',', ':'))
+    os.replace(path+'.tmp', path)
+
+
+def read_window_stats(path):
+    with open(path) as f:
+        return json.load(f)
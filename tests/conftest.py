@@ -0,0 +1,113 @@
+"""
+Shared fixtures: temporary copies of the repository layout for the
+pipeline to write to, and synthetic CARB observations.
+
+The pipeline scripts use paths relative to the scripts folder
+(../data/..., ../assets/...), so tests that run them change into the
+scripts folder of a workspace.
+"""
+
+import os
+import shutil
+import sys
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+sys.path.insert(0, ROOT)
+
+import fetch
+import run_all
+import window_stats
+
+RAW = ['Bay_Area_Counties.geojson', 'PM25HR_SITELIST_2020-12-31.csv',
+       'intervention_windows.json']
+
+
+def make_workspace(path):
+    """
+    Lays out the repository's data and assets folders under path, with
+    the raw inputs and county layers, and returns its scripts folder
+    """
+    for folder in ['scripts', 'data/raw', 'data/wrangled', 'assets/img']:
+        os.makedirs(os.path.join(path, folder), exist_ok=True)
+    for name in RAW:
+        shutil.copy(os.path.join(ROOT, 'data/raw', name),
+                    os.path.join(path, 'data/raw'))
+    for name in os.listdir(os.path.join(ROOT, 'data/wrangled')):
+        if name.endswith('.topojson'):
+            shutil.copy(os.path.join(ROOT, 'data/wrangled', name),
+                        os.path.join(path, 'data/wrangled'))
+    return os.path.join(path, 'scripts')
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """
+    A temporary copy of the repository layout; the test runs in its
+    scripts folder
+    """
+    monkeypatch.chdir(make_workspace(str(tmp_path)))
+    return tmp_path
+
+
+def observations(param, sites, start, end, hours=(0, 6, 12, 18), drop=.05):
+    """
+    Returns a df of hourly observations of param at sites (site ids)
+    from start to end (iso dates), with the columns of a CARB report.
+    Values depend only on param, site and date, so overlapping date
+    ranges agree.
+    """
+    rows = []
+    for site in sites:
+        level = np.random.default_rng(zlib.crc32((param+site).encode())).uniform(2, 12)
+        for day in pd.date_range(start, end).strftime('%Y-%m-%d'):
+            rng = np.random.default_rng(zlib.crc32((param+site+day).encode()))
+            if rng.uniform() < drop:
+                continue
+            for hour in hours:
+                rows.append((site, day, hour, round(level + rng.normal(), 3),
+                             param, 'x', 0, 'N', 'Station '+site))
+    return pd.DataFrame(rows, columns=['site', 'date', 'start_hour', 'value',
+                                       'variable', 'units', 'quality',
+                                       'prelim', 'name'])
+
+
+def report(aq_data):
+    """
+    Returns aq_data as the text of a CARB csv report, footer included
+    """
+    return aq_data.to_csv(index=False)+'Quality Flag Definition\n'
+
+
+def pipeline_inputs(param, end, skip=()):
+    """
+    Stores the observations of param from run_all.first_date to end,
+    but for the dates in skip, in the workspace's raw store, and
+    returns the store, sites and windows the run_* functions take
+    """
+    sites_wr = run_all.load_sites()
+    aq_data = observations(param, sites_wr['site'].tolist(),
+                           run_all.first_date.isoformat(), end)
+    store = fetch.RawStore()
+    store.update(param, aq_data[~aq_data['date'].isin(skip)], run_all.first_date)
+    windows = window_stats.load_windows(window_stats.windows_path())
+    return store, sites_wr, windows
+
+
+def outputs(workspace, param):
+    """
+    Returns {path: bytes} of the map frames, gif blocks, gif and frame
+    cache of param written in workspace
+    """
+    files = {}
+    for folder, _, names in os.walk(os.path.join(workspace, 'assets')):
+        for name in names:
+            path = os.path.join(folder, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, workspace)] = f.read()
+    return files
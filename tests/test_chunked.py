@@ -0,0 +1,52 @@
+"""
+The chunked mode of run_all.py, which reads and interpolates a month
+at a time, against the in-memory one
+"""
+
+import numpy as np
+import pandas as pd
+
+import run_all
+import tiles
+import window_stats
+from conftest import pipeline_inputs
+from grid_store import GridStore, store_path
+
+PARAM = 'NO2'
+
+
+def results(store, sites, windows, chunked):
+    """
+    Returns the daily means, grid store, line data and window stats
+    of a run of PARAM
+    """
+    daily = run_all.read_daily(store, PARAM, chunked)
+    run_all.process_pollutant(PARAM, store, sites, windows, chunked=chunked,
+                              tile_zoom=tiles.MIN_ZOOM)
+    grid_store = GridStore(store_path(PARAM))
+    with open('../data/wrangled/'+PARAM+'_line_plot.csv') as f:
+        line_csv = f.read()
+    return {'daily': daily,
+            'manifest': grid_store.manifest,
+            'mask': np.array(grid_store.mask),
+            'values': np.array(grid_store.values),
+            'stations': np.array(grid_store.station_values),
+            'line_csv': line_csv,
+            'line_parquet': pd.read_parquet('../data/wrangled/'+PARAM+'_line_plot.parquet'),
+            'windows': window_stats.read_window_stats(window_stats.stats_path(PARAM))}
+
+
+def test_chunked_run_matches_the_in_memory_run(workspace):
+    # Three month partitions, two of them mapped
+    store, sites, windows = pipeline_inputs(PARAM, '2020-04-10')
+    assert len(store.partitions(PARAM)) == 3
+    in_memory = results(store, sites, windows, chunked=False)
+    chunked = results(store, sites, windows, chunked=True)
+
+    pd.testing.assert_frame_equal(chunked['daily'], in_memory['daily'])
+    assert chunked['manifest'] == in_memory['manifest']
+    for name in ['mask', 'values', 'stations']:
+        np.testing.assert_array_equal(chunked[name], in_memory[name])
+    assert chunked['line_csv'] == in_memory['line_csv']
+    pd.testing.assert_frame_equal(chunked['line_parquet'], in_memory['line_parquet'])
+    assert chunked['windows'] == in_memory['windows']
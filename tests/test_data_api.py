@@ -0,0 +1,56 @@
+"""
+Query arguments of the data routes of data_api.py
+"""
+
+import json
+
+import pandas as pd
+import pytest
+from flask import Flask
+
+from data_api import DataAPI
+from datastore import LineStore
+
+
+def write_line_data(root, end):
+    dates = pd.date_range('2020-01-01', end)
+    line_df = pd.DataFrame({'name': pd.Categorical(['Oakland']*len(dates)),
+                            'date': dates, 'NO2': range(len(dates))})
+    line_df.to_parquet(root/'NO2_line_plot.parquet')
+
+
+@pytest.fixture
+def client(tmp_path):
+    write_line_data(tmp_path, '2020-01-31')
+    server = Flask(__name__)
+    DataAPI(server, LineStore(str(tmp_path)), ['NO2'], {}, None, points=100)
+    return server.test_client()
+
+
+def test_line_data_between_dates(client):
+    r = client.get('/data/line/NO2.json?start=2020-01-10&end=2020-01-12T00:00:00')
+    assert r.status_code == 200
+    assert [row['date'] for row in json.loads(r.data)] == \
+        ['2020-01-10', '2020-01-11', '2020-01-12']
+
+
+@pytest.mark.parametrize('query, error', [
+    ('start=garbage', 'start must be a date'),
+    ('end=2020-13-01', 'end must be a date'),
+    ('start=2020-01-12&end=2020-01-10', 'start 2020-01-12 is after end 2020-01-10'),
+])
+def test_line_data_rejects_bad_dates(client, query, error):
+    r = client.get('/data/line/NO2.json?'+query)
+    assert r.status_code == 400
+    assert r.get_json() == {'error': error}
+
+
+def test_line_data_of_unknown_pollutants(client):
+    assert client.get('/data/line/CO.json').status_code == 404
+
+
+def test_line_data_picks_up_replaced_files(client, tmp_path):
+    # As run_all.py replaces the data under a running worker
+    assert len(client.get('/data/line/NO2.json').get_json()) == 31
+    write_line_data(tmp_path, '2020-02-29')
+    assert len(client.get('/data/line/NO2.json').get_json()) == 60
@@ -0,0 +1,60 @@
+"""
+Largest-Triangle-Three-Buckets downsampling of downsample.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from downsample import downsample, lttb
+
+
+@pytest.fixture
+def series():
+    rng = np.random.default_rng(2020)
+    x = np.arange(1000, dtype='float64')
+    y = np.sin(x/50) + rng.normal(0, .1, len(x))
+    y[437] = 10
+    return x, y
+
+
+@pytest.mark.parametrize('threshold', [3, 10, 100, 999])
+def test_keeps_threshold_points_and_the_endpoints(series, threshold):
+    x, y = series
+    keep = lttb(x, y, threshold)
+    assert len(keep) == threshold
+    assert keep[0] == 0 and keep[-1] == len(x) - 1
+    assert np.all(np.diff(keep) > 0)
+    # Peaks survive
+    assert 437 in keep
+
+
+@pytest.mark.parametrize('threshold', [2, 1000, 2000])
+def test_returns_short_series_unchanged(series, threshold):
+    x, y = series
+    np.testing.assert_array_equal(lttb(x, y, threshold), np.arange(len(x)))
+
+
+def test_gaps_are_kept_as_gaps(series):
+    x, y = series
+    y = y.copy()
+    # Gaps of single dates, and one wider than a bucket
+    y[[100, 101, 600]] = np.nan
+    y[300:340] = np.nan
+    keep = lttb(x, y, 100)
+    assert len(keep) == 100
+    kept_gaps = keep[np.isnan(y[keep])]
+    assert len(kept_gaps) > 0
+    assert np.all((kept_gaps >= 300) & (kept_gaps < 340))
+    assert 437 in keep
+
+
+def test_downsample_each_group():
+    dates = pd.date_range('2020-01-01', periods=200)
+    df = pd.DataFrame({'name': ['Oakland']*200 + ['Fremont']*50,
+                       'date': list(dates) + list(dates[:50]),
+                       'NO2': np.arange(250.)})
+    out = downsample(df, 'date', 'NO2', 'name', 60)
+    assert (out['name'] == 'Oakland').sum() == 60
+    pd.testing.assert_frame_equal(out[out['name'] == 'Fremont'],
+                                  df[df['name'] == 'Fremont'])
@@ -0,0 +1,236 @@
+"""
+Downloads and the raw store of scripts/fetch.py, against a local
+stand-in for the CARB report server
+"""
+
+import os
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+
+import fetch
+from conftest import observations, report
+
+SITES = ['2178', '3247', '5829']
+
+
+class CARBServer(ThreadingHTTPServer):
+    """
+    Answers report requests with observations of the requested
+    pollutant and dates, or with the faults queued for the pollutant
+    in faults ({param: [fault, ...]}, used up one per request):
+
+    - 500: an HTTP error
+    - always: an HTTP error, to every request
+    - truncate: a body shorter than its Content-Length
+    - empty: a report without observations
+    - outside: a report with dates after the requested ones
+    - columns: a report without the value column
+    - slow: a report sent after a delay
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ReportHandler)
+        self.faults = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/display.php'.format(self.server_address[1])
+
+
+class ReportHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        param = query['param']
+        start = date(*map(int, query['first_date'].split('-')))
+        end = date(int(query['year']), int(query['mon']), int(query['day']))
+        with self.server.lock:
+            self.server.requests.append((param, start, end))
+            faults = self.server.faults.get(param, [])
+            fault = faults[0] if faults == ['always'] else \
+                faults.pop(0) if faults else ''
+        if fault in ('500', 'always'):
+            self.send_error(500)
+            return
+        aq_data = observations(param, SITES, start.isoformat(), end.isoformat())
+        if fault == 'empty':
+            aq_data = aq_data[:0]
+        elif fault == 'outside':
+            aq_data.loc[aq_data.index[-1], 'date'] = '2099-01-01'
+        elif fault == 'columns':
+            aq_data = aq_data.drop(columns='value')
+        elif fault == 'slow':
+            time.sleep(.5)
+        body = report(aq_data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body) + 100*(fault == 'truncate')))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = CARBServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def waits(monkeypatch):
+    """
+    The backoff waits of downloads, which return at once
+    """
+    waits = []
+    monkeypatch.setattr(fetch.time, 'sleep', waits.append)
+    return waits
+
+
+def test_download_retries_with_backoff(server, waits):
+    server.faults['NO2'] = ['500', 'truncate', 'columns']
+    with fetch.make_session() as session:
+        aq_data = fetch.download('NO2', date(2020, 1, 1), date(2020, 1, 10),
+                                 server.url, session=session, backoff=2)
+    assert waits == [2, 4, 8]
+    assert len(server.requests) == 4
+    expected = observations('NO2', SITES, '2020-01-01', '2020-01-10')
+    assert aq_data['value'].tolist() == expected['value'].tolist()
+
+
+@pytest.mark.parametrize('fault', ['500', 'truncate', 'outside', 'columns'])
+def test_download_fails_after_the_retries(server, waits, fault):
+    server.faults['NO2'] = [fault]*3
+    with pytest.raises(fetch.DownloadError, match='NO2 failed after 3 attempts'):
+        fetch.download('NO2', date(2020, 1, 1), date(2020, 1, 10), server.url,
+                       retries=2, backoff=1)
+    assert waits == [1, 2]
+
+
+def test_read_body_limits_size(server):
+    with fetch.make_session() as session:
+        url = fetch.carb_url('NO2', date(2020, 1, 1), date(2020, 3, 1), server.url)
+        with session.post(url, stream=True) as r:
+            with pytest.raises(fetch.DownloadError, match='larger than 1024 bytes'):
+                fetch.read_body(r, max_bytes=1024)
+        with session.post(url, stream=True) as r:
+            assert len(fetch.read_body(r)) == int(r.headers['Content-Length'])
+
+
+def test_failed_downloads_are_not_stored(server, waits, tmp_path):
+    store = fetch.RawStore(str(tmp_path))
+    server.faults['NO2'] = ['truncate']
+    with pytest.raises(fetch.DownloadError):
+        fetch.fetch('NO2', date(2020, 1, 1), store, today=date(2020, 2, 10),
+                    base_url=server.url, retries=0)
+    assert store.partitions('NO2') == []
+
+
+def test_fetch_rerequests_the_revision_window(server, tmp_path):
+    store = fetch.RawStore(str(tmp_path))
+    stored = fetch.parse(report(observations('NO2', SITES, '2020-01-01',
+                                             '2020-02-10')))
+    # A value CARB corrects afterwards, in the revision window
+    stored.loc[stored['date'] == '2020-02-05', 'value'] += 1
+    assert store.update('NO2', stored, date(2020, 1, 1))
+    changed = fetch.fetch('NO2', date(2020, 1, 1), store, today=date(2020, 2, 13),
+                          revision_days=7, base_url=server.url)
+    assert server.requests == [('NO2', date(2020, 2, 3), date(2020, 2, 13))]
+    assert changed == {'2020-02-05', '2020-02-11', '2020-02-12', '2020-02-13'}
+    expected = fetch.parse(report(observations('NO2', SITES, '2020-01-01',
+                                               '2020-02-13')))
+    order = ['site', 'date', 'start_hour']
+    pd.testing.assert_frame_equal(
+        store.read('NO2').sort_values(order, ignore_index=True),
+        expected.sort_values(order, ignore_index=True))
+
+
+def test_empty_revision_window_is_no_update(server, waits, tmp_path):
+    store = fetch.RawStore(str(tmp_path))
+    stored = fetch.parse(report(observations('NO2', SITES, '2020-01-01',
+                                             '2020-02-10')))
+    store.update('NO2', stored, date(2020, 1, 1))
+    partitions = {p: os.path.getmtime(p) for p in store.partitions('NO2')}
+    server.faults['NO2'] = ['empty']
+    assert fetch.fetch('NO2', date(2020, 1, 1), store, today=date(2020, 2, 13),
+                       base_url=server.url) == set()
+    assert waits == []
+    assert {p: os.path.getmtime(p) for p in store.partitions('NO2')} == partitions
+    assert store.last_date('NO2') == date(2020, 2, 10)
+
+
+def test_store_skips_empty_partitions(tmp_path):
+    store = fetch.RawStore(str(tmp_path))
+    aq_data = fetch.parse(report(observations('BC', SITES, '2020-01-20',
+                                              '2020-02-10', drop=0)))
+    store.update('BC', aq_data, date(2020, 1, 20))
+    # Every February date withdrawn: its partition goes
+    assert store.update('BC', aq_data[aq_data['date'] < '2020-02-01'],
+                        date(2020, 1, 25)) == set(
+        aq_data.loc[aq_data['date'] >= '2020-02-01', 'date'])
+    assert [os.path.basename(p) for p in store.partitions('BC')] == \
+        ['2020-01.parquet']
+    assert store.last_date('BC') == date(2020, 1, 31)
+    # An empty partition, as earlier versions could write, is ignored
+    aq_data[:0].to_parquet(store.partition_path('BC', '2020-03'), index=False)
+    assert store.last_date('BC') == date(2020, 1, 31)
+
+
+def test_store_update_replaces_from_since(tmp_path):
+    store = fetch.RawStore(str(tmp_path))
+    aq_data = fetch.parse(report(observations('OZONE', SITES, '2020-01-20',
+                                              '2020-03-10', drop=0)))
+    assert store.update('OZONE', aq_data, date(2020, 1, 20)) == \
+        set(aq_data['date'])
+    assert [os.path.basename(p) for p in store.partitions('OZONE')] == \
+        ['2020-01.parquet', '2020-02.parquet', '2020-03.parquet']
+    assert store.last_date('OZONE') == date(2020, 3, 10)
+
+    # The same observations in another order change nothing
+    assert store.update('OZONE', aq_data[::-1], date(2020, 1, 20)) == set()
+
+    # Dates from since on are replaced, dropped ones included; earlier
+    # dates are kept
+    since = date(2020, 2, 25)
+    revised = aq_data[(aq_data['date'] >= since.isoformat())
+                      & (aq_data['date'] != '2020-03-01')].copy()
+    revised.loc[revised['date'] == '2020-02-27', 'value'] += 1
+    assert store.update('OZONE', revised, since) == {'2020-02-27', '2020-03-01'}
+    stored = store.read('OZONE')
+    assert '2020-03-01' not in set(stored['date'])
+    assert set(stored['date']) == set(aq_data['date']) - {'2020-03-01'}
+    assert len(stored[stored['date'] < since.isoformat()]) == \
+        len(aq_data[aq_data['date'] < since.isoformat()])
+
+
+def test_fetch_all_keeps_each_pollutants_data(server, waits, tmp_path):
+    store = fetch.RawStore(str(tmp_path))
+    params = ['NO2', 'OZONE', 'PM25HR', 'BC']
+    # The first pollutant finishes last; OZONE fails every attempt
+    server.faults['NO2'] = ['slow']
+    server.faults['OZONE'] = ['always']
+    updates, failures = fetch.fetch_all(params, date(2020, 1, 1), store,
+                                        today=date(2020, 1, 31),
+                                        base_url=server.url, retries=1)
+    assert list(updates) == ['NO2', 'PM25HR', 'BC']
+    assert list(failures) == ['OZONE']
+    assert 'OZONE failed after 2 attempts' in failures['OZONE']
+    assert store.partitions('OZONE') == []
+    for param in updates:
+        assert set(store.read(param)['variable']) == {param}
+        assert updates[param] == set(store.read(param)['date'])
@@ -0,0 +1,77 @@
+"""
+The frame stream of frame_api.py, decoded as the browser player does
+"""
+
+import json
+import struct
+
+import numpy as np
+import pytest
+from flask import Flask
+
+from frame_api import MAGIC, MISSING, FrameAPI
+from grid import Grid
+from grid_store import write_grid_store
+
+DATES = ['2020-03-01', '2020-03-02', '2020-03-03']
+
+
+@pytest.fixture
+def grid():
+    return Grid.from_extent(np.array([-122.5, -121.5]), np.array([37., 38.]), .25)
+
+
+def serve(root):
+    server = Flask(__name__)
+    FrameAPI(server, ['NO2'], root=str(root))
+    return server.test_client()
+
+
+def decode(stream):
+    """
+    Returns the header, mask and (dates x cells with data) codes of a
+    frame stream
+    """
+    assert stream[:4] == MAGIC
+    length, = struct.unpack('<I', stream[4:8])
+    header = json.loads(stream[8:8+length])
+    grid = header['grid']
+    ncells = grid['nrows']*grid['ncols']
+    mask = np.frombuffer(stream, dtype='uint8', count=ncells, offset=8+length)
+    codes = np.frombuffer(stream, dtype='uint8', offset=8+length+ncells)
+    return header, mask.astype(bool), codes.reshape(len(header['dates']), header['cells'])
+
+
+def test_codes_round_trip_within_a_step(tmp_path, grid):
+    rng = np.random.default_rng(2020)
+    values = rng.uniform(2, 12, (grid.nrows*grid.ncols, len(DATES)))
+    # A cell without data, and a cell missing on one date
+    values[0] = np.nan
+    values[5, 1] = np.nan
+    write_grid_store(str(tmp_path/'NO2_grid'), 'NO2', grid, DATES, values)
+    r = serve(tmp_path).get('/data/frames/NO2.bin')
+    assert r.status_code == 200
+    header, mask, codes = decode(r.data)
+
+    assert header['param'] == 'NO2' and header['dates'] == DATES
+    assert header['grid'] == grid._asdict()
+    low, high = header['domain']
+    assert (low, high) == (np.float32(np.nanmin(values)), np.float32(np.nanmax(values)))
+    np.testing.assert_array_equal(mask, ~np.all(np.isnan(values), axis=1))
+    expected = values[mask].T
+    assert np.array_equal(codes == MISSING, np.isnan(expected))
+    decoded = low + codes/(MISSING - 1)*(high - low)
+    step = (high - low)/(MISSING - 1)
+    error = np.abs(decoded - expected)[~np.isnan(expected)]
+    assert error.max() <= step/2 + 1e-6
+    # The ends of the domain are coded exactly
+    assert codes[codes != MISSING].min() == 0
+    assert codes[codes != MISSING].max() == MISSING - 1
+
+
+def test_stores_without_values_have_no_stream(tmp_path, grid):
+    values = np.full((grid.nrows*grid.ncols, len(DATES)), np.nan)
+    write_grid_store(str(tmp_path/'NO2_grid'), 'NO2', grid, DATES, values)
+    client = serve(tmp_path)
+    assert client.get('/data/frames/NO2.bin').status_code == 404
+    assert client.get('/data/frames/CO.bin').status_code == 404
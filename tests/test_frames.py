@@ -0,0 +1,95 @@
+"""
+Map frames and gifs written by run_all.py
+"""
+
+import os
+
+import numpy as np
+
+import run_all
+import tiles
+from conftest import make_workspace, outputs, pipeline_inputs
+
+PARAM = 'NO2'
+
+# No map tiles, which the frames don't depend on
+NO_TILES = tiles.MIN_ZOOM - 1
+
+
+def run(monkeypatch, path, end, max_chunk=64, workers=1, skip=()):
+    """
+    Runs the pipeline for PARAM on the observations up to end, but for
+    the dates in skip, in the workspace at path, and returns its frame
+    outputs
+    """
+    monkeypatch.chdir(make_workspace(str(path)))
+    monkeypatch.setattr(run_all, 'min_chunk', 1)
+    monkeypatch.setattr(run_all, 'max_chunk', max_chunk)
+    store, sites, windows = pipeline_inputs(PARAM, end, skip)
+    if workers > 1:
+        failures = run_all.run_parallel(store, {PARAM: None}, sites, windows,
+                                        workers, tile_zoom=NO_TILES)
+    else:
+        failures = run_all.run_serial(store, {PARAM: None}, sites, windows,
+                                      tile_zoom=NO_TILES)
+    assert failures == {}
+    return outputs(str(path), PARAM)
+
+
+def pngs(files):
+    return {path: data for path, data in files.items() if path.endswith('.png')}
+
+
+def test_frame_chunks_carry_their_dates(monkeypatch):
+    monkeypatch.setattr(run_all, 'min_chunk', 1)
+    monkeypatch.setattr(run_all, 'max_chunk', 3)
+    dates = ['2020-03-{:02d}'.format(d) for d in range(10, 20)]
+    job = {'param': PARAM,
+           'dates': dates,
+           'indices': [run_all.date_int(d) for d in dates],
+           'values': np.arange(40.).reshape(4, 10)}
+    todo = job['indices'][1::2]
+    for chunk, indices in run_all.frame_chunks(job, todo, 1):
+        for i in indices:
+            assert run_all.frame_labels(chunk, i) == run_all.frame_labels(job, i)
+            column = job['indices'].index(i)
+            assert (chunk['values'][:, chunk['indices'].index(i)]
+                    == job['values'][:, column]).all()
+
+
+def test_frames_do_not_depend_on_chunks(tmp_path, monkeypatch):
+    one = pngs(run(monkeypatch, tmp_path/'one', '2020-03-25'))
+    chunked = pngs(run(monkeypatch, tmp_path/'chunked', '2020-03-25', max_chunk=4))
+    assert len([path for path in one if path.startswith('assets/img/')]) == 25
+    assert chunked == one
+
+
+def test_appended_frames_match_a_fresh_run(tmp_path, monkeypatch):
+    fresh = pngs(run(monkeypatch, tmp_path/'fresh', '2020-03-25'))
+    run(monkeypatch, tmp_path/'incremental', '2020-03-12', max_chunk=4)
+    incremental = pngs(run(monkeypatch, tmp_path/'incremental', '2020-03-25',
+                           max_chunk=4))
+    assert incremental == fresh
+
+
+def test_parallel_output_matches_serial(tmp_path, monkeypatch):
+    serial = run(monkeypatch, tmp_path/'serial', '2020-03-25', max_chunk=16)
+    parallel = run(monkeypatch, tmp_path/'parallel', '2020-03-25', max_chunk=16,
+                   workers=3)
+    assert 'assets/NO2.gif' in serial
+    assert sorted(parallel) == sorted(serial)
+    for path in serial:
+        assert parallel[path] == serial[path], path
+
+
+def test_gif_blocks_are_encoded_again_across_date_gaps(tmp_path, monkeypatch):
+    skip = ['2020-03-10', '2020-03-11']
+    files = run(monkeypatch, tmp_path, '2020-03-20', skip=skip)
+    gap = ['{}_{}.png'.format(PARAM, run_all.date_int(d)) for d in skip]
+    assert not any(path.endswith(name) for path in files for name in gap)
+    # Lose the blocks and the gif, which is then written again from the pngs
+    for path in files:
+        if '/blocks/' in path or path.endswith('.gif'):
+            os.remove(str(tmp_path/path))
+    again = run(monkeypatch, tmp_path, '2020-03-20', skip=skip)
+    assert again == files
@@ -0,0 +1,79 @@
+"""
+Writes of scripts/grid_store.py, which swap in the new store under
+running readers
+"""
+
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import grid_store
+from grid import Grid
+from grid_store import GridStore, write_grid_store
+
+DATES = ['2020-03-01', '2020-03-02']
+
+
+@pytest.fixture
+def grid():
+    return Grid.from_extent(np.array([-122.5, -121.5]), np.array([37., 38.]), .25)
+
+
+def write(path, grid, value):
+    cells = grid.nrows*grid.ncols
+    write_grid_store(path, 'NO2', grid, DATES, np.full((cells, len(DATES)), value))
+
+
+def versions(path):
+    return sorted(glob.glob(path+'.v*'))
+
+
+def test_readers_find_a_store_throughout_a_write(tmp_path, grid, monkeypatch):
+    path = str(tmp_path/'NO2_grid')
+    write(path, grid, 1.)
+    opened = []
+    replace = os.replace
+
+    def reading(src, dst):
+        # A reader opening the store just before and just after the swap
+        opened.append(GridStore(path).frame(DATES[0])[0])
+        replace(src, dst)
+        opened.append(GridStore(path).frame(DATES[0])[0])
+    monkeypatch.setattr(grid_store.os, 'replace', reading)
+    write(path, grid, 2.)
+    assert opened == [1., 2.]
+
+
+def test_open_readers_keep_their_version(tmp_path, grid):
+    path = str(tmp_path/'NO2_grid')
+    write(path, grid, 1.)
+    store = GridStore(path)
+    write(path, grid, 2.)
+    assert store.frame(DATES[1])[0] == 1.
+    assert GridStore(path).frame(DATES[1])[0] == 2.
+    # Only the current and the previous version are kept
+    write(path, grid, 3.)
+    assert len(versions(path)) == 2
+    assert os.path.realpath(path) in versions(path)
+    assert store.version not in versions(path)
+
+
+def test_unversioned_stores_are_replaced(tmp_path, grid):
+    # As written before stores were versioned, with a failed write's leftovers
+    path = str(tmp_path/'NO2_grid')
+    write(path, grid, 1.)
+    os.rename(os.path.realpath(path), path+'.tmp')
+    os.remove(path)
+    os.rename(path+'.tmp', path)
+    os.makedirs(path+'.old')
+    write(path, grid, 2.)
+    assert os.path.islink(path)
+    assert GridStore(path).frame(DATES[0])[0] == 2.
+    assert len(versions(path)) == 2
+    assert not os.path.exists(path+'.old')
+    # The migrated store goes once it is no longer the previous version
+    write(path, grid, 3.)
+    assert len(versions(path)) == 2
+    assert not os.path.exists(path+'.v0')
@@ -0,0 +1,112 @@
+"""
+Data refreshes of the app served by gunicorn with gunicorn.conf.py
+"""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pandas as pd
+import pytest
+
+import run_all
+from conftest import ROOT
+
+pytest.importorskip('gunicorn')
+
+IGNORE = shutil.ignore_patterns('.git', 'tests', 'benchmarks', 'docs',
+                                '__pycache__', '*.patch', '*.jsonl')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def workers(master):
+    """
+    Returns the pids of the processes whose parent is master
+    """
+    children = set()
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        if int(stat.rsplit(')', 1)[1].split()[1]) == master:
+            children.add(int(pid))
+    return children
+
+
+def wait_for(condition, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            result = condition()
+        except OSError:
+            result = None
+        if result:
+            return result
+        time.sleep(.2)
+    raise AssertionError('timed out')
+
+
+@pytest.fixture
+def served(tmp_path):
+    """
+    A copy of the app served by gunicorn with two workers, and its url
+    """
+    app_root = tmp_path/'app'
+    shutil.copytree(ROOT, app_root, ignore=IGNORE)
+    pidfile = str(tmp_path/'gunicorn.pid')
+    port = free_port()
+    log = open(tmp_path/'gunicorn.log', 'w+')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+         '--workers', '2', '--bind', '127.0.0.1:{}'.format(port), 'app:server'],
+        cwd=app_root, env=dict(os.environ, AQ_PIDFILE=pidfile),
+        stdout=log, stderr=subprocess.STDOUT)
+    url = 'http://127.0.0.1:{}'.format(port)
+    try:
+        wait_for(lambda: urllib.request.urlopen(url+'/data/sites.geojson'))
+        yield app_root, url, process.pid, pidfile, log
+    finally:
+        process.terminate()
+        process.wait(30)
+        log.close()
+
+
+def line_rows(url):
+    with urllib.request.urlopen(url+'/data/line/NO2.json') as r:
+        return len(json.load(r))
+
+
+def test_reload_replaces_the_workers_with_fresh_data(served):
+    app_root, url, master, pidfile, log = served
+    before = line_rows(url)
+    old = wait_for(lambda: len(workers(master)) == 2 and workers(master))
+
+    # As run_all.py replaces the line data, then signals the master
+    path = app_root/'data/wrangled/NO2_line_plot.csv'
+    line_df = pd.read_csv(path, index_col=0)
+    line_df[:len(line_df)//2].to_csv(str(path)+'.tmp')
+    os.replace(str(path)+'.tmp', path)
+    assert run_all.reload_app(pidfile)
+
+    new = wait_for(lambda: (len(workers(master)) == 2
+                            and not workers(master) & old and workers(master)))
+    assert len(new) == 2
+    log.seek(0)
+    assert 'Reloaded the app data' in log.read()
+    assert line_rows(url) < before
+
+
+def test_reload_without_a_master(tmp_path):
+    assert not run_all.reload_app(str(tmp_path/'missing.pid'))
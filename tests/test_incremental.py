@@ -0,0 +1,99 @@
+"""
+Incremental runs of run_all.py, which interpolate only the dates whose
+observations changed
+"""
+
+import os
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import fetch
+import run_all
+import tiles
+import window_stats
+from conftest import make_workspace, observations
+
+PARAM = 'NO2'
+
+
+def written(path):
+    """
+    Returns {path: bytes} of everything the pipeline wrote in the
+    workspace at path, grid stores read through their current version
+    """
+    files = {}
+    for top in ['data/wrangled', 'data/tiles', 'assets']:
+        for folder, folders, names in os.walk(os.path.join(path, top),
+                                              followlinks=True):
+            folders[:] = [f for f in folders if '_grid.v' not in f]
+            for name in names:
+                with open(os.path.join(folder, name), 'rb') as f:
+                    files[os.path.relpath(os.path.join(folder, name), path)] = f.read()
+    return files
+
+
+def run(store, updates):
+    sites = run_all.load_sites()
+    windows = window_stats.load_windows(window_stats.windows_path())
+    assert run_all.run_serial(store, updates, sites, windows,
+                              tile_zoom=tiles.MIN_ZOOM) == {}
+
+
+@pytest.fixture
+def interpolated(monkeypatch):
+    """
+    The number of dates interpolated
+    """
+    counts = []
+    make_interpolator = run_all.make_interpolator
+
+    def counting(sites, pixel=.05):
+        grid, interpolator = make_interpolator(sites, pixel)
+
+        def interpolate(values):
+            counts.append(values.shape[1])
+            return interpolator(values)
+        return grid, interpolate
+    monkeypatch.setattr(run_all, 'make_interpolator', counting)
+    return counts
+
+
+@pytest.mark.parametrize('hint', [True, False])
+def test_incremental_run_matches_a_full_run(tmp_path, monkeypatch,
+                                            interpolated, hint):
+    first = run_all.first_date.isoformat()
+
+    monkeypatch.chdir(make_workspace(str(tmp_path/'fresh')))
+    site_ids = run_all.load_sites()['site'].tolist()
+    old = observations(PARAM, site_ids, first, '2020-03-25')
+    new = observations(PARAM, site_ids, first, '2020-04-05')
+    # A value corrected in the revision window
+    new.loc[new['date'] == '2020-03-20', 'value'] += 1
+    since = date(2020, 3, 18)
+    final = pd.concat([old[old['date'] < since.isoformat()],
+                       new[new['date'] >= since.isoformat()]])
+    store = fetch.RawStore()
+    store.update(PARAM, final, run_all.first_date)
+    run(store, {PARAM: None})
+    fresh = written(str(tmp_path/'fresh'))
+
+    monkeypatch.chdir(make_workspace(str(tmp_path/'incremental')))
+    store = fetch.RawStore()
+    store.update(PARAM, old, run_all.first_date)
+    run(store, {PARAM: None})
+    changed = store.update(PARAM, new[new['date'] >= since.isoformat()], since)
+    assert min(changed) == '2020-03-20' and max(changed) == '2020-04-05'
+    del interpolated[:]
+    # Without the hint, as after a run that failed once the store was
+    # updated, dates are found from their station values
+    run(store, {PARAM: changed if hint else set()})
+    assert sum(interpolated) == len(changed)
+    assert written(str(tmp_path/'incremental')) == fresh
+
+    # Nothing changed, nothing interpolated
+    del interpolated[:]
+    run(store, {PARAM: set()})
+    assert sum(interpolated) == 0
+    assert written(str(tmp_path/'incremental')) == fresh
@@ -0,0 +1,53 @@
+"""
+GridInterpolator of scripts/interpolate.py against scipy's griddata
+"""
+
+import numpy as np
+import pytest
+from scipy.interpolate import griddata
+
+from interpolate import GridInterpolator
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(2020)
+
+
+def random_case(rng, stations=25, dates=6):
+    """
+    Returns station points, grid points reaching past their hull and
+    (stations x dates) values
+    """
+    points = rng.uniform(-1, 1, (stations, 2))
+    xs, ys = np.meshgrid(np.linspace(-1.3, 1.3, 40), np.linspace(-1.2, 1.2, 35))
+    xi = np.column_stack([xs.ravel(), ys.ravel()])
+    xi = np.vstack([xi, rng.uniform(-1.5, 1.5, (300, 2))])
+    values = rng.uniform(2, 12, (stations, dates))
+    return points, xi, values
+
+
+def assert_matches(out, expected):
+    np.testing.assert_array_equal(np.isnan(out), np.isnan(expected))
+    assert np.nanmax(np.abs(out - expected)) < 1e-13
+
+
+def test_matches_griddata(rng):
+    points, xi, values = random_case(rng)
+    # A missing station blanks the triangles touching it, as in griddata
+    values[3, 2] = np.nan
+    out = GridInterpolator(points, xi)(values)
+    expected = np.column_stack([griddata(points, values[:, j], xi, method='linear')
+                                for j in range(values.shape[1])])
+    assert np.isnan(expected).any() and not np.isnan(expected).all()
+    assert_matches(out, expected)
+
+
+def test_skip_missing_matches_griddata_of_the_reporting_stations(rng):
+    points, xi, values = random_case(rng)
+    values[3, 2] = values[7, 2] = values[3, 4] = np.nan
+    out = GridInterpolator(points, xi, skip_missing=True)(values)
+    for j in range(values.shape[1]):
+        reporting = ~np.isnan(values[:, j])
+        assert_matches(out[:, j], griddata(points[reporting], values[reporting, j],
+                                           xi, method='linear'))
@@ -0,0 +1,77 @@
+"""
+Metrics of metrics.py summed across gunicorn worker processes
+"""
+
+import multiprocessing
+import os
+import re
+
+from flask import Flask
+
+from metrics import Metrics
+
+
+def scrape(server):
+    """
+    Returns {line name and labels: value} of /metrics
+    """
+    text = server.test_client().get('/metrics').get_data(as_text=True)
+    return {m.group(1): float(m.group(2))
+            for m in re.finditer(r'^(aq_\S+) (\S+)$', text, re.M)}
+
+
+def make_metrics(directory):
+    server = Flask(__name__)
+    metrics = Metrics(server, enabled=True, directory=str(directory))
+    double = metrics.callback('double')(lambda x: 2*x)
+    return server, metrics, double
+
+
+def work(directory, calls, queue):
+    # A worker: records calls callbacks and flushes at exit, as the
+    # gunicorn worker_exit hook does
+    _, metrics, double = make_metrics(directory)
+    for i in range(calls):
+        double(i)
+    metrics.flush(force=True)
+    queue.put(os.getpid())
+
+
+def count(scraped):
+    return scraped['aq_callback_seconds_count{callback="double"}']
+
+
+def test_scrapes_sum_every_worker(tmp_path):
+    server, metrics, double = make_metrics(tmp_path)
+    double(1)
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    workers = [context.Process(target=work, args=(tmp_path, calls, queue))
+               for calls in (3, 5)]
+    for worker in workers:
+        worker.start()
+    pids = [queue.get(), queue.get()]
+    for worker in workers:
+        worker.join()
+    before = scrape(server)
+    assert count(before) == 9
+    assert before['aq_callback_seconds_bucket{callback="double",le="+Inf"}'] == 9
+
+    # Exited workers' counts are kept, their files merged away
+    for pid in pids:
+        metrics.process_exited(pid)
+    assert not [n for n in os.listdir(tmp_path)
+                if n.startswith(tuple('{}-'.format(pid) for pid in pids))]
+    assert scrape(server) == before
+    metrics.process_exited(pids[0])
+    assert scrape(server) == before
+
+
+def test_reset_clears_earlier_runs(tmp_path):
+    _, metrics, double = make_metrics(tmp_path)
+    double(1)
+    metrics.flush(force=True)
+    server, fresh, _ = make_metrics(tmp_path)
+    assert count(scrape(server)) == 1
+    fresh.reset()
+    assert 'aq_callback_seconds_count{callback="double"}' not in scrape(server)
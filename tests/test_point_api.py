@@ -0,0 +1,117 @@
+"""
+Point query routes of point_api.py
+"""
+
+import numpy as np
+import pytest
+from flask import Flask
+
+import point_api
+from grid import Grid
+from grid_store import write_grid_store
+from point_api import PointAPI
+
+DATES = ['2020-03-01', '2020-03-02', '2020-03-03']
+# The grid's south-west and north-east points
+SOUTH_WEST = [37.0, -122.5]
+NORTH_EAST = [37.75, -121.75]
+
+
+@pytest.fixture
+def grid():
+    return Grid.from_extent(np.array([-122.5, -121.5]), np.array([37., 38.]), .25)
+
+
+@pytest.fixture
+def client(tmp_path, grid):
+    cells = grid.nrows*grid.ncols
+    # Each cell's value is its index plus the date's tenth; the
+    # south-west cell has no data
+    values = np.arange(cells)[:, None] + np.array([0, .1, .2])
+    values[grid.cell_index(SOUTH_WEST[1], SOUTH_WEST[0])] = np.nan
+    write_grid_store(str(tmp_path/'NO2_grid'), 'NO2', grid, DATES, values)
+    server = Flask(__name__)
+    PointAPI(server, ['NO2'], root=str(tmp_path))
+    return server.test_client()
+
+
+def test_point_values(client, grid):
+    cell = int(grid.cell_index(NORTH_EAST[1], NORTH_EAST[0]))
+    r = client.get('/data/point/NO2.json?lat=37.76&long=-121.74&date=2020-03-02')
+    assert r.status_code == 200
+    assert r.get_json() == {'pollutant': 'NO2', 'lat': 37.76, 'long': -121.74,
+                            'date': '2020-03-02', 'value': cell + .1}
+    r = client.get('/data/point/NO2.json?lat=37&long=-122.5&start=2020-03-02')
+    assert r.get_json()['dates'] == DATES[1:]
+    assert r.get_json()['values'] == [None, None]
+
+
+@pytest.mark.parametrize('query', ['lat=36.8&long=-122', 'lat=37.5&long=-121.3',
+                                   'lat=nan&long=-122'])
+def test_points_off_the_grid_are_not_found(client, query):
+    r = client.get('/data/point/NO2.json?{}&date=2020-03-01'.format(query))
+    assert r.status_code == 404
+
+
+@pytest.mark.parametrize('query, error', [
+    ('long=-122&date=2020-03-01', 'lat must be a number'),
+    ('lat=37.5&long=west&date=2020-03-01', 'long must be a number'),
+    ('lat=37.5&long=-122&date=2020-04-01', 'no values on 2020-04-01'),
+    ('lat=37.5&long=-122', 'pass a date, or a start and/or end date'),
+])
+def test_point_rejects_bad_queries(client, query, error):
+    r = client.get('/data/point/NO2.json?'+query)
+    assert r.status_code == 400
+    assert r.get_json() == {'error': error}
+
+
+def test_unknown_pollutants(client):
+    assert client.get('/data/point/CO.json?lat=37.5&long=-122').status_code == 404
+    assert client.post('/data/points/CO.json', json={'points': [[37.5, -122]],
+                                                     'date': '2020-03-01'}).status_code == 404
+
+
+def test_batch_values(client, grid):
+    points = [NORTH_EAST, SOUTH_WEST, [36.8, -122], [37.5, -121.3]]
+    r = client.post('/data/points/NO2.json', json={'points': points,
+                                                   'date': '2020-03-03'})
+    assert r.status_code == 200
+    cell = int(grid.cell_index(NORTH_EAST[1], NORTH_EAST[0]))
+    # Points off the grid, and on cells without data, get null
+    assert r.get_json() == {'pollutant': 'NO2', 'date': '2020-03-03',
+                            'values': [cell + .2, None, None, None]}
+    r = client.post('/data/points/NO2.json', json={'points': points[:2],
+                                                   'start': '2020-03-02',
+                                                   'end': '2020-03-03'})
+    assert r.get_json()['values'] == [[cell + .1, cell + .2], [None, None]]
+
+
+def test_batch_size_limit(client):
+    points = [NORTH_EAST]*point_api.MAX_POINTS
+    r = client.post('/data/points/NO2.json', json={'points': points,
+                                                   'date': '2020-03-01'})
+    assert r.status_code == 200
+    assert len(r.get_json()['values']) == point_api.MAX_POINTS
+    r = client.post('/data/points/NO2.json', json={'points': points + [NORTH_EAST],
+                                                   'date': '2020-03-01'})
+    assert r.status_code == 400
+    assert r.get_json() == {'error': 'at most 10000 points per query'}
+
+
+@pytest.mark.parametrize('body, error', [
+    ('{"points": [[37.5, -122]', 'expected a JSON object with a list of points'),
+    ('[[37.5, -122]]', 'expected a JSON object with a list of points'),
+    ('{"points": []}', 'expected a JSON object with a list of points'),
+    ('{"points": [[37.5, -122, 1]], "date": "2020-03-01"}',
+     'points must be [lat, long] pairs'),
+    ('{"points": [[37.5, -122], [38]], "date": "2020-03-01"}',
+     'points must be [lat, long] pairs'),
+    ('{"points": [["north", "west"]], "date": "2020-03-01"}',
+     'points must be [lat, long] pairs'),
+    ('{"points": [[37.5, -122]]}', 'pass a date, or a start and/or end date'),
+])
+def test_batch_rejects_malformed_bodies(client, body, error):
+    r = client.post('/data/points/NO2.json', data=body,
+                    content_type='application/json')
+    assert r.status_code == 400
+    assert r.get_json() == {'error': error}
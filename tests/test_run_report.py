@@ -0,0 +1,83 @@
+"""
+Stage records of scripts/run_report.py
+"""
+
+import threading
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import run_report
+
+
+@pytest.fixture
+def report(monkeypatch):
+    report = run_report.RunReport(enabled=True)
+    monkeypatch.setattr(run_report, 'current', report)
+    yield report
+    tracemalloc.stop()
+
+
+def allocate(mb):
+    with run_report.stage('allocate', 'NO2', mb=mb):
+        block = np.ones(mb*2**20, dtype='uint8')
+        del block
+
+
+def test_stage_records_its_own_peak(report):
+    allocate(16)
+    allocate(4)
+    first, second = report.records
+    assert first['stage'] == 'allocate' and first['param'] == 'NO2'
+    assert 16*2**20 <= first['peak_bytes'] < 17*2**20
+    assert 4*2**20 <= second['peak_bytes'] < 5*2**20
+
+
+def test_nested_stages_keep_the_outer_peak(report):
+    with run_report.stage('outer'):
+        block = np.ones(16*2**20, dtype='uint8')
+        del block
+        allocate(4)
+    inner, outer = report.records
+    assert 4*2**20 <= inner['peak_bytes'] < 5*2**20
+    assert 16*2**20 <= outer['peak_bytes'] < 17*2**20
+
+
+def test_concurrent_stages_keep_their_peaks(report):
+    allocated = threading.Event()
+    started = threading.Event()
+
+    def peak():
+        with run_report.stage('peak'):
+            block = np.ones(16*2**20, dtype='uint8')
+            del block
+            allocated.set()
+            # Another thread's stage starts before this one ends
+            started.wait(10)
+
+    thread = threading.Thread(target=peak)
+    thread.start()
+    allocated.wait(10)
+    with run_report.stage('other'):
+        started.set()
+        thread.join()
+    first, other = report.records
+    assert first['stage'] == 'peak'
+    assert 16*2**20 <= first['peak_bytes'] < 17*2**20
+    assert other['peak_bytes'] < 2**20
+
+
+def test_peaks_need_reset_peak(report, monkeypatch):
+    # As on Python 3.8, which has no tracemalloc.reset_peak
+    monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+    allocate(4)
+    assert report.records[0]['peak_bytes'] is None
+    assert report.records[0]['wall'] > 0
+
+
+def test_disabled_stages_record_nothing(monkeypatch):
+    monkeypatch.setattr(run_report, 'current', run_report.RunReport())
+    allocate(1)
+    assert run_report.current.records == []
+    assert not tracemalloc.is_tracing()
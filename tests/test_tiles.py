@@ -0,0 +1,84 @@
+"""
+Map tiles served by tile_api.py
+"""
+
+import os
+
+import pytest
+from flask import Flask
+
+import run_all
+import tiles
+from conftest import pipeline_inputs
+from grid_store import GridStore, store_path
+from tile_api import TileAPI
+
+PARAM = 'NO2'
+
+
+@pytest.fixture
+def surface_store(workspace):
+    # Tiles of the first zoom level only, built on disk
+    store, sites, windows = pipeline_inputs(PARAM, '2020-03-25')
+    assert run_all.run_serial(store, {PARAM: None}, sites, windows,
+                              tile_zoom=tiles.MIN_ZOOM, gif=False) == {}
+    return GridStore(store_path(PARAM))
+
+
+def tile_files(cache):
+    return sorted(os.path.join(folder, name)
+                  for folder, _, names in os.walk(cache) for name in names)
+
+
+def test_requested_tiles_stay_in_memory(surface_store):
+    cache = tiles.tile_root()
+    built = tile_files(cache)
+    assert built
+    server = Flask(__name__)
+    api = TileAPI(server, [PARAM], root='../data/wrangled', cache=cache,
+                  memory_mb=.25)
+    client = server.test_client()
+    date = surface_store.dates[0]
+    surface = api.surface(PARAM)
+    positions = tiles.covering(surface.bounds, 11)
+    served = {}
+    for x, y in positions:
+        r = client.get('/tiles/{}/{}/11/{}/{}.png'.format(PARAM, date, x, y))
+        assert r.status_code == 200
+        served[x, y] = r.data
+    # Nothing written to disk, and at most memory_mb kept
+    assert tile_files(cache) == built
+    assert 0 < api.memory.size <= .25*2**20 < sum(map(len, served.values()))
+    assert len(api.memory) < len(positions)
+    # Evicted tiles render again the same
+    for (x, y), png in served.items():
+        assert surface.tile(date, 11, x, y)[0] == png
+
+    # Built tiles are read from disk
+    x, y = tiles.covering(surface.bounds, tiles.MIN_ZOOM)[0]
+    r = client.get('/tiles/{}/{}/{}/{}/{}.png'.format(PARAM, date,
+                                                      tiles.MIN_ZOOM, x, y))
+    with open(surface.path(surface.key(0), tiles.MIN_ZOOM, x, y), 'rb') as f:
+        assert r.data == f.read()
+
+
+def test_pixel_weights_count_against_the_memory_budget(surface_store):
+    server = Flask(__name__)
+    api = TileAPI(server, [PARAM], root='../data/wrangled',
+                  cache=tiles.tile_root(), memory_mb=6)
+    client = server.test_client()
+    surface = api.surface(PARAM)
+    positions = tiles.covering(surface.bounds, 12)
+    # Each position's weights take about 2.3 MB
+    assert len(positions) > 6/2.3
+    for x, y in positions:
+        for date in surface_store.dates[:2]:
+            url = '/tiles/{}/{}/12/{}/{}.png'.format(PARAM, date, x, y)
+            assert client.get(url).status_code == 200
+    entries = [value for value, _ in api.memory._entries.values()]
+    assert any(isinstance(value, tuple) for value in entries)
+    assert api.memory.size <= 6*2**20
+    assert api.memory.size == sum(
+        len(value) if isinstance(value, bytes) else value[0].nbytes + value[1].nbytes
+        for value in entries)
+    assert surface._build_weights.cache_info().currsize == 0
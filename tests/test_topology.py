@@ -0,0 +1,72 @@
+"""
+TopoJSON layers of scripts/topology.py
+"""
+
+import numpy as np
+import pytest
+
+import topology
+
+
+def feature(name, ring):
+    return {'type': 'Feature', 'properties': {'name': name},
+            'geometry': {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}}
+
+
+def wiggle(a, b, n, amplitude):
+    """
+    Returns the n points from a towards b (b excluded), off the line
+    by up to amplitude
+    """
+    t = np.linspace(0, 1, n, endpoint=False)[:, None]
+    points = np.array(a) + t*(np.array(b) - np.array(a))
+    offset = amplitude*np.sin(t*37)*(t > 0)
+    return (points + offset*np.array([[1, -1]])).tolist()
+
+
+@pytest.fixture
+def features():
+    # Two adjacent squares sharing a wiggly border from (-122, 37) to
+    # (-122, 37.1), and a small island
+    shared = wiggle([-122, 37], [-122, 37.1], 40, .002)
+    west = (wiggle([-122.1, 37], [-122, 37], 20, .001) + shared
+            + wiggle([-122, 37.1], [-122.1, 37.1], 20, .001)
+            + wiggle([-122.1, 37.1], [-122.1, 37], 20, .001))
+    east = (wiggle([-122, 37], [-121.9, 37], 20, .001)
+            + wiggle([-121.9, 37], [-121.9, 37.1], 20, .001)
+            + [[-122, 37.1]] + shared[:0:-1])
+    angles = np.linspace(0, 2*np.pi, 30, endpoint=False)
+    island = np.column_stack([-121.95 + .001*np.cos(angles),
+                              37.2 + .001*np.sin(angles)]).tolist()
+    return [feature('West', west), feature('East', east), feature('Island', island)]
+
+
+@pytest.mark.parametrize('level', list(topology.LEVELS))
+def test_shared_borders_are_stored_once(features, level):
+    topo = topology.topology(features, topology.LEVELS[level])
+    (west,), (east,), (island,) = [g['arcs'][0] for g in
+                                   topo['objects']['counties']['geometries']]
+    # The shared border, the rest of each square and the island
+    assert len(topo['arcs']) == 4
+    shared = set(west) & {~i for i in east}
+    assert len(shared) == 1
+    assert not set(west) & set(east)
+    assert island == [3]
+    # Both squares decode the same border points, so they stay seamless
+    border = {tuple(p) for p in topology.decode_arcs(topo)[shared.pop()]}
+    west_ring, east_ring, _ = topology.rings(topo)
+    assert {tuple(p) for p in west_ring} & {tuple(p) for p in east_ring} == border
+
+
+@pytest.mark.parametrize('level', list(topology.LEVELS))
+def test_rings_stay_closed(features, level):
+    topo = topology.topology(features, topology.LEVELS[level])
+    rings = topology.rings(topo)
+    assert len(rings) == 3
+    for ring in rings:
+        assert len(ring) >= 4
+        np.testing.assert_array_equal(ring[0], ring[-1])
+    # Simplified layers keep fewer points
+    if topology.LEVELS[level]:
+        full = topology.topology(features)
+        assert sum(map(len, rings)) < sum(map(len, topology.rings(full)))
@@ -0,0 +1,84 @@
+"""
+Statistics of scripts/window_stats.py against a plain pandas groupby
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import window_stats
+
+WINDOWS = [
+    {'name': 'Before', 'start': None, 'end': '2020-03-16', 'default': True},
+    {'name': 'After', 'start': '2020-03-17', 'end': None},
+    # A Saturday, with one station only
+    {'name': 'Weekend day', 'start': '2020-03-21', 'end': '2020-03-21'},
+    {'name': 'Overlapping', 'start': '2020-03-10', 'end': '2020-03-24'},
+    {'name': 'Empty', 'start': '2021-06-15', 'end': '2021-06-30'},
+]
+
+
+@pytest.fixture
+def line_df():
+    rng = np.random.default_rng(2020)
+    rows = []
+    for day in pd.date_range('2020-03-01', '2020-03-31').strftime('%Y-%m-%d'):
+        for name in ['Oakland', 'San Jose', 'Vallejo']:
+            if rng.uniform() < .2 or (name != 'Oakland' and day == '2020-03-21'):
+                continue
+            rows.append((name, day, rng.uniform(2, 12)))
+    return pd.DataFrame(rows, columns=['name', 'date', 'NO2'])
+
+
+def expected_summary(df, stations):
+    """
+    The summary of the rows of df by a pandas groupby
+    """
+    def mean(values):
+        return None if len(values) == 0 else values.mean()
+    weekend = pd.to_datetime(df['date']).dt.dayofweek >= 5
+    by_station = df.groupby('name')['NO2'].mean()
+    return {'count': len(df),
+            'mean': mean(df['NO2']),
+            'weekday': mean(df.loc[~weekend, 'NO2']),
+            'weekend': mean(df.loc[weekend, 'NO2']),
+            'stations': [by_station.get(s) for s in stations]}
+
+
+def assert_summary(summary, expected):
+    assert summary.keys() >= expected.keys()
+    for key, value in expected.items():
+        if key == 'stations':
+            assert [s is None for s in summary[key]] == [s is None for s in value]
+            assert [s for s in summary[key] if s is not None] == \
+                pytest.approx([s for s in value if s is not None], abs=1e-8)
+        elif value is None:
+            assert summary[key] is None
+        else:
+            assert summary[key] == pytest.approx(value, abs=1e-8)
+
+
+def test_matches_a_groupby(line_df):
+    stats = window_stats.window_stats(line_df, 'NO2', WINDOWS)
+    stations = sorted(line_df['name'].unique())
+    assert stats['stations'] == stations
+    assert (stats['first'], stats['last']) == ('2020-03-01', '2020-03-31')
+    assert_summary(stats['all'], expected_summary(line_df, stations))
+    for window, summary in zip(WINDOWS, stats['windows']):
+        rows = line_df[(line_df['date'] >= (window['start'] or ''))
+                       & (line_df['date'] <= (window['end'] or '9999'))]
+        assert {k: summary[k] for k in window} == window
+        assert_summary(summary, expected_summary(rows, stations))
+    # Windows without days, and stations without values in a window
+    assert stats['windows'][4]['count'] == 0
+    assert stats['windows'][4]['stations'] == [None]*3
+    assert stats['windows'][2]['stations'][1:] == [None, None]
+    assert stats['windows'][2]['weekday'] is None
+
+
+def test_no_rows():
+    stats = window_stats.window_stats(
+        pd.DataFrame({'name': [], 'date': [], 'NO2': []}), 'NO2', WINDOWS)
+    assert stats['first'] is None and stats['stations'] == []
+    assert stats['all'] == {'count': 0, 'mean': None, 'weekday': None,
+                            'weekend': None, 'stations': []}
@@ -0,0 +1,145 @@
+"""
+Map tiles of the interpolated surface, served from app.server.
+
+    GET /tiles/<param>/<date>/<z>/<x>/<y>.png
+
+Tiles are read from the disk cache run_all.py fills with the coarse
+zoom levels (see scripts/tiles.py); finer levels are rendered on their
+first request and kept in the worker's memory with the pixel weights
+of their positions, at most memory_mb of both together, so the app
+never writes tiles to disk. map_document() returns a Leaflet map of
+the tiles, with a slider over the dates, for the app to show in an
+iframe.
+"""
+
+import json
+import os
+
+from flask import Response, abort, request
+
+from chart_cache import file_fingerprint
+from data_api import MAX_AGE
+from grid_store import GridStore
+from tiles import (MAX_ZOOM, MEMORY_MB, MIN_ZOOM, SurfaceTiles, TileMemory,
+                   tile_root)
+
+
+class TileAPI:
+    """
+    Registers the tile route on a flask server
+    """
+
+    def __init__(self, server, pollutants, root='data/wrangled',
+                 cache=tile_root('data'), memory_mb=MEMORY_MB):
+        self.pollutants = pollutants
+        self.root = root
+        self.cache = cache
+        self.memory = TileMemory(memory_mb)
+        self._surfaces = {}
+        server.add_url_rule('/tiles/<param>/<date>/<int:z>/<int:x>/<int:y>.png',
+                            'tile_data', self.tile_data)
+
+    def surface(self, param):
+        """
+        Returns the SurfaceTiles of param, reopened when run_all.py
+        replaces its grid store, or None if there is none or it was
+        written without its stations
+        """
+        path = os.path.join(self.root, param+'_grid')
+        fingerprint = file_fingerprint([os.path.join(path, 'manifest.json')])
+        entry = self._surfaces.get(param)
+        if entry is None or entry[0] != fingerprint:
+            surface = None
+            if fingerprint[0][1] is not None:
+                store = GridStore(path)
+                if store.stations is not None:
+                    surface = SurfaceTiles(store, self.cache, self.memory)
+            entry = self._surfaces[param] = (fingerprint, surface)
+        return entry[1]
+
+    def tile_url(self, param):
+        """
+        Returns the url template of the tiles of param, for Leaflet
+        """
+        return '/tiles/'+param+'/{date}/{z}/{x}/{y}.png'
+
+    def tile_data(self, param, date, z, x, y):
+        surface = self.surface(param) if param in self.pollutants else None
+        if surface is None:
+            abort(404)
+        try:
+            png, key = surface.tile(date, z, x, y)
+        except (KeyError, ValueError):
+            abort(404)
+        headers = {'Cache-Control': 'public, max-age={}'.format(MAX_AGE)}
+        etag = '{}-{}-{}-{}'.format(key, z, x, y)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304, headers=headers)
+        else:
+            response = Response(png, content_type='image/png', headers=headers)
+        response.set_etag(etag)
+        return response
+
+    def map_document(self, param, title):
+        """
+        Returns the HTML of a zoomable Leaflet map of the tiles of
+        param over OpenStreetMap, with a slider over its dates
+        """
+        surface = self.surface(param)
+        if surface is None:
+            return '<p>No map tiles for {}</p>'.format(title)
+        west, south, east, north = surface.bounds
+        return MAP_TEMPLATE.format(
+            title=title,
+            url=json.dumps(self.tile_url(param)),
+            dates=json.dumps(surface.store.dates),
+            bounds=json.dumps([[south, west], [north, east]]),
+            min_zoom=MIN_ZOOM,
+            max_zoom=MAX_ZOOM)
+
+
+MAP_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>
+  body {{ margin: 0; font-family: sans-serif; }}
+  #map {{ height: 440px; }}
+  #controls {{ padding: 4px 8px; }}
+  #date {{ width: 100%; }}
+</style>
+</head>
+<body>
+<div id="map"></div>
+<div id="controls">
+  <b>{title}</b>: <span id="label"></span>
+  <input id="date" type="range" min="0" step="1">
+</div>
+<script>
+  var dates = {dates};
+  var url = {url};
+  var map = L.map('map', {{minZoom: {min_zoom}, maxZoom: {max_zoom}}});
+  map.fitBounds({bounds});
+  L.tileLayer('https://tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
+    maxZoom: {max_zoom},
+    attribution: '&copy; OpenStreetMap contributors'
+  }}).addTo(map);
+  var surface = L.tileLayer(url, {{date: dates[dates.length - 1],
+                                  minZoom: {min_zoom}, maxZoom: {max_zoom},
+                                  opacity: 0.7}}).addTo(map);
+  var slider = document.getElementById('date');
+  var label = document.getElementById('label');
+  slider.max = dates.length - 1;
+  slider.value = dates.length - 1;
+  label.textContent = dates[dates.length - 1];
+  slider.addEventListener('input', function () {{
+    label.textContent = dates[slider.value];
+    surface.options.date = dates[slider.value];
+    surface.redraw();
+  }});
+</script>
+</body>
+</html>
+'''